@@ -0,0 +1,185 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Benchmark ingestion.series.build_series against a fake NBIA server, a GCS emulator and a local
+# Postgres DB (see harness.py). The version hierarchy of the synthetic collections is populated down
+# to unexpanded series, and the series are then built by --processes worker processes, each series
+# being expanded, downloaded (or copied, for IDC sourced collections), validated, uploaded to the
+# prestaging bucket and hash checked as in a version build. Reports instances/sec and the per series
+# latency, together with the metrics recorded by the ingestion code.
+#
+# E.g. to compare streamed with staged TCIA ingestion of 20 series of 200 1MB instances:
+#   python benchmarks/bench_build_series.py --shape Bench-A:5x1x4x200:1048576 --mode tcia
+#   python benchmarks/bench_build_series.py --shape Bench-A:5x1x4x200:1048576 --mode tcia_streaming
+
+import os
+import sys
+import time
+import shutil
+import argparse
+from urllib.parse import urlparse
+
+FAKE_NBIA_PORT = 8765
+# NBIA requests must be directed to the fake server before tcia_helpers is imported
+os.environ.setdefault('NBIA_HOST', f'http://localhost:{FAKE_NBIA_PORT}')
+# Debugging breakpoints in the ingestion code must not stop a benchmark
+os.environ.setdefault('PYTHONBREAKPOINT', '0')
+
+import settings as etl_settings
+from python_settings import settings
+if not settings.configured:
+    settings.configure(etl_settings)
+
+from multiprocessing import Process, Queue, Lock, shared_memory
+from sqlalchemy.orm import Session
+from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.tcia_helpers import get_access_token
+from utilities.metrics import metrics
+from ingestion import instance
+from ingestion.utilities import utils
+from ingestion.all_sources import All
+from ingestion.series import build_series
+from ingestion.series_scheduler import find_patient
+from benchmarks.synthetic import parse_shape
+from benchmarks.fake_nbia import FakeNBIA, start_server
+from benchmarks.harness import check_environment, create_benchmark_database, get_benchmark_engine, \
+    get_emulator_client, create_bucket, empty_bucket, fill_bucket, populate_version, report
+
+
+# Have the ingestion code use a client of the GCS emulator, which needs no credentials, in place of
+# get_storage_client(), which authenticates with the default credentials. Called in each worker process.
+def use_emulator_client():
+    client = get_emulator_client()
+    # instance imports get_storage_client by name
+    utils.get_storage_client = instance.get_storage_client = lambda args: client
+
+
+def worker(input, output, args, access, lock):
+    use_emulator_client()
+    engine = get_benchmark_engine(args.database)
+    with Session(engine) as sess:
+        all_sources = All(args.pid, sess, settings.CURRENT_VERSION, access, [], [], lock)
+        for collection_id, submitter_case_id, study_instance_uid, series_instance_uid in iter(input.get, 'STOP'):
+            begin = time.time()
+            try:
+                version, collection, patient = find_patient(sess, args, collection_id, submitter_case_id)
+                study = next(study for study in patient.studies if study.study_instance_uid == study_instance_uid)
+                series = next(series for series in study.seriess if series.series_instance_uid == series_instance_uid)
+                build_series(sess, args, all_sources, '', version, collection, patient, study, series)
+                done, instances = series.done, len(series.instances)
+            except Exception as exc:
+                errlogger.error('p%s: Series %s failed: %s', args.pid, series_instance_uid, exc)
+                sess.rollback()
+                done, instances = False, 0
+            metrics.observe('benchmark.series', time.time() - begin)
+            output.put((series_instance_uid, done, instances))
+            metrics.flush()
+
+
+def bench_build_series(args):
+    check_environment()
+    shapes = [parse_shape(shape) for shape in args.shape]
+
+    # The fake NBIA server runs in a thread of this process for the duration of the benchmark
+    nbia = FakeNBIA(shapes, args.latency, args.bandwidth, args.error_rate)
+    server = start_server(nbia, port=urlparse(os.environ['NBIA_HOST']).port)
+
+    client = get_emulator_client()
+    idc_bucket = args.idc_source_bucket if args.mode == 'idc' else None
+    if idc_bucket:
+        progresslogger.info('Filling %s', idc_bucket)
+        fill_bucket(client, idc_bucket, shapes)
+    for bucket_name in (args.prestaging_tcia_bucket, args.prestaging_idc_bucket):
+        empty_bucket(client, bucket_name)
+
+    create_benchmark_database(args.database)
+    engine = get_benchmark_engine(args.database)
+    with Session(engine) as sess:
+        populate_version(sess, shapes, idc_bucket)
+    # Worker processes create their own engines
+    engine.dispose()
+
+    if os.path.isdir(args.dicom_dir):
+        shutil.rmtree(args.dicom_dir)
+    os.mkdir(args.dicom_dir)
+    # The other source of each collection is skipped
+    args.skipped_collections = {shape.collection_id: [args.mode == 'idc', args.mode != 'idc'] for shape in shapes}
+    args.stream_tcia = args.mode == 'tcia_streaming'
+    tasks = [(shape.collection_id, patient_id, study_uid, series_uid) for shape in shapes \
+             for patient_id, study_uid, series_uid, _ in shape.all_series()]
+
+    access = shared_memory.ShareableList([*get_access_token(), 0])
+    lock = Lock()
+    metrics.configure(args.metrics_dir)
+
+    begin = time.time()
+    processes = []
+    task_queue = Queue()
+    done_queue = Queue()
+    for process in range(args.processes):
+        args.pid = process + 1
+        processes.append(Process(target=worker, args=(task_queue, done_queue, args, access, lock)))
+        processes[-1].start()
+    args.pid = 0
+
+    for task in tasks:
+        task_queue.put(task)
+    instances = 0
+    for _ in tasks:
+        series_instance_uid, done, series_instances = done_queue.get()
+        if done:
+            instances += series_instances
+        else:
+            errlogger.error('Series %s not done', series_instance_uid)
+    for process in processes:
+        task_queue.put('STOP')
+    for process in processes:
+        process.join()
+
+    result = report(f'build_series {args.mode} {" ".join(args.shape)}', begin, instances, 'instances', args.output)
+    progresslogger.info('Fake NBIA: %s requests, %s bytes sent', nbia.requests, nbia.bytes_sent)
+    server.shutdown()
+    access.shm.close()
+    access.shm.unlink()
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--shape', nargs='*', default=['Bench-A:5x1x4x100'], \
+                        help='Collections to build, each as <collection_id>:<patients>x<studies>x<series>x<instances>[:<instance_size>]')
+    parser.add_argument('--mode', default='tcia', help='One of tcia, tcia_streaming or idc')
+    parser.add_argument('--processes', type=int, default=4, help='Number of worker processes building series')
+    parser.add_argument('--database', default='idc_benchmark', help='Database to (re)create on the local Postgres server')
+    parser.add_argument('--prestaging_tcia_bucket', default='benchmark_prestaging_tcia')
+    parser.add_argument('--prestaging_idc_bucket', default='benchmark_prestaging_idc')
+    parser.add_argument('--idc_source_bucket', default='benchmark_idc_source', help='Bucket of IDC sourced instances, in idc mode')
+    parser.add_argument('--dicom_dir', default='/tmp/benchmark_dicom', help='Directory in which to expand downloaded zip files')
+    parser.add_argument('--upload_threads', type=int, default=16)
+    parser.add_argument('--upload_chunk_size', type=int, default=64*2**20)
+    parser.add_argument('--stream_spool_size', type=int, default=256*2**20)
+    parser.add_argument('--copy_threads', type=int, default=32)
+    parser.add_argument('--loading_profile', default='patient_series')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every fake NBIA response')
+    parser.add_argument('--bandwidth', type=int, default=0, help='Maximum bytes/sec of each fake NBIA response. 0 for unlimited')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of fake NBIA requests answered with a 503')
+    parser.add_argument('--metrics_dir', default='/tmp/benchmark_metrics')
+    parser.add_argument('--output', default='', help='File to which to write the results as JSON')
+    args = parser.parse_args()
+    args.pid = 0
+    print("{}".format(args), file=sys.stdout)
+
+    bench_build_series(args)
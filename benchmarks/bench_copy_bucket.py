@@ -0,0 +1,74 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Benchmark gcs/copy_bucket_mp against a GCS emulator (see harness.py). A source bucket is filled
+# with the instances of synthetic collections, and is then copied to an empty destination bucket.
+# Reports blobs/sec, together with the metrics recorded by copy_bucket_mp.
+#   python benchmarks/bench_copy_bucket.py --shape Bench-A:10x2x4x100:262144 --processes 8
+
+import os
+import sys
+import time
+import argparse
+
+import settings as etl_settings
+from python_settings import settings
+if not settings.configured:
+    settings.configure(etl_settings)
+
+from utilities.logging_config import progresslogger
+from gcs.copy_bucket_mp.copy_bucket_mp import copy_all_instances
+from utilities.checkpoint_store import CheckpointStore
+from benchmarks.synthetic import parse_shape
+from benchmarks.harness import check_environment, get_emulator_client, empty_bucket, fill_bucket, report
+
+
+def bench_copy_bucket(args):
+    check_environment()
+    shapes = [parse_shape(shape) for shape in args.shape]
+    client = get_emulator_client()
+    if args.fill:
+        empty_bucket(client, args.src_bucket)
+        blobs = fill_bucket(client, args.src_bucket, shapes)
+        progresslogger.info('Filled %s with %s blobs', args.src_bucket, len(blobs))
+    empty_bucket(client, args.dst_bucket)
+
+    # Nothing has been copied
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(f'{args.checkpoints}{suffix}'):
+            os.remove(f'{args.checkpoints}{suffix}')
+
+    begin = time.time()
+    copy_all_instances(args, CheckpointStore(args.checkpoints))
+    copied = sum(1 for _ in client.list_blobs(args.dst_bucket))
+    return report(f'copy_bucket_mp {" ".join(args.shape)}', begin, copied, 'blobs', args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--shape', nargs='*', default=['Bench-A:10x2x4x100:262144'], \
+                        help='Collections with which to fill the source bucket, each as <collection_id>:<patients>x<studies>x<series>x<instances>[:<instance_size>]')
+    parser.add_argument('--fill', type=bool, default=True, help='Refill the source bucket. Set to "" to reuse the blobs of a previous run')
+    parser.add_argument('--src_bucket', default='benchmark_copy_src')
+    parser.add_argument('--dst_bucket', default='benchmark_copy_dst')
+    parser.add_argument('--processes', type=int, default=8, help="Number of concurrent processes")
+    parser.add_argument('--batch', type=int, default=100, help='Size of batch assigned to each process')
+    parser.add_argument('--checkpoints', default='/tmp/benchmark_copy_checkpoints.db', help='Checkpoint store of the copied blobs')
+    parser.add_argument('--output', default='', help='File to which to write the results as JSON')
+    args = parser.parse_args()
+    print("{}".format(args), file=sys.stdout)
+
+    bench_copy_bucket(args)
@@ -0,0 +1,75 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Benchmark gcs/validate_bucket/validate_bucket_mp against a GCS emulator (see harness.py). A bucket
+# is filled with the instances of synthetic collections, and the expected blobs are written from the
+# same collections in place of the BigQuery query, so that only the listing and comparison of the
+# bucket are measured. --missing blobs are deleted from the bucket so that the mismatch path is
+# exercised as well. Reports blobs/sec.
+#   python benchmarks/bench_validate_bucket.py --shape Bench-A:100x2x4x100:1024 --missing 10
+
+import os
+import sys
+import time
+import argparse
+
+import settings as etl_settings
+from python_settings import settings
+if not settings.configured:
+    settings.configure(etl_settings)
+
+from utilities.logging_config import progresslogger
+from gcs.validate_bucket.validate_bucket_mp import check_all_instances
+from benchmarks.synthetic import parse_shape
+from benchmarks.harness import check_environment, get_emulator_client, empty_bucket, fill_bucket, report
+
+
+def bench_validate_bucket(args):
+    check_environment()
+    shapes = [parse_shape(shape) for shape in args.shape]
+    client = get_emulator_client()
+    empty_bucket(client, args.bucket)
+    blobs = fill_bucket(client, args.bucket, shapes)
+    progresslogger.info('Filled %s with %s blobs', args.bucket, len(blobs))
+    for blob_name in blobs[:args.missing]:
+        client.bucket(args.bucket).blob(blob_name).delete()
+
+    # The expected blobs are in blob name order, as the BQ query returns them
+    with open(args.expected_blobs, 'w') as f:
+        f.write(''.join(f'{blob_name}\n' for blob_name in sorted(blobs)))
+    if os.path.exists(args.found_blobs):
+        os.remove(args.found_blobs)
+
+    begin = time.time()
+    check_all_instances(args, check_hashes=args.check_hashes)
+    return report(f'validate_bucket_mp {" ".join(args.shape)}', begin, len(blobs), 'blobs', args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--shape', nargs='*', default=['Bench-A:100x2x4x100:1024'], \
+                        help='Collections with which to fill the bucket, each as <collection_id>:<patients>x<studies>x<series>x<instances>[:<instance_size>]')
+    parser.add_argument('--bucket', default='benchmark_validate')
+    parser.add_argument('--missing', type=int, default=0, help='Number of expected blobs to delete from the bucket')
+    parser.add_argument('--check_hashes', type=bool, default=False, help='Also compare the MD5 hash and size of each blob with those expected')
+    parser.add_argument('--expected_blobs', default='/tmp/benchmark_expected_blobs.txt')
+    parser.add_argument('--found_blobs', default='/tmp/benchmark_found_blobs.txt')
+    parser.add_argument('--batch', type=int, default=10000, help='Page size of the bucket listing')
+    parser.add_argument('--output', default='', help='File to which to write the results as JSON')
+    args = parser.parse_args()
+    print("{}".format(args), file=sys.stdout)
+
+    bench_validate_bucket(args)
@@ -0,0 +1,66 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Check that ingestion.collection.worker runs through a patient: that it builds the patient,
+# reports it on the output queue, flushes its metrics and logs its NBIA request metrics. The DB
+# session, the sources and build_patient are replaced by mocks, so that the check needs neither a
+# DB nor NBIA, and it runs the worker in this process.
+#   python benchmarks/check_collection_worker.py
+
+import os
+import sys
+import tempfile
+from queue import Queue
+from argparse import Namespace
+from unittest import mock
+
+import settings as etl_settings
+from python_settings import settings
+if not settings.configured:
+    settings.configure(etl_settings)
+
+from ingestion import collection
+from utilities.metrics import metrics
+
+
+def check_collection_worker():
+    input = Queue()
+    output = Queue()
+    input.put((1, 'Check-A', 'Check-A-00000'))
+    input.put('STOP')
+    args = Namespace(pid=1, skipped_tcia_collections=[], skipped_idc_collections=[], nbia_cache=None,
+                     loading_profile='patient_series')
+    patient = mock.Mock(submitter_case_id='Check-A-00000')
+
+    with tempfile.TemporaryDirectory() as metrics_dir, \
+            mock.patch.object(collection, 'sa_session'), \
+            mock.patch.object(collection, 'All'), \
+            mock.patch.object(collection, 'get_collection'), \
+            mock.patch.object(collection, 'get_patient', return_value=patient), \
+            mock.patch.object(collection, 'build_patient') as build_patient, \
+            mock.patch.object(collection, 'get_nbia_metrics', return_value={
+                'https://nbia/getSeries': dict(requests=1, retries=0, failures=0, seconds=0.1)}):
+        metrics.configure(metrics_dir)
+        collection.worker(input, output, args, None, None)
+        assert build_patient.call_count == 1, 'build_patient was not called'
+        assert output.get_nowait() == 'Check-A-00000', 'The patient was not reported'
+        assert os.listdir(metrics_dir), 'Metrics were not flushed'
+    print('collection.worker ran through a patient')
+
+
+if __name__ == '__main__':
+    check_collection_worker()
+    sys.exit(0)
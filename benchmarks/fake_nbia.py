@@ -0,0 +1,210 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# A stand-in for the NBIA API that serves synthetic collections (see synthetic.py), for benchmarking
+# ingestion without touching NBIA. It implements the endpoints that ingestion uses: token requests,
+# the patient/study/series/instance listings, getMD5Hierarchy, getM5HashForImage, and
+# getImageWithMD5Hash, which returns a zip of a series' instances together with an md5hashes.csv.
+# Latency, per connection bandwidth and a rate of 503 responses can be configured to approximate NBIA.
+#
+# Run it standalone, and point ingestion at it by setting NBIA_HOST before starting the ETL:
+#   python benchmarks/fake_nbia.py --port 8765 --shape Bench-A:10x2x4x100
+#   NBIA_HOST=http://localhost:8765 python ingestion/ingest.py ...
+# or start it in a thread of a benchmark with start_server().
+
+import io
+import sys
+import json
+import time
+import random
+import zipfile
+import argparse
+import threading
+from functools import lru_cache
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from benchmarks.synthetic import parse_shape, instance_hash
+
+WRITE_CHUNK_SIZE = 64*2**10
+
+
+class FakeNBIA:
+    def __init__(self, shapes, latency=0.0, bandwidth=0, error_rate=0.0):
+        self.shapes = {shape.collection_id: shape for shape in shapes}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        # Index the position of every object of every collection
+        self.patients = {}
+        self.studies = {}
+        self.seriess = {}
+        self.instances = {}
+        for shape in shapes:
+            for p, patient_id in enumerate(shape.patient_ids()):
+                self.patients[patient_id] = (shape, p)
+            for patient_id, study_uid, series_uid, (p, s, r) in shape.all_series():
+                self.studies[study_uid] = (shape, p, s)
+                self.seriess[series_uid] = (shape, p, s, r)
+                for i, sop_instance_uid in enumerate(shape.instance_uids(p, s, r)):
+                    self.instances[sop_instance_uid] = (shape, p, s, r, i)
+        self.requests = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+    # Returns (content_type, body) or None if the request is not recognized
+    def get(self, endpoint, params):
+        if endpoint == 'getCollectionValuesAndCounts':
+            return json_body([{'criteria': collection_id, 'count': shape.patients} for collection_id, shape in self.shapes.items()])
+        elif endpoint == 'getPatient':
+            shape = self.shapes[params['Collection']]
+            return json_body([{'PatientId': patient_id, 'Collection': shape.collection_id} for patient_id in shape.patient_ids()])
+        elif endpoint == 'getPatientStudy':
+            shape, p = self.patients[params['PatientID']]
+            return json_body([{'StudyInstanceUID': study_uid, 'PatientID': params['PatientID']} for study_uid in shape.study_uids(p)])
+        elif endpoint == 'getSeries':
+            shape, p, s = self.studies[params['StudyInstanceUID']]
+            return json_body([{'SeriesInstanceUID': series_uid} for series_uid in shape.series_uids(p, s)])
+        elif endpoint == 'getSOPInstanceUIDs':
+            shape, p, s, r = self.seriess[params['SeriesInstanceUID']]
+            return json_body([{'SOPInstanceUID': sop_instance_uid} for sop_instance_uid in shape.instance_uids(p, s, r)])
+        elif endpoint == 'getM5HashForImage':
+            return 'text/plain', instance_hash(*self.instances[params['SOPInstanceUid']]).encode()
+        elif endpoint == 'getImageWithMD5Hash':
+            return 'application/zip', self.series_zip(*self.seriess[params['SeriesInstanceUID']])
+        return None
+
+    def post(self, endpoint, params):
+        if endpoint == 'token':
+            return json_body({'access_token': 'fake-access-token', 'refresh_token': 'fake-refresh-token', 'expires_in': 7200})
+        elif endpoint == 'getMD5Hierarchy':
+            if 'SeriesInstanceUID' in params:
+                hash = self.seriess[params['SeriesInstanceUID']][0].series_hash(*self.seriess[params['SeriesInstanceUID']][1:])
+            elif 'StudyInstanceUID' in params:
+                hash = self.studies[params['StudyInstanceUID']][0].study_hash(*self.studies[params['StudyInstanceUID']][1:])
+            elif 'PatientID' in params:
+                shape, p = self.patients[params['PatientID']]
+                hash = shape.patient_hash(p)
+            else:
+                hash = self.shapes[params['Collection']].collection_hash()
+            return 'text/plain', hash.encode()
+        return None
+
+    # A zip of the instances of a series, named as NBIA names them, and an md5hashes.csv of their hashes.
+    # Members are stored, not deflated, so that the zip can be read as a stream.
+    @lru_cache(maxsize=64)
+    def series_zip(self, shape, p, s, r):
+        buffer = io.BytesIO()
+        rows = ['FileName,MD5Hash']
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zip:
+            for i in range(shape.instances):
+                name = f'1-{i+1:03d}.dcm'
+                zip.writestr(name, shape.dicom(p, s, r, i))
+                rows.append(f'{name},{instance_hash(shape, p, s, r, i)}')
+            zip.writestr('md5hashes.csv', '\n'.join(rows) + '\n')
+        return buffer.getvalue()
+
+
+def json_body(value):
+    return 'application/json', json.dumps(value).encode()
+
+
+class FakeNBIAHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Set by start_server
+    nbia = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, method):
+        nbia = self.nbia
+        url = urlparse(self.path)
+        endpoint = url.path.rsplit('/', 1)[-1]
+        params = {key.strip(): values[0] for key, values in parse_qs(url.query).items()}
+        if method == 'POST':
+            length = int(self.headers.get('Content-Length', 0))
+            params.update({key.strip(): values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()})
+        with nbia.lock:
+            nbia.requests += 1
+        if nbia.latency:
+            time.sleep(nbia.latency)
+        if nbia.error_rate and random.random() < nbia.error_rate:
+            self.send_error(503)
+            return
+        try:
+            result = nbia.get(endpoint, params) if method == 'GET' else nbia.post(endpoint, params)
+        except KeyError:
+            result = None
+        if result is None:
+            self.send_error(404)
+            return
+        content_type, body = result
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.write_throttled(body)
+
+    # Write the body at no more than the configured bandwidth
+    def write_throttled(self, body):
+        begin = time.time()
+        for offset in range(0, len(body), WRITE_CHUNK_SIZE):
+            self.wfile.write(body[offset:offset+WRITE_CHUNK_SIZE])
+            if self.nbia.bandwidth:
+                delay = (offset + WRITE_CHUNK_SIZE) / self.nbia.bandwidth - (time.time() - begin)
+                if delay > 0:
+                    time.sleep(delay)
+        with self.nbia.lock:
+            self.nbia.bytes_sent += len(body)
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+
+# Start a fake NBIA server in a daemon thread. Returns the server; its URL is http://<host>:<server.server_port>
+def start_server(nbia, host='localhost', port=0):
+    handler = type('Handler', (FakeNBIAHandler,), {'nbia': nbia})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--shape', nargs='*', default=['Bench-A:10x2x4x100'], \
+                        help='Collections to serve, each as <collection_id>:<patients>x<studies>x<series>x<instances>[:<instance_size>]')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--bandwidth', type=int, default=0, help='Maximum bytes/sec of each response. 0 for unlimited')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of requests answered with a 503')
+    args = parser.parse_args()
+    print("{}".format(args), file=sys.stdout)
+
+    nbia = FakeNBIA([parse_shape(shape) for shape in args.shape], args.latency, args.bandwidth, args.error_rate)
+    server = start_server(nbia, args.host, args.port)
+    print(f'Serving {", ".join(args.shape)} at http://{args.host}:{server.server_port}')
+    try:
+        while True:
+            time.sleep(60)
+            print(f'{nbia.requests} requests, {nbia.bytes_sent} bytes sent')
+    except KeyboardInterrupt:
+        server.shutdown()
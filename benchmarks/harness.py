@@ -0,0 +1,176 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Setup shared by the benchmarks: a local Postgres DB holding the version hierarchy of synthetic
+# collections, buckets in a GCS emulator, and reporting of the results.
+#
+# The benchmarks never use the Cloud SQL DB. They connect to the local Postgres server given by
+# settings.LOCAL_HOST/LOCAL_PORT/LOCAL_USERNAME/LOCAL_PASSWORD, in which they create (and
+# recreate on every run) the database given by --database. GCS requests go to the emulator given by
+# the STORAGE_EMULATOR_HOST environment variable, e.g. fake-gcs-server:
+#   docker run -d -p 4443:4443 fsouza/fake-gcs-server -scheme http
+#   export STORAGE_EMULATOR_HOST=http://localhost:4443
+
+import os
+import sys
+import json
+import time
+from uuid import uuid4, uuid5, NAMESPACE_OID
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from python_settings import settings
+from sqlalchemy import create_engine, text
+from sqlalchemy_utils import register_composites
+from google.cloud import storage
+from google.auth.credentials import AnonymousCredentials
+from google.api_core.exceptions import Conflict
+
+from idc.models import Base, Version, Collection, Patient, Study, Series, Instance, IDC_Collection, IDC_Patient, \
+    IDC_Study, IDC_Series, IDC_Instance, version_collection, collection_patient, patient_study, study_series, \
+    series_instance
+from utilities.metrics import collect, summary
+
+# The tables of the version hierarchy and of the IDC sourced metadata
+BENCHMARK_TABLES = [table.__table__ if hasattr(table, '__table__') else table for table in (
+    Version, Collection, Patient, Study, Series, Instance,
+    version_collection, collection_patient, patient_study, study_series, series_instance,
+    IDC_Collection, IDC_Patient, IDC_Study, IDC_Series, IDC_Instance)]
+
+
+def check_environment():
+    if not os.environ.get('STORAGE_EMULATOR_HOST'):
+        print('STORAGE_EMULATOR_HOST must be set to the URL of a GCS emulator', file=sys.stderr)
+        exit(1)
+
+
+def local_server_uri():
+    return f'postgresql+psycopg2://{settings.LOCAL_USERNAME}:{settings.LOCAL_PASSWORD}@{settings.LOCAL_HOST}:{settings.LOCAL_PORT}'
+
+
+# Create a fresh database on the local Postgres server, having empty hierarchy tables
+def create_benchmark_database(database):
+    server_engine = create_engine(f'{local_server_uri()}/postgres', isolation_level='AUTOCOMMIT')
+    with server_engine.connect() as conn:
+        conn.execute(text(f'DROP DATABASE IF EXISTS {database}'))
+        conn.execute(text(f'CREATE DATABASE {database}'))
+    server_engine.dispose()
+    engine = create_engine(f'{local_server_uri()}/{database}')
+    Base.metadata.create_all(engine, tables=BENCHMARK_TABLES)
+    engine.dispose()
+
+
+# Each process, including each worker process, must create its own engine
+def get_benchmark_engine(database):
+    engine = create_engine(f'{local_server_uri()}/{database}')
+    with engine.connect() as conn:
+        register_composites(conn)
+    return engine
+
+
+def get_emulator_client():
+    return storage.Client(project=settings.DEV_PROJECT, credentials=AnonymousCredentials())
+
+
+def create_bucket(client, bucket_name):
+    try:
+        client.create_bucket(bucket_name)
+    except Conflict:
+        pass
+    return client.bucket(bucket_name)
+
+
+# The blob name of a synthetic instance. It is derived from the SOPInstanceUID so that it is the same in every run.
+def blob_name(sop_instance_uid):
+    return f'{uuid5(NAMESPACE_OID, sop_instance_uid)}.dcm'
+
+
+# Upload the instances of the collections to a bucket. Returns the names of the blobs.
+def fill_bucket(client, bucket_name, shapes, threads=16):
+    bucket = create_bucket(client, bucket_name)
+
+    def upload(item):
+        shape, (p, s, r), i, sop_instance_uid = item
+        bucket.blob(blob_name(sop_instance_uid)).upload_from_string(shape.dicom(p, s, r, i))
+        return blob_name(sop_instance_uid)
+
+    items = [(shape, position, i, sop_instance_uid) for shape in shapes for _, _, _, position in shape.all_series() \
+             for i, sop_instance_uid in enumerate(shape.instance_uids(*position))]
+    with ThreadPoolExecutor(threads) as executor:
+        return list(executor.map(upload, items))
+
+
+def empty_bucket(client, bucket_name):
+    bucket = create_bucket(client, bucket_name)
+    for blob in client.list_blobs(bucket):
+        blob.delete()
+
+
+# Populate the version hierarchy of the collections down to the series, which are left unexpanded, as
+# expand_study would. If idc_bucket is given, the collections are IDC sourced: their metadata is
+# added to the idc_* tables, with gcs_urls of the instances as uploaded by fill_bucket.
+def populate_version(sess, shapes, idc_bucket=None):
+    now = datetime.utcnow()
+    sources = (False, True) if idc_bucket else (True, False)
+    common = dict(min_timestamp=now, init_idc_version=settings.CURRENT_VERSION, rev_idc_version=settings.CURRENT_VERSION,
+                  final_idc_version=0, done=False, is_new=True, sources=sources, revised=sources, hashes=None)
+    version = Version(version=settings.CURRENT_VERSION, previous_version=settings.PREVIOUS_VERSION, min_timestamp=now,
+                      done=False, is_new=True, expanded=True, sources=sources, revised=sources, hashes=None)
+    sess.add(version)
+    for shape in shapes:
+        collection = Collection(collection_id=shape.collection_id, idc_collection_id=str(uuid4()), uuid=str(uuid4()),
+                                expanded=True, **common)
+        version.collections.append(collection)
+        if idc_bucket:
+            sess.add(IDC_Collection(collection_id=shape.collection_id, hash=shape.collection_hash()))
+        for p, patient_id in enumerate(shape.patient_ids()):
+            patient = Patient(submitter_case_id=patient_id, idc_case_id=str(uuid4()), uuid=str(uuid4()),
+                              expanded=True, **common)
+            collection.patients.append(patient)
+            if idc_bucket:
+                sess.add(IDC_Patient(submitter_case_id=patient_id, collection_id=shape.collection_id, hash=shape.patient_hash(p)))
+            for s, study_uid in enumerate(shape.study_uids(p)):
+                study = Study(study_instance_uid=study_uid, uuid=str(uuid4()), study_instances=0, expanded=True, **common)
+                patient.studies.append(study)
+                if idc_bucket:
+                    sess.add(IDC_Study(study_instance_uid=study_uid, submitter_case_id=patient_id, hash=shape.study_hash(p, s)))
+                for r, series_uid in enumerate(shape.series_uids(p, s)):
+                    study.seriess.append(Series(series_instance_uid=series_uid, uuid=str(uuid4()), expanded=False, **common))
+                    if idc_bucket:
+                        sess.add(IDC_Series(series_instance_uid=series_uid, study_instance_uid=study_uid,
+                                            hash=shape.series_hash(p, s, r), third_party=False))
+                        for i, sop_instance_uid in enumerate(shape.instance_uids(p, s, r)):
+                            sess.add(IDC_Instance(sop_instance_uid=sop_instance_uid, series_instance_uid=series_uid,
+                                hash=shape.instance_hash(p, s, r, i), gcs_url=f'gs://{idc_bucket}/{blob_name(sop_instance_uid)}',
+                                size=len(shape.dicom(p, s, r, i)), idc_version=settings.CURRENT_VERSION))
+    sess.commit()
+    return version
+
+
+# Print, and optionally save as JSON, the rate of a benchmark and the metrics recorded while it ran
+def report(name, begin, units, unit_name, output=None):
+    elapsed = time.time() - begin
+    result = dict(
+        benchmark=name,
+        seconds=elapsed,
+        **{unit_name: units, f'{unit_name}_per_second': units/elapsed if elapsed else 0},
+        metrics=summary(collect())
+    )
+    print(json.dumps(result, indent=2, sort_keys=True))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    return result
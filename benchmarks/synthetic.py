@@ -0,0 +1,137 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Synthetic collections for the benchmarks. A collection is described by its shape: the number of
+# patients, studies per patient, series per study and instances per series, and the size of each
+# instance. UIDs and pixel data are derived from the collection ID and the position of each object,
+# so that the fake NBIA server and a benchmark that were given the same shape agree on the
+# collection without sharing any state.
+
+import io
+import random
+import hashlib
+from functools import lru_cache
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.filewriter import dcmwrite
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+
+from ingestion.utilities.utils import get_merkle_hash
+
+# Secondary Capture Image Storage
+SOP_CLASS_UID = '1.2.840.10008.5.1.4.1.1.7'
+
+
+def parse_shape(shape):
+    # <collection_id>:<patients>x<studies>x<series>x<instances>[:<instance_size>]
+    collection_id, counts, *size = shape.split(':')
+    patients, studies, seriess, instances = (int(count) for count in counts.split('x'))
+    return CollectionShape(collection_id, patients, studies, seriess, instances, int(size[0]) if size else 512*2**10)
+
+
+class CollectionShape:
+    def __init__(self, collection_id, patients, studies, seriess, instances, instance_size):
+        self.collection_id = collection_id
+        self.patients = patients
+        self.studies = studies
+        self.seriess = seriess
+        self.instances = instances
+        self.instance_size = instance_size
+
+    def __str__(self):
+        return f'{self.collection_id}:{self.patients}x{self.studies}x{self.seriess}x{self.instances}:{self.instance_size}'
+
+    @lru_cache(maxsize=None)
+    def uid(self, *position):
+        return generate_uid(entropy_srcs=[self.collection_id, *(str(p) for p in position)])
+
+    def patient_ids(self):
+        return [f'{self.collection_id}-{p:05d}' for p in range(self.patients)]
+
+    def study_uids(self, p):
+        return [self.uid(p, s) for s in range(self.studies)]
+
+    def series_uids(self, p, s):
+        return [self.uid(p, s, r) for r in range(self.seriess)]
+
+    def instance_uids(self, p, s, r):
+        return [self.uid(p, s, r, i) for i in range(self.instances)]
+
+    # Yield (patient_id, study_uid, series_uid, position) of each series, where position is (p, s, r)
+    def all_series(self):
+        for p, patient_id in enumerate(self.patient_ids()):
+            for s, study_uid in enumerate(self.study_uids(p)):
+                for r, series_uid in enumerate(self.series_uids(p, s)):
+                    yield patient_id, study_uid, series_uid, (p, s, r)
+
+    def dicom(self, p, s, r, i):
+        return make_dicom(self.collection_id, self.patient_ids()[p], self.uid(p, s), self.uid(p, s, r),
+                          self.uid(p, s, r, i), self.instance_size)
+
+    # Hashes computed as NBIA does: instances are hashed, and each higher level is the Merkle hash of its children
+    def instance_hash(self, p, s, r, i):
+        return instance_hash(self, p, s, r, i)
+
+    def series_hash(self, p, s, r):
+        return get_merkle_hash([instance_hash(self, p, s, r, i) for i in range(self.instances)])
+
+    def study_hash(self, p, s):
+        return get_merkle_hash([self.series_hash(p, s, r) for r in range(self.seriess)])
+
+    def patient_hash(self, p):
+        return get_merkle_hash([self.study_hash(p, s) for s in range(self.studies)])
+
+    def collection_hash(self):
+        return get_merkle_hash([self.patient_hash(p) for p in range(self.patients)])
+
+
+@lru_cache(maxsize=None)
+def instance_hash(shape, p, s, r, i):
+    return hashlib.md5(shape.dicom(p, s, r, i)).hexdigest()
+
+
+@lru_cache(maxsize=4096)
+def make_dicom(collection_id, patient_id, study_uid, series_uid, sop_instance_uid, size):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = SOP_CLASS_UID
+    file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.preamble = b'\0' * 128
+    ds.SOPClassUID = SOP_CLASS_UID
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.PatientID = patient_id
+    ds.ClinicalTrialProtocolID = collection_id
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.Modality = 'OT'
+    # Pixel data makes up the requested size. It is random so that it does not compress.
+    rows = max(1, size // 512)
+    ds.Rows = rows
+    ds.Columns = 256
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.PixelData = random.Random(sop_instance_uid).randbytes(rows * 512)
+
+    buffer = io.BytesIO()
+    dcmwrite(buffer, ds, write_like_original=False)
+    return buffer.getvalue()
@@ -23,6 +23,8 @@
 
 import argparse
 from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.checkpoint_store import success_checkpoints
+from utilities.metrics import metrics, collect, to_json
 
 import google
 from google.cloud import storage, bigquery
@@ -40,7 +42,8 @@ def instance_exists(args, dicomweb_sess, study_instance_uid, series_instance_uid
     # Set the required application/dicom+json; charset=utf-8 header on the request
     headers = {"Content-Type": "application/dicom+json; charset=utf-8"}
 
-    response = dicomweb_sess.get(dicomweb_path, headers=headers)
+    with metrics.timer('gch.dicomweb.get'):
+        response = dicomweb_sess.get(dicomweb_path, headers=headers)
     if response.status_code == 200:
         progresslogger.info('%s found',sop_instance_uid)
         # print('%s found',sop_instance_uid)
@@ -51,7 +54,7 @@ def instance_exists(args, dicomweb_sess, study_instance_uid, series_instance_uid
         return False
 
 
-def delete_instance(args, dicomweb_session, study_instance_uid, series_instance_uid, sop_instance_uid):
+def delete_instance(args, dicomweb_session, study_instance_uid, series_instance_uid, sop_instance_uid, done_instances):
     # URL to the Cloud Healthcare API endpoint and version
     base_url = "https://healthcare.googleapis.com/v1"
     url = "{}/projects/{}/locations/{}".format(base_url, settings.PUB_PROJECT, settings.GCH_REGION)
@@ -61,37 +64,36 @@ def delete_instance(args, dicomweb_session, study_instance_uid, series_instance_
     # Set the required application/dicom+json; charset=utf-8 header on the request
     headers = {"Content-Type": "application/dicom+json; charset=utf-8"}
 
-    response = dicomweb_session.delete(dicomweb_path, headers=headers)
+    with metrics.timer('gch.dicomweb.delete'):
+        response = dicomweb_session.delete(dicomweb_path, headers=headers)
     retries = 3
     while retries:
         if response.status_code == 200:
+            metrics.count('gch.delete.instances')
             successlogger.info(sop_instance_uid)
+            done_instances.add(sop_instance_uid)
             return
         else:
             retries -= 1
+    metrics.count('gch.delete.failures')
     errlogger.error(sop_instance_uid)
 
-def worker(input, args):
+def worker(input, args, done_instances):
     scoped_credentials, project = google.auth.default(
         ["https://www.googleapis.com/auth/cloud-platform"]
     )
     # Create a DICOMweb requests Session object with the credentials.
     dicomweb_sess = requests.AuthorizedSession(scoped_credentials)
 
-    try:
-        # Get the previously copied blobs
-        done_instances = set(open(successlogger.handlers[0].baseFilename).read().splitlines())
-    except:
-        done_instances = set()
-
     # client = storage.Client()
     for rev_uids, n in iter(input.get, 'STOP'):
+        todo = set(done_instances.todo(row['sop_instance_uid'] for row in rev_uids))
         for row in rev_uids:
-            if not row['sop_instance_uid'] in done_instances:
+            if row['sop_instance_uid'] in todo:
                 if instance_exists(args, dicomweb_sess, row['study_instance_uid'],
                                    row['series_instance_uid'], row['sop_instance_uid']):
                     delete_instance(args, dicomweb_sess, row['study_instance_uid'],
-                                    row['series_instance_uid'], row['sop_instance_uid'])
+                                    row['series_instance_uid'], row['sop_instance_uid'], done_instances)
                     # print(f"{n}: Instance {row['sop_instance_uid']}  deleted")
                     progresslogger.info(f"{n}: Instance {row['sop_instance_uid']}  deleted")
                 else:
@@ -102,25 +104,24 @@ def worker(input, args):
                 # print(f"{n}: Instance {row['sop_instance_uid']} previously deleted")
                 progresslogger.info(f"{n}: Instance {row['sop_instance_uid']} previously deleted")
             n += 1
+        metrics.flush()
 
 def delete_instances(args):
     client = bigquery.Client()
 
-    try:
-        # Get the previously copied blobs
-        done_instances = set(open(successlogger.handlers[0].baseFilename).read().splitlines())
-    except:
-        done_instances = set()
+    # The previously deleted instances
+    done_instances = success_checkpoints(successlogger)
 
 
     num_processes = args.processes
     processes = []
     task_queue = Queue()
+    metrics.configure(f'{settings.LOG_DIR}/metrics')
     # Start worker processes
     for process in range(num_processes):
         args.id = process + 1
         processes.append(
-            Process(group=None, target=worker, args=(task_queue, args)))
+            Process(group=None, target=worker, args=(task_queue, args, done_instances)))
         processes[-1].start()
 
 
@@ -169,6 +170,7 @@ def delete_instances(args):
     for process in processes:
         print(f'Joining process: {process.name}, {process.is_alive()}')
         process.join()
+    progresslogger.info(to_json(collect()))
 
     return
 
@@ -30,6 +30,7 @@ from google.api_core.exceptions import Conflict
 from idc.models import Base, Version, Patient, Study, Series, Instance, Collection, CR_Collections, Defaced_Collections, Open_Collections, Redacted_Collections
 from ingestion.utilities.utils import empty_bucket, to_webapp
 from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.metrics import metrics, collect, to_json
 import settings
 import google
 from google.cloud import storage, bigquery
@@ -170,8 +171,11 @@ def populate_staging_bucket(args, uids):
                     progresslogger.debug('******p%s: Rewrite bytes_rewritten %s, total_bytes %s', args.pid, bytes_rewritten,
                                       total_bytes)
                     token, bytes_rewritten, total_bytes = dst_blob.rewrite(src_blob, token=token)
+                metrics.count('gch.stage.blobs')
+                metrics.bytes('gch.stage', total_bytes)
                 successlogger.info(f'{row["uuid"]}')
             except Exception as exc:
+               metrics.count('gch.stage.failures')
                errlogger.error(f'{blob_id}: {exc}')
         else:
             progresslogger.info(f'{row["uuid"]} exists')
@@ -181,6 +185,7 @@ def worker(input, args):
     for uids, n in iter(input.get, 'STOP'):
         progresslogger.info(f'p{args.id}: {n}')
         populate_staging_bucket(args, uids)
+        metrics.flush()
 
 
 def insert_instances(args, dicomweb_sess):
@@ -214,6 +219,7 @@ def insert_instances(args, dicomweb_sess):
     num_processes = args.processes
     processes = []
     task_queue = Queue()
+    metrics.configure(f'{settings.LOG_DIR}/metrics')
     # Start worker processes
     for process in range(num_processes):
         args.id = process + 1
@@ -274,7 +280,9 @@ def insert_instances(args, dicomweb_sess):
     response = import_dicom_instances(settings.GCH_PROJECT, settings.GCH_REGION, settings.GCH_DATASET,
                                       settings.GCH_DICOMSTORE, content_uri)
     print(f'Response: {response}')
-    result = wait_done(response, args, args.period)
+    with metrics.timer('gch.import'):
+        result = wait_done(response, args, args.period)
+    progresslogger.info(to_json(collect()))
 
     # Don't forget to delete the staging bucket
 
@@ -22,6 +22,8 @@ from google.cloud import bigquery, storage
 import time
 from multiprocessing import Process, Queue
 from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.checkpoint_store import success_checkpoints
+from utilities.gcs_batch import copy_blobs
 
 # Copy the blobs that are new to a version from dev pre-staging buckets
 # to dev staging buckets.
@@ -53,30 +55,13 @@ def get_urls(args, query):
     destination = client.get_table(destination)
     return destination
 
-TRIES = 3
-
-def copy_instances(args, client, src_bucket, dst_bucket, blob_names, n):
-    for blob_name in blob_names:
-        src_blob = src_bucket.blob(blob_name)
-        dst_blob = dst_bucket.blob(blob_name)
-        retries = 0
-        while True:
-            try:
-                rewrite_token = False
-                while True:
-                    rewrite_token, bytes_rewritten, bytes_to_rewrite = dst_blob.rewrite(
-                        src_blob, token=rewrite_token
-                    )
-                    if not rewrite_token:
-                        break
-                successlogger.info(f'{blob_name}')
-                break
-            except Exception as exc:
-                if retries == TRIES:
-                    errlogger.error('p%s: %s/%s copy failed\n   %s', args.id, args.src_bucket, blob_name, exc)
-                    break
-            time.sleep(retries)
-            retries += 1
+def copy_instances(args, client, src_bucket, dst_bucket, blob_names, n, dones):
+    copied, failed = copy_blobs(client, args.src_bucket, args.dst_bucket, blob_names)
+    for blob_name in copied:
+        successlogger.info(f'{blob_name}')
+    dones.add_many(copied)
+    for blob_name, exc in failed:
+        errlogger.error('p%s: %s/%s copy failed\n   %s', args.id, args.src_bucket, blob_name, exc)
 
     progresslogger.info('p%s Copied blobs %s:%s ', args.id, n, n+len(blob_names)-1)
 
@@ -91,9 +76,9 @@ def worker(input, args, dones):
     src_bucket = storage.Bucket(client, args.src_bucket)
     dst_bucket = storage.Bucket(client, args.dst_bucket)
     for blob_names, n in iter(input.get, 'STOP'):
-        blob_names_todo = set(blob_names) - dones
+        blob_names_todo = dones.todo(blob_names)
         if blob_names_todo:
-            copy_instances(args, client, src_bucket, dst_bucket, blob_names_todo, n)
+            copy_instances(args, client, src_bucket, dst_bucket, blob_names_todo, n, dones)
         else:
             progresslogger.info(f'p{args.id}: Blobs {n}:{n+len(blob_names)-1} previously copied')
 
@@ -109,7 +94,8 @@ def copy_all_blobs(args, query):
     task_queue = Queue()
 
     strt = time.time()
-    dones = set(open(f'{successlogger.handlers[0].baseFilename}').read().splitlines())
+    # Previously copied blobs. Workers query and add to the store rather than each holding a copy.
+    dones = success_checkpoints(successlogger)
 
     # Start worker processes
     for process in range(num_processes):
@@ -30,6 +30,10 @@ import os
 # successlogger = logging.getLogger('root.success')
 # errlogger = logging.getLogger('root.err')
 from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.metrics import metrics, collect, to_json
+from utilities.concurrency import ConcurrencyController
+from utilities.gcs_batch import copy_blobs
+from utilities.bucket_lister import list_blob_pages
 import time
 from multiprocessing import Process, Queue
 from google.cloud import storage, bigquery
@@ -42,35 +46,20 @@ if not settings.configured:
     settings.configure(etl_settings)
 assert settings.configured
 
-TRIES = 3
-
-def copy_instances(args, client, src_bucket, dst_bucket, blob_names, n):
-    for blob_name in blob_names:
-        src_blob = src_bucket.blob(blob_name)
-        dst_blob = dst_bucket.blob(blob_name)
-        retries = 0
-        while True:
-            try:
-                rewrite_token = False
-                while True:
-                    rewrite_token, bytes_rewritten, bytes_to_rewrite = dst_blob.rewrite(
-                        src_blob, token=rewrite_token
-                    )
-                    if not rewrite_token:
-                        break
-                successlogger.info(f'{blob_name}')
-                break
-            except Exception as exc:
-                if retries == TRIES:
-                    errlogger.error('p%s: %s/%s copy failed\n   %s', args.id, args.src_bucket, blob_name, exc)
-                    break
-            time.sleep(retries)
-            retries += 1
+def copy_instances(args, client, src_bucket, dst_bucket, blob_names, n, controller, dones):
+    # The blobs are copied in batch requests, each waiting for one of the in-flight slots that the
+    # controller allows
+    copied, failed = copy_blobs(client, args.src_bucket, args.dst_bucket, blob_names, controller)
+    for blob_name in copied:
+        successlogger.info(f'{blob_name}')
+    dones.add_many(copied)
+    for blob_name, exc in failed:
+        errlogger.error('p%s: %s/%s copy failed\n   %s', args.id, args.src_bucket, blob_name, exc)
 
     progresslogger.info('p%s Copied blobs %s:%s ', args.id, n, n+len(blob_names)-1)
 
 
-def worker(input, args, dones):
+def worker(input, args, dones, controller):
     # proglogger.info('p%s: Worker starting: args: %s', args.id, args )
     # print(f'p{args.id}: Worker starting: args: {args}')
 
@@ -80,13 +69,15 @@ def worker(input, args, dones):
     src_bucket = storage.Bucket(client, args.src_bucket)
     dst_bucket = storage.Bucket(client, args.dst_bucket)
     for blob_names, n in iter(input.get, 'STOP'):
-        blob_names_todo = blob_names - dones
+        blob_names_todo = dones.todo(blob_names)
         if blob_names_todo:
-            copy_instances(args, client, src_bucket, dst_bucket, blob_names_todo, n)
+            copy_instances(args, client, src_bucket, dst_bucket, blob_names_todo, n, controller, dones)
         else:
             progresslogger.info(f'p{args.id}: Blobs {n}:{n+len(blob_names)-1} previously copied')
+        metrics.flush()
 
 
+# dones is a CheckpointStore of the blobs, and buckets, previously copied. Workers query and add to it.
 def copy_all_instances(args, dones):
     client = storage.Client()
     src_bucket = storage.Bucket(client, args.src_bucket)
@@ -115,32 +106,34 @@ def copy_all_instances(args, dones):
 
     progresslogger.info(f'Copying bucket {args.src_bucket} to {args.dst_bucket}, ')
 
-    num_processes = args.processes
+    # args.processes is the ceiling of the number of concurrent copies. The controller adjusts the
+    # number actually in flight to the observed throughput, throttling and CPU load.
+    num_processes = int(args.processes)
+    controller = ConcurrencyController(num_processes)
     processes = []
     task_queue = Queue()
 
     strt = time.time()
+    metrics.configure(f'{settings.LOG_DIR}/metrics')
 
     # Start worker processes
     for process in range(num_processes):
         args.id = process + 1
         processes.append(
-            Process(group=None, target=worker, args=(task_queue, args, dones)))
+            Process(group=None, target=worker, args=(task_queue, args, dones, controller)))
         processes[-1].start()
+    controller.start()
 
-    # Distribute the work across the task_queues
+    # Distribute the work across the task_queues. The bucket is listed in concurrent shards, and
+    # each page is queued as it arrives.
     n = 0
-    iterator = client.list_blobs(src_bucket,  page_size=args.batch)
-    for page in iterator.pages:
-        if page.num_items:
-            blobs = set([blob.name for blob in page])
-            # blobs = blobs - dones
-            task_queue.put((blobs, n))
-            # print(f'Queued {n}:{n+len(blobs)-1}')
-        else:
-            break
-        n += page.num_items
+    for page in list_blob_pages(client, args.src_bucket, page_size=args.batch, fields='items(name),nextPageToken'):
+        blobs = [blob.name for blob in page]
+        task_queue.put((blobs, n))
+        # print(f'Queued {n}:{n+len(blobs)-1}')
+        n += len(blobs)
     progresslogger.info('Primary work distribution complete; {} blobs'.format(n))
+    metrics.flush()
 
     # Tell child processes to stop
     for i in range(num_processes):
@@ -152,6 +145,7 @@ def copy_all_instances(args, dones):
     for process in processes:
         print(f'Joining process: {process.name}, {process.is_alive()}')
         process.join()
+    controller.stop()
 
     delta = time.time() - strt
     rate = (n)/delta
@@ -161,7 +155,9 @@ def copy_all_instances(args, dones):
         print(f'Bucket {args.src_bucket} had errors')
     else:
         successlogger.info(f'{args.src_bucket}')
-        progresslogger.info(f'Completed bucket {args.src_bucket}, {rate} instances/sec, {num_processes} processes')
+        dones.add(args.src_bucket)
+        progresslogger.info(f'Completed bucket {args.src_bucket}, {rate} instances/sec, {num_processes} processes, final concurrency {controller.limit.value}')
+    progresslogger.info(to_json(collect()))
 
 
 # if __name__ == '__main__':
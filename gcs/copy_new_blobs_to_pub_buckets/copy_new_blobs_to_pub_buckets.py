@@ -22,6 +22,9 @@ from google.cloud import bigquery, storage
 import time
 from multiprocessing import Process, Queue
 from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.gcs_batch import copy_blobs
+from utilities.bulk_copy import ManifestWriter, bulk_copy
+from utilities.checkpoint_store import success_checkpoints
 
 # Copy the blobs that are new to a version from dev pre-staging buckets
 # to dev staging buckets.
@@ -54,43 +57,40 @@ def get_urls(args):
     return destination
 
 
+# Return the source bucket, destination bucket and name of the blob at a pair of urls
+def copy_buckets(dev_url, pub_url):
+    blob_name = dev_url.split('/')[3]
+    dev_bucket_name = dev_url.split('/')[2]
+    pub_bucket_name = pub_url.split('/')[2]
+
+    # We don't copy directly to the public-datasets-idc bucket.
+    # We copy to a staging bucket and Google copies to the public bucket
+    if 'public-datasets-idc' in pub_bucket_name:
+        pub_bucket_name = 'idc-open-pdp-staging'
+    else:
+        pass
+    return dev_bucket_name, pub_bucket_name, blob_name
+
+
 def copy_some_blobs(args, client, urls, n, dones):
-    done = 0
-    copied = 0
+    # Group the blobs by source and destination bucket, so that each group can be copied in batches
+    groups = {}
     for blob in urls:
-        blob_name = blob['dev_url'].split('/')[3]
+        dev_bucket_name, pub_bucket_name, blob_name = copy_buckets(blob['dev_url'], blob['pub_url'])
         if not blob_name in dones:
-            dev_bucket_name=blob['dev_url'].split('/')[2]
-            dev_bucket = client.bucket(blob['dev_url'].split('/')[2])
-            dev_blob = dev_bucket.blob(blob_name)
-            pub_bucket_name = blob['pub_url'].split('/')[2]
-
-            # We don't copy directly to the public-datasets-idc bucket.
-            # We copy to a staging bucket and Google copies to the public bucket
-            if 'public-datasets-idc' in pub_bucket_name:
-                pub_bucket_name = 'idc-open-pdp-staging'
-            else:
-                pass
-            pub_bucket = client.bucket(pub_bucket_name)
-            pub_blob = pub_bucket.blob(blob_name)
-            for attempt in range(3):
-                try:
-                    rewrite_token = False
-                    while True:
-                        rewrite_token, bytes_rewritten, bytes_to_rewrite = pub_blob.rewrite(
-                            dev_blob, token=rewrite_token
-                        )
-                        if not rewrite_token:
-                            break
-                    successlogger.info('%s', blob_name)
-                    progresslogger.info(f'p{args.id}: {done+n}of{len(urls)+n}: {dev_bucket_name}/{blob_name} --> {pub_bucket_name}/{blob_name}')
-                    break
-                except Exception as exc:
-                    errlogger.error('p%s: Blob: %s, attempt: %s;  %s', args.id, blob_name, attempt, exc)
-
-        done += 1
+            groups.setdefault((dev_bucket_name, pub_bucket_name), []).append(blob_name)
+
+    copied = 0
+    for (dev_bucket_name, pub_bucket_name), blob_names in groups.items():
+        copied_names, failed = copy_blobs(client, dev_bucket_name, pub_bucket_name, blob_names)
+        for blob_name in copied_names:
+            successlogger.info('%s', blob_name)
+        for blob_name, exc in failed:
+            errlogger.error('p%s: Blob: %s;  %s', args.id, blob_name, exc)
+        progresslogger.info(f'p{args.id}: {n}:{n+len(urls)-1}: {len(copied_names)} blobs {dev_bucket_name} --> {pub_bucket_name}')
+        copied += len(copied_names)
     if copied == 0:
-        progresslogger.info(f'p{args.id}: Skipped {n}:{n+done-1}')
+        progresslogger.info(f'p{args.id}: Skipped {n}:{n+len(urls)-1}')
 
 
 def worker(input, args, dones):
@@ -151,15 +151,35 @@ def copy_all_blobs(args):
     rate = (n)/delta
 
 
+# Copy the new blobs with a transfer job per pair of buckets, or with the local stand-in for the
+# transfer service, according to args.executor
+def bulk_copy_all_blobs(args):
+    bq_client = bigquery.Client()
+    destination = get_urls(args)
+
+    manifests = ManifestWriter(args.manifest_dir)
+    for page in bq_client.list_rows(destination, page_size=args.batch).pages:
+        for row in page:
+            manifests.add(*copy_buckets(row.dev_url, row.pub_url))
+    bulk_copy(args, manifests.close(), successlogger, success_checkpoints(successlogger))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--version', default=settings.CURRENT_VERSION, help='Version to work on')
     # parser.add_argument('--log_dir', default=f'{settings.LOGGING_BASE}/{settings.BASE_NAME}')
     parser.add_argument('--batch', default=1000)
     parser.add_argument('--processes', default=16)
+    parser.add_argument('--executor', default='objects', help='objects to copy blob by blob, sts to copy with Storage Transfer jobs, or local to process the transfer manifests from this VM')
+    parser.add_argument('--manifest_dir', default=f'{settings.LOG_DIR}/manifests', help='Directory in which to write transfer manifests')
+    parser.add_argument('--manifest_bucket', default='', help='Bucket to which to upload transfer manifests; required by the sts executor')
+    parser.add_argument('--transfer_project', default=settings.PDP_PROJECT, help='Project in which to run transfer jobs')
     args = parser.parse_args()
     args.id = 0 # Default process ID
 
     progresslogger.info(f'args: {json.dumps(args.__dict__, indent=2)}')
 
-    copy_all_blobs(args)
\ No newline at end of file
+    if args.executor == 'objects':
+        copy_all_blobs(args)
+    else:
+        bulk_copy_all_blobs(args)
\ No newline at end of file
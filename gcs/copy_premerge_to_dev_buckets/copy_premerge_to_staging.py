@@ -27,6 +27,9 @@ from utilities.logging_config import successlogger, progresslogger, errlogger
 import settings
 from google.cloud import storage, bigquery
 from gcs.copy_bucket_mp.copy_bucket_mp import copy_all_instances
+from utilities.checkpoint_store import success_checkpoints
+from utilities.bucket_lister import list_blob_pages
+from utilities.bulk_copy import ManifestWriter, bulk_copy
 
 def get_collection_groups():
     client = bigquery.Client()
@@ -64,12 +67,9 @@ def copy_dev_buckets(args):
     client = storage.Client()
     bucket_data= get_collection_groups()
     preview_copies(args, client, bucket_data)
-    try:
-        # Create a set of previously copied blobs
-        # dones = set(open(f'{args.log_dir}/{args.src_bucket}_success.log').read().splitlines())
-        dones = set(open(successlogger.handlers[0].baseFilename).read().splitlines())
-    except:
-        dones = set([])
+    # Previously copied blobs and buckets
+    # dones = set(open(f'{args.log_dir}/{args.src_bucket}_success.log').read().splitlines())
+    dones = success_checkpoints(successlogger)
 
     for collection_id in bucket_data:
         if client.bucket(f'idc_v{args.version}_tcia_{collection_id}').exists():
@@ -85,12 +85,41 @@ def copy_dev_buckets(args):
     return
 
 
+# Copy each prestaging bucket with a transfer job, or with the local stand-in for the transfer
+# service, according to args.executor. The manifest of a bucket lists all its blobs.
+def bulk_copy_dev_buckets(args):
+    client = storage.Client()
+    bucket_data= get_collection_groups()
+    preview_copies(args, client, bucket_data)
+    dones = success_checkpoints(successlogger)
+
+    manifests = ManifestWriter(args.manifest_dir)
+    for collection_id in bucket_data:
+        for source, url in (('tcia', 'dev_tcia_url'), ('idc', 'dev_idc_url')):
+            prestaging_bucket = f'idc_v{args.version}_{source}_{collection_id}'
+            if not client.bucket(prestaging_bucket).exists() or \
+                    f'{prestaging_bucket}->{bucket_data[collection_id][url]}' in dones:
+                continue
+            for page in list_blob_pages(client, prestaging_bucket, page_size=args.batch, fields='items(name),nextPageToken'):
+                for blob in page:
+                    manifests.add(prestaging_bucket, bucket_data[collection_id][url], blob.name)
+    bulk_copy(args, manifests.close(), successlogger, dones)
+    return
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--version', default=settings.CURRENT_VERSION, help='Version to work on')
     parser.add_argument('--processes', default=32, help="Number of concurrent processes")
     parser.add_argument('--batch', default=100, help='Size of batch assigned to each process')
+    parser.add_argument('--executor', default='objects', help='objects to copy blob by blob, sts to copy with Storage Transfer jobs, or local to process the transfer manifests from this VM')
+    parser.add_argument('--manifest_dir', default=f'{settings.LOG_DIR}/manifests', help='Directory in which to write transfer manifests')
+    parser.add_argument('--manifest_bucket', default='', help='Bucket to which to upload transfer manifests; required by the sts executor')
+    parser.add_argument('--transfer_project', default=settings.DEV_PROJECT, help='Project in which to run transfer jobs')
     args = parser.parse_args()
     args.id = 0 # Default process ID
 
-    copy_dev_buckets(args)
\ No newline at end of file
+    if args.executor == 'objects':
+        copy_dev_buckets(args)
+    else:
+        bulk_copy_dev_buckets(args)
\ No newline at end of file
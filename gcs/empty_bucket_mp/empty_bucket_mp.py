@@ -16,7 +16,8 @@
 
 """
 Multiprocess bucket emptier. Does not delete the bucket.
-May saturate a small VM, depending on the number of processes.
+The number of concurrent batch deletes is adapted to the observed throughput, throttling
+and CPU load, up to --processes.
 """
 
 import argparse
@@ -28,11 +29,13 @@ import logging
 # errlogger = logging.getLogger('root.err')
 
 from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.concurrency import ConcurrencyController
+from utilities.gcs_batch import delete_blobs
+from utilities.bucket_lister import list_blob_pages
 
 import time
 from multiprocessing import Process, Queue
 from google.cloud import storage
-from google.api_core.exceptions import ServiceUnavailable, NotFound
 
 from python_settings import settings
 import settings as etl_settings
@@ -42,28 +45,21 @@ if not settings.configured:
 assert settings.configured
 
 
-def delete_instances(args, client, bucket, blobs, n):
-    try:
-        with client.batch():
-            for blob in blobs:
-                bucket.blob(blob[0], generation=blob[1]).delete()
-                # bucket.blob(blob[0], generation=blob[1]).delete()
-
+def delete_instances(args, client, bucket, blobs, n, controller):
+    # Blobs are deleted in batch requests. Those that failed are retried, and then reported individually.
+    deleted, failed = delete_blobs(client, args.bucket, blobs, controller)
+    for (blob_name, generation), exc in failed:
+        errlogger.error('p%s Delete %s blob %s#%s failed: %s', args.id, args.bucket, blob_name, generation, exc)
+    if not failed:
         successlogger.info('p%s Delete %s blobs %s:%s ', args.id, args.bucket, n, n+len(blobs)-1)
-    except ServiceUnavailable:
-        errlogger.error('p%s Delete %s blobs %s:%s failed', args.id, args.bucket, n, n+len(blobs)-1)
-    except NotFound:
-        errlogger.error('p%s Delete %s blobs %s:%s failed, not found', args.id, args.bucket, n, n+len(blobs)-1)
-    except Exception as exc:
-        errlogger.error('p%s Exception %s %s:%s', args.id, exc, n, n+len(blobs)-1)
 
 
 
-def worker(input, args):
+def worker(input, args, controller):
     client = storage.Client()
     bucket = storage.Bucket(client, args.bucket)
     for blobs, n in iter(input.get, 'STOP'):
-        delete_instances(args, client, bucket, blobs, n)
+        delete_instances(args, client, bucket, blobs, n, controller)
 
 
 def del_all_instances(args):
@@ -73,7 +69,8 @@ def del_all_instances(args):
 
     progresslogger.info(f'Deleting bucket {args.bucket}')
 
-    num_processes = args.processes
+    num_processes = int(args.processes)
+    controller = ConcurrencyController(num_processes)
     processes = []
 
     task_queue = Queue()
@@ -84,24 +81,21 @@ def del_all_instances(args):
     for process in range(num_processes):
         args.id = process + 1
         processes.append(
-            Process(group=None, target=worker, args=(task_queue, args)))
+            Process(group=None, target=worker, args=(task_queue, args, controller)))
         processes[-1].start()
+    controller.start()
 
 
-    # Distribute the work across the task_queues
+    # Distribute the work across the task_queues. The bucket is listed in concurrent shards, and
+    # each page is queued as it arrives.
     n = 0
-    page_token = ""
-    # iterator = client.list_blobs(bucket, page_token=page_token, max_results=args.batch)
-    iterator = client.list_blobs(bucket, versions=True, page_token=page_token, page_size=args.batch)
-    for page in iterator.pages:
+    for page in list_blob_pages(client, args.bucket, page_size=args.batch, versions=True,
+                                fields='items(name,generation),nextPageToken'):
         blobs = [[blob.name, blob.generation] for blob in page]
-        if len(blobs) == 0:
-            break
         task_queue.put((blobs, n))
         # print(f'Queued {n}:{n+len(blobs)-1}')
-        # task_queue.put((page, n))
 
-        n += page.num_items
+        n += len(blobs)
     progresslogger.info('Primary work distribution complete; {} blobs'.format(n))
 
     # Tell child processes to stop
@@ -113,6 +107,7 @@ def del_all_instances(args):
     for process in processes:
         # print(f'Joining process: {process.name}, {process.is_alive()}')
         process.join()
+    controller.stop()
 
     delta = time.time() - strt
     rate = (n)/delta
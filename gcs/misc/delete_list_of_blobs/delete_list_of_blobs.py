@@ -19,23 +19,13 @@ from utilities.logging_config import successlogger, progresslogger, errlogger
 import time
 from multiprocessing import Process, Queue
 from google.cloud import storage
-from google.api_core.exceptions import ServiceUnavailable, NotFound
+from utilities.gcs_batch import delete_blobs
 
 def delete_instances(args, client, bucket, blobs, n):
-    try:
-        # with client.batch():
-        #     for blob in blobs:
-        #         bucket.blob(blob).delete()
-        #         # bucket.blob(blob[0], generation=blob[1]).delete()
-        for blob in blobs:
-            bucket.blob(blob).delete()
-            # bucket.blob(blob[0], generation=blob[1]).delete()
-            successlogger.info(f'{blob}')
-    except ServiceUnavailable:
-        errlogger.error('p%s Delete %s blob %s failed', args.id, args.bucket, blob)
-    except NotFound:
-        errlogger.error('p%s Delete %s blobs % failed, not found', args.id, args.bucket, blob)
-    except Exception as exc:
+    deleted, failed = delete_blobs(client, args.bucket, blobs)
+    for blob in deleted:
+        successlogger.info(f'{blob}')
+    for blob, exc in failed:
         errlogger.error('p%s Exception on %s blob %s: %s', args.id, args.bucket, blob, exc)
 
 
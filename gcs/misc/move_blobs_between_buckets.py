@@ -22,6 +22,7 @@ from google.cloud import bigquery, storage
 import time
 from multiprocessing import Process, Queue
 from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.gcs_batch import copy_blobs, delete_blobs
 
 # Copy the blobs that are new to a version from dev pre-staging buckets
 # to dev staging buckets.
@@ -50,34 +51,18 @@ def get_urls(args):
     return destination
 
 def move_some_blobs(args, client, urls, n, dones):
-    done = 0
-    copied = 0
-    for blob_name in urls:
-        if not blob_name in dones:
-            src_bucket = client.bucket(args.src_bucket)
-            src_blob = src_bucket.blob(blob_name)
-            trg_bucket = client.bucket(args.trg_bucket)
-            trg_blob = trg_bucket.blob(blob_name)
-            for attempt in range(3):
-                try:
-                    rewrite_token = False
-                    while True:
-                        rewrite_token, bytes_rewritten, bytes_to_rewrite = trg_blob.rewrite(
-                            src_blob, token=rewrite_token
-                        )
-                        if not rewrite_token:
-                            break
-                    src_blob.delete()
-
-                    successlogger.info('%s', blob_name)
-                    progresslogger.info(f'p{args.id}: {done+n}of{len(urls)+n}: {args.src_bucket}/{blob_name} --> {args.trg_bucket}/{blob_name}')
-                    break
-                except Exception as exc:
-                    errlogger.error('p%s: Blob: %s, attempt: %s;  %s', args.id, blob_name, attempt, exc)
-
-        done += 1
-    if copied == 0:
-        progresslogger.info(f'p{args.id}: Skipped {n}:{n+done-1}')
+    blob_names = [blob_name for blob_name in urls if not blob_name in dones]
+    # Only the blobs that were copied are deleted from the source bucket
+    copied, failed = copy_blobs(client, args.src_bucket, args.trg_bucket, blob_names)
+    moved, delete_failed = delete_blobs(client, args.src_bucket, copied)
+    for blob_name in moved:
+        successlogger.info('%s', blob_name)
+    for blob_name, exc in failed + delete_failed:
+        errlogger.error('p%s: Blob: %s;  %s', args.id, blob_name, exc)
+    if moved:
+        progresslogger.info(f'p{args.id}: {n}:{n+len(urls)-1}: {len(moved)} blobs {args.src_bucket} --> {args.trg_bucket}')
+    else:
+        progresslogger.info(f'p{args.id}: Skipped {n}:{n+len(urls)-1}')
 
 
 def worker(input, args, dones):
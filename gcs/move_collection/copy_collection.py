@@ -20,6 +20,7 @@ import argparse
 import json
 from utilities.logging_config import successlogger, progresslogger, errlogger
 from utilities.bq_helpers import query_BQ
+from utilities.gcs_batch import copy_blobs
 
 import time
 from multiprocessing import Process, Queue
@@ -27,8 +28,6 @@ from google.cloud import storage, bigquery
 
 import settings
 
-TRIES = 3
-
 def get_blob_names(args):
     client = bigquery.Client()
     query = f"""
@@ -45,28 +44,11 @@ def get_blob_names(args):
 
 
 def copy_instances(args, client, src_bucket, dst_bucket, blob_names, n):
-    for blob_name in blob_names:
-        src_blob = src_bucket.blob(blob_name)
-        dst_blob = dst_bucket.blob(blob_name)
-        retries = 0
-        while True:
-            try:
-                rewrite_token = False
-                while True:
-                    rewrite_token, bytes_rewritten, bytes_to_rewrite = dst_blob.rewrite(
-                        src_blob, token=rewrite_token
-                    )
-                    if not rewrite_token:
-                        break
-                successlogger.info(f'{blob_name}')
-                break
-            except Exception as exc:
-                if retries == TRIES:
-                    errlogger.error('p%s %s: %s copy failed \n, retry %s; %s', args.id,
-                                    n, blob_name, retries, exc)
-                    break
-            time.sleep(retries)
-            retries += 1
+    copied, failed = copy_blobs(client, args.src_bucket, args.dst_bucket, blob_names)
+    for blob_name in copied:
+        successlogger.info(f'{blob_name}')
+    for blob_name, exc in failed:
+        errlogger.error('p%s %s: %s copy failed \n; %s', args.id, n, blob_name, exc)
 
     progresslogger.info('p%s Copied blobs %s:%s ', args.id, n, n+len(blob_names)-1)
 
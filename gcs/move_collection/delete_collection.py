@@ -21,12 +21,10 @@ from utilities.logging_config import successlogger, progresslogger, errlogger
 import time
 from multiprocessing import Process, Queue
 from google.cloud import storage, bigquery
-from google.cloud.exceptions import NotFound
+from utilities.gcs_batch import delete_blobs
 
 import settings
 
-TRIES = 3
-
 def get_blob_names(args):
     client = bigquery.Client()
     query = f"""
@@ -43,22 +41,14 @@ def get_blob_names(args):
 
 
 def delete_instances(args, client, src_bucket, blob_names, n):
-    for blob_name in blob_names:
-        while True:
-            try:
-                src_bucket.delete_blob(blob_name)
-                successlogger.info(f'{blob_name}')
-                break
-            except NotFound as exc:
-                errlogger.error('p%s %s: %s: Failed, not found \n', args.id,
-                                args.collection,
-                                blob_name)
-                break
-            except Exception as exc:
-                errlogger.error('p%s %s: %s: Failed %s\n: %s', args.id,
-                                args.collection,
-                                blob_name, exc)
-                break
+    # Blobs that are not found are counted as deleted
+    deleted, failed = delete_blobs(client, args.src_bucket, blob_names)
+    for blob_name in deleted:
+        successlogger.info(f'{blob_name}')
+    for blob_name, exc in failed:
+        errlogger.error('p%s %s: %s: Failed %s\n', args.id,
+                        args.collection,
+                        blob_name, exc)
 
     progresslogger.info('p%s Deleted blobs %s:%s ', args.id, n, n+len(blob_names)-1)
 
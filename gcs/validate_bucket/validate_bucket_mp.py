@@ -15,16 +15,27 @@
 #
 
 """
-Validate that a bucket holds the correct set of instance blobs
+Validate that a bucket holds the correct set of instance blobs.
+
+Both sides are written to files in blob name order: the expected blobs by a BQ query that is
+ORDERed BY blob_name, the found blobs by listing the bucket in lexicographic order. The files are
+then compared by a single merge pass, so memory use is constant in the number of blobs. If
+check_hashes, the md5 hash and size of each expected blob are compared with those of the found
+blob in the same pass.
+Existing files are reused, so that either side of a comparison that failed need not be refetched.
+Each line of the files is <blob_name>[,<hex md5 hash>,<size>].
 """
 import settings
+from base64 import b64decode
 from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.bucket_lister import list_blob_pages
 from google.cloud import storage, bigquery
 
 def get_expected_blobs_in_bucket(args, premerge=False):
     client = bigquery.Client()
+    # BQ orders strings by their UTF-8 bytes, which is also the order in which GCS lists blobs
     query = f"""
-      SELECT distinct concat(i.uuid, '.dcm') as blob_name
+      SELECT concat(i.uuid, '.dcm') as blob_name, any_value(i.hash) as hash, any_value(i.size) as size
       FROM `idc-dev-etl.idc_v{args.version}_dev.version` v
           JOIN `idc-dev-etl.idc_v{args.version}_dev.version_collection` vc ON v.version = vc.version
           JOIN `idc-dev-etl.idc_v{args.version}_dev.collection` c ON vc.collection_uuid = c.uuid
@@ -42,6 +53,8 @@ def get_expected_blobs_in_bucket(args, premerge=False):
           OR (i.source='idc' and aic.{args.dev_or_pub}_idc_url="{args.bucket}"))
           AND i.excluded = False
           AND if({premerge}, i.rev_idc_version < {args.version}, i.rev_idc_version <= {args.version})
+      GROUP BY blob_name
+      ORDER BY blob_name
       """
 
 
@@ -59,51 +72,96 @@ def get_expected_blobs_in_bucket(args, premerge=False):
     #
     # A schema is useful for converting from BigQuery types to Python types.
     destination = client.get_table(destination)
+    # The rows of the destination table of an ORDERed query are listed in that order
     with open(args.expected_blobs, 'w') as f:
         for page in client.list_rows(destination, page_size=args.batch).pages:
-            rows = [f'{row["blob_name"]}\n' for row in page]
+            rows = [f'{row["blob_name"]},{row["hash"] or ""},{"" if row["size"] is None else row["size"]}\n' for row in page]
             f.write(''.join(rows))
 
 def get_found_blobs_in_bucket(args):
     client = storage.Client()
-    bucket = client.bucket(args.bucket)
-    page_token = ""
-    # iterator = client.list_blobs(bucket, page_token=page_token, max_results=args.batch)
-    iterator = client.list_blobs(bucket, versions=False, page_token=page_token, page_size=args.batch)
+    # The bucket is listed in concurrent shards, which are written in blob name order. Only the
+    # fields that are compared are requested.
     with open(args.found_blobs, 'w') as f:
-        for page in iterator.pages:
-            blobs = [f'{blob.name}\n' for blob in page]
+        for page in list_blob_pages(client, args.bucket, page_size=args.batch, ordered=True, versions=False,
+                                    fields='items(name,md5Hash,size),nextPageToken'):
+            # GCS md5 hashes are base64; composite objects have none
+            blobs = [f'{blob.name},{b64decode(blob.md5_hash).hex() if blob.md5_hash else ""},{"" if blob.size is None else blob.size}\n' \
+                     for blob in page]
             f.write(''.join(blobs))
 
-def check_all_instances(args, premerge=False):
+
+# Yield (blob_name, hash, size) from a file written by one of the above, checking that it is in
+# blob name order. hash and size are '' if not known, e.g. in a file that only has blob names.
+def read_sorted_blobs(path):
+    previous = None
+    with open(path) as f:
+        for line in f:
+            blob_name, _, rest = line.rstrip('\n').partition(',')
+            hash, _, size = rest.partition(',')
+            if previous is not None and blob_name <= previous:
+                raise ValueError(f'{path} is not sorted by blob name at {blob_name}; delete it to refetch')
+            previous = blob_name
+            yield blob_name, hash, size
+
+
+# Merge two streams of (blob_name, hash, size) that are in blob name order, yielding
+# (blob_name, expected, found), where expected or found is None if the blob is only in the other stream
+def merge_blobs(expected_blobs, found_blobs):
+    expected = next(expected_blobs, None)
+    found = next(found_blobs, None)
+    while expected or found:
+        if found is None or (expected and expected[0] < found[0]):
+            yield expected[0], expected, None
+            expected = next(expected_blobs, None)
+        elif expected is None or found[0] < expected[0]:
+            yield found[0], None, found
+            found = next(found_blobs, None)
+        else:
+            yield expected[0], expected, found
+            expected = next(expected_blobs, None)
+            found = next(found_blobs, None)
+
+
+def check_all_instances(args, premerge=False, check_hashes=False):
     try:
-        expected_blobs = set(open(args.expected_blobs).read().splitlines())
+        open(args.expected_blobs).close()
         progresslogger.info(f'Already have expected blobs')
     except:
         progresslogger.info(f'Getting expected blobs')
         get_expected_blobs_in_bucket(args, premerge)
-        expected_blobs = set(open(args.expected_blobs).read().splitlines())
-        # json.dump(psql_blobs, open(args.blob_names), 'w')
 
     try:
-        found_blobs = set(open(args.found_blobs).read().splitlines())
+        open(args.found_blobs).close()
         progresslogger.info(f'Already have found blobs')
     except:
         progresslogger.info(f'Getting found blobs')
         get_found_blobs_in_bucket(args)
-        found_blobs = set(open(args.found_blobs).read().splitlines())
-        # json.dump(psql_blobs, open(args.blob_names), 'w')
-    if found_blobs == expected_blobs:
+
+    unexpected = 0
+    missing = 0
+    mismatched = 0
+    for blob_name, expected, found in merge_blobs(read_sorted_blobs(args.expected_blobs), read_sorted_blobs(args.found_blobs)):
+        if expected is None:
+            unexpected += 1
+            errlogger.error(f"Unexpected blob in bucket: {blob_name}")
+        elif found is None:
+            missing += 1
+            errlogger.error(f"Expected blob not found in bucket: {blob_name}")
+        elif check_hashes:
+            # Only compare what is known on both sides
+            if (expected[1] and found[1] and expected[1] != found[1]) or \
+                    (expected[2] and found[2] and expected[2] != found[2]):
+                mismatched += 1
+                errlogger.error(f"Blob {blob_name} has hash/size {found[1]}/{found[2]}, expected {expected[1]}/{expected[2]}")
+
+    if not (unexpected or missing or mismatched):
         successlogger.info(f"Bucket {args.bucket} has the correct set of blobs")
     else:
         errlogger.error(f"Bucket {args.bucket} does not have the correct set of blobs")
-        errlogger.error(f"Unexpected blobs in bucket: {len(found_blobs - expected_blobs)}")
-        for blob in found_blobs - expected_blobs:
-            errlogger.error(blob)
-        errlogger.error(f"Expected blobs not found in bucket: {len(expected_blobs - found_blobs)}")
-        for blob in expected_blobs - found_blobs:
-            errlogger.error(blob)
+        errlogger.error(f"Unexpected blobs in bucket: {unexpected}")
+        errlogger.error(f"Expected blobs not found in bucket: {missing}")
+        if check_hashes:
+            errlogger.error(f"Blobs having an unexpected hash or size: {mismatched}")
 
     return
-
-
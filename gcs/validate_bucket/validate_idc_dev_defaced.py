@@ -33,6 +33,7 @@ if __name__ == '__main__':
     parser.add_argument('--bucket', default='idc-dev-defaced')
     parser.add_argument('--dev_or_pub', default = 'dev', help='Validating a dev or pub bucket')
     parser.add_argument('--premerge', default=False, help='True when performing prior to merging premerge  buckets')
+    parser.add_argument('--check_hashes', type=bool, default=False, help='Also compare the MD5 hash and size of each blob with those expected')
     parser.add_argument('--expected_blobs', default=f'{settings.LOG_DIR}/expected_blobs.txt', help='List of blobs names expected to be in above collections')
     parser.add_argument('--found_blobs', default=f'{settings.LOG_DIR}/found_blobs.txt', help='List of blobs names found in bucket')
     parser.add_argument('--batch', default=10000, help='Size of batch assigned to each process')
@@ -41,4 +42,4 @@ if __name__ == '__main__':
     args = parser.parse_args()
     print(f'args: {json.dumps(args.__dict__, indent=2)}')
 
-    check_all_instances(args)
\ No newline at end of file
+    check_all_instances(args, check_hashes=args.check_hashes)
\ No newline at end of file
@@ -18,7 +18,7 @@ import sqlalchemy as sa
 from sqlalchemy import Integer, String, Boolean, BigInteger,\
     Column, DateTime, ForeignKey, create_engine, MetaData, Table, ForeignKeyConstraint, Enum, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, selectinload, raiseload
 from sqlalchemy_utils import CompositeType
 
 import enum
@@ -537,6 +537,42 @@ class Instance(Base):
                           secondary=series_instance,
                           back_populates='instances')
 
+# Named loading profiles for the version hierarchy. Relationships are lazy by default, so walking
+# a subtree issues a SELECT per object. A profile makes a query load the named relationships up
+# front with one SELECT per level:
+#   patient_tree:   a patient's collections, and its studies, series and instances
+#   patient_series: a patient's collections, and its studies and series, but not instances
+#   strict:         nothing beyond the object itself; lazy loading raises. For finding N+1 queries.
+LOADING_PROFILES = {
+    'patient_tree': lambda: [
+        selectinload(Patient.collections),
+        selectinload(Patient.studies).selectinload(Study.seriess).selectinload(Series.instances)],
+    'patient_series': lambda: [
+        selectinload(Patient.collections),
+        selectinload(Patient.studies).selectinload(Study.seriess)],
+    'strict': lambda: [raiseload('*')],
+}
+
+
+def loading_profile(profile):
+    return LOADING_PROFILES[profile]() if profile else []
+
+
+# Get a collection of a version by its collection_id, without loading the version's other collections
+def get_collection(sess, version, collection_id):
+    return sess.query(Collection).join(Collection.versions). \
+        filter(Version.version == version, Collection.collection_id == collection_id).one()
+
+
+# Get a patient of a collection of a version by its submitter_case_id, without loading the
+# collection's other patients, and with the relationships of the loading profile.
+def get_patient(sess, version, collection_id, submitter_case_id, profile='patient_series'):
+    return sess.query(Patient).join(Patient.collections).join(Collection.versions). \
+        filter(Version.version == version, Collection.collection_id == collection_id,
+               Patient.submitter_case_id == submitter_case_id). \
+        options(*loading_profile(profile)).one()
+
+
 # collection_id_map maps an idc_collection_id to one or more tcia_api_collection_ids.
 # This mapping is meant to deal with the possibility that TCIA might rename a collection.
 # In that case, the IDC generated idc_collection_id binds those tcia_api_collection_ids.
@@ -26,19 +26,23 @@ import logging
 rootlogger = logging.getLogger('root')
 errlogger = logging.getLogger('root.err')
 
+# Default number of concurrent hash requests per source when prefetching hashes
+PREFETCH_THREADS = 16
+
 
 class All:
 
-    def __init__(self, pid, sess, version, access, skipped_tcia_collections, skipped_idc_collections, lock):
+    def __init__(self, pid, sess, version, access, skipped_tcia_collections, skipped_idc_collections, lock, cache=None):
         self.sess = sess
         self.idc_version = version
-        self.client = bigquery.Client()
         self.sources = {}
         try:
-            self.sources[instance_source.tcia] = TCIA(pid, sess, access, skipped_tcia_collections, lock)
+            self.sources[instance_source.tcia] = TCIA(pid, sess, access, skipped_tcia_collections, lock, cache)
             self.sources[instance_source.idc] = IDC(sess, skipped_idc_collections)
         except Exception as exc:
             print(exc)
+        # Source patient hashes, indexed by (source, collection_id, submitter_case_id), obtained by prefetch_patient_hashes
+        self.patient_hashes = {}
 
     ###-------------------Versions-----------------###
 
@@ -162,15 +166,17 @@ class All:
         return collection_hashes
 
     # Compute collection hashes from its child hashes according to sources
-    def src_collection_hashes_from_patient_hashes(self, collection_id, submitter_case_ids, skipped_sources, sources):
+    def src_collection_hashes_from_patient_hashes(self, collection_id, submitter_case_ids, skipped_sources, sources, max_workers=PREFETCH_THREADS):
         collection_hashes = ['','']
+        self.prefetch_patient_hashes(collection_id, submitter_case_ids,
+            [skipped or not source for skipped, source in zip(skipped_sources, sources)], max_workers)
         for source in self.sources:
             if skipped_sources[source.value] or not sources[source.value]:
                 collection_hashes[source.value] = ""
             else:
                 hashes = []
                 for submitter_case_id in submitter_case_ids:
-                    hashes.append(self.sources[source].src_patient_hash(collection_id, submitter_case_id))
+                    hashes.append(self.src_patient_hash(source, collection_id, submitter_case_id))
                 collection_hashes[source.value] = get_merkle_hash(hashes)
         return collection_hashes
 
@@ -228,6 +234,29 @@ class All:
         # # patient_hashes[-1] = get_merkle_hash([hash for hash in patient_hashes[:-1]if hash])
         # return patient_hashes
 
+    # Get the source hashes of many patients of a collection ahead of their use by src_patient_hashes.
+    # The hashes of a source are obtained concurrently, max_workers at a time, and memoized until
+    # clear_patient_hashes() is called.
+    def prefetch_patient_hashes(self, collection_id, submitter_case_ids, skipped_sources, max_workers=PREFETCH_THREADS):
+        for source in self.sources:
+            if skipped_sources[source.value]:
+                continue
+            needed = [submitter_case_id for submitter_case_id in submitter_case_ids \
+                      if (source, collection_id, submitter_case_id) not in self.patient_hashes]
+            if needed:
+                hashes = self.sources[source].src_patient_hashes_batch(collection_id, needed, max_workers)
+                for submitter_case_id, hash in hashes.items():
+                    self.patient_hashes[(source, collection_id, submitter_case_id)] = hash
+
+    def clear_patient_hashes(self):
+        self.patient_hashes = {}
+
+    # Get a patient's hash from a source, using a prefetched hash if there is one
+    def src_patient_hash(self, source, collection_id, submitter_case_id):
+        if (source, collection_id, submitter_case_id) in self.patient_hashes:
+            return self.patient_hashes[(source, collection_id, submitter_case_id)]
+        return self.sources[source].src_patient_hash(collection_id, submitter_case_id)
+
     # Compute object's hashes according to sources
     def src_patient_hashes(self, collection_id, submitter_case_id, skipped_sources):
         patient_hashes = ['','']
@@ -235,8 +264,7 @@ class All:
             if skipped_sources[source.value]:
                 patient_hashes[source.value] = ""
             else:
-                patient_hashes[source.value] = self.sources[source].src_patient_hash(collection_id,
-                                                                             submitter_case_id)
+                patient_hashes[source.value] = self.src_patient_hash(source, collection_id, submitter_case_id)
         return patient_hashes
 
 
@@ -414,8 +442,8 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     with sa_session() as sess:
-        # Get a sharable NBIA access token
-        access = shared_memory.ShareableList(get_access_token())
+        # Get a sharable NBIA access token. The third element is the token's generation; see NBIATokenManager
+        access = shared_memory.ShareableList([*get_access_token(), 0])
         args.pid = 0
 
         args.skipped_tcia_collections = []
@@ -18,11 +18,14 @@ import time
 from datetime import datetime, timedelta
 import logging
 from uuid import uuid4
-from idc.models import instance_source, Version, Collection, Patient
-from ingestion.utilities.utils import accum_sources, empty_bucket, create_prestaging_bucket, is_skipped
+from idc.models import instance_source, Version, Collection, Patient, collection_patient, get_collection, get_patient
+from ingestion.utilities.utils import accum_sources, empty_bucket, create_prestaging_bucket, is_skipped, bulk_insert_children
 from ingestion.patient import clone_patient, build_patient, retire_patient
 from ingestion.all_sources import All
+from ingestion.series_scheduler import build_collection_series_scheduled
 from utilities.sqlalchemy_helpers import sa_session
+from utilities.tcia_helpers import get_nbia_metrics
+from utilities.metrics import metrics
 from python_settings import settings
 
 from multiprocessing import Process, Queue, Lock, shared_memory
@@ -56,7 +59,7 @@ PATIENT_TRIES=5
 def worker(input, output, args, access, lock):
     with sa_session() as sess:
         all_sources = All(args.pid, sess, settings.CURRENT_VERSION, access,
-                          args.skipped_tcia_collections, args.skipped_idc_collections, lock)
+                          args.skipped_tcia_collections, args.skipped_idc_collections, lock, args.nbia_cache)
 
         for more_args in iter(input.get, 'STOP'):
             for attempt in range(PATIENT_TRIES):
@@ -64,8 +67,8 @@ def worker(input, output, args, access, lock):
                 index, collection_id, submitter_case_id = more_args
                 try:
                     version = sess.query(Version).filter(Version.version==settings.CURRENT_VERSION).one()
-                    collection = next(collection for collection in version.collections if collection.collection_id ==collection_id)
-                    patient = next(patient for patient in collection.patients if patient.submitter_case_id==submitter_case_id)
+                    collection = get_collection(sess, settings.CURRENT_VERSION, collection_id)
+                    patient = get_patient(sess, settings.CURRENT_VERSION, collection_id, submitter_case_id, args.loading_profile)
                     build_patient(sess, args, all_sources, index, version, collection, patient)
                     break
                 except Exception as exc:
@@ -76,6 +79,11 @@ def worker(input, output, args, access, lock):
                 errlogger.error("p%s, Failed to process patient: %s", args.pid, patient.submitter_case_id)
                 sess.rollback()
             output.put(patient.submitter_case_id)
+            metrics.flush()
+
+        for url, url_metrics in get_nbia_metrics().items():
+            progresslogger.debug("p%s: NBIA %s: requests: %s, retries: %s, failures: %s, seconds: %s", args.pid, url,
+                url_metrics['requests'], url_metrics['retries'], url_metrics['failures'], url_metrics['seconds'])
 
 
 def expand_collection(sess, args, all_sources, collection):
@@ -126,30 +134,32 @@ def expand_collection(sess, args, all_sources, collection):
         retired_objects = [obj for id, obj in idc_objects.items() \
                       if not obj in existing_objects]
 
+    # New patients are inserted in bulk after the existing patients have been processed
+    timestamp = datetime.utcnow()
+    new_patients = []
     for patient in sorted(new_objects):
-        new_patient = Patient()
-
-        new_patient.submitter_case_id = patient
-        new_patient.idc_case_id = str(uuid4())
-        new_patient.min_timestamp = datetime.utcnow()
-        new_patient.revised = patients[patient]
-        # The following line can probably be deleted because
-        # a object's sources are computed hierarchically after
-        # building all the children.
-        new_patient.sources = patients[patient]
-        new_patient.hashes = None
-        new_patient.uuid = str(uuid4())
-        new_patient.max_timestamp = new_patient.min_timestamp
-        new_patient.init_idc_version=settings.CURRENT_VERSION
-        new_patient.rev_idc_version=settings.CURRENT_VERSION
-        new_patient.final_idc_version=0
-        new_patient.done=False
-        new_patient.is_new=True
-        new_patient.expanded=False
-
-        collection.patients.append(new_patient)
-        progresslogger.info('  p%s: Patient %s is new',  args.pid, new_patient.submitter_case_id)
-
+        # Note that a patient's sources are computed hierarchically after building all the children.
+        new_patients.append(dict(
+            submitter_case_id=patient,
+            idc_case_id=str(uuid4()),
+            min_timestamp=timestamp,
+            revised=patients[patient],
+            sources=patients[patient],
+            hashes=None,
+            uuid=str(uuid4()),
+            max_timestamp=timestamp,
+            init_idc_version=settings.CURRENT_VERSION,
+            rev_idc_version=settings.CURRENT_VERSION,
+            final_idc_version=0,
+            done=False,
+            is_new=True,
+            expanded=False
+        ))
+        progresslogger.info('  p%s: Patient %s is new',  args.pid, patient)
+
+    # Get the source hashes of all the existing patients concurrently rather than one at a time
+    all_sources.prefetch_patient_hashes(collection.collection_id,
+        [patient.submitter_case_id for patient in existing_objects], skipped, args.hash_prefetch_threads)
     for patient in existing_objects:
         idc_hashes = patient.hashes
         # Get the hash from each source that is not skipped
@@ -200,8 +210,10 @@ def expand_collection(sess, args, all_sources, collection):
         retire_patient(args, patient)
         collection.patients.remove(patient)
 
+    bulk_insert_children(sess, collection, 'patients', Patient, collection_patient, 'collection_uuid', 'patient_uuid', new_patients)
     collection.expanded = True
     sess.commit()
+    all_sources.clear_patient_hashes()
     return
 
 
@@ -245,6 +257,10 @@ def build_collection(sess, args, all_sources, collection_index, version, collect
                     successlogger.info("  p0: Patient %s, %s, previously built", patient.submitter_case_id,
                                 patient_index)
 
+    elif args.series_scheduler:
+        # Distribute series rather than patients over the worker processes
+        build_collection_series_scheduled(sess, args, collection, Lock())
+
     else:
         processes = []
         # Create queues
@@ -322,7 +338,8 @@ def build_collection(sess, args, all_sources, collection_index, version, collect
                 errlogger.error('Collection hash match failed for collection %s', collection.collection_id)
 
                 # NBIA collection hash is sometimes incorrect. Compute the NBIA hash from patient hashes
-                src_hashes = all_sources.src_collection_hashes_from_patient_hashes(collection.collection_id, [patient.submitter_case_id for patient in collection.patients], skipped, collection.sources)
+                src_hashes = all_sources.src_collection_hashes_from_patient_hashes(collection.collection_id, [patient.submitter_case_id for patient in collection.patients], skipped, collection.sources, args.hash_prefetch_threads)
+                all_sources.clear_patient_hashes()
                 rehash_deltas = [(x != y) and not z for x, y, z in \
                                  zip(idc_hashes[:-1], src_hashes, skipped)]
                 if any(rehash_deltas):
@@ -27,6 +27,8 @@ from multiprocessing import Lock, shared_memory
 from idc.models import Base, Version, Collection
 from utilities.tcia_helpers import get_access_token
 from utilities.sqlalchemy_helpers import sa_session
+from utilities.nbia_cache import NBIACache
+from utilities.metrics import metrics, export
 from utilities.logging_config import successlogger, errlogger, progresslogger, rootlogger
 
 from ingestion.utilities.utils import list_skips
@@ -54,8 +56,8 @@ def ingest(args):
     os.mkdir('{}'.format(args.dicom_dir))
 
     with sa_session() as sess:
-        # Get a sharable NBIA access token
-        access = shared_memory.ShareableList(get_access_token())
+        # Get a sharable NBIA access token. The third element is the token's generation; see NBIATokenManager
+        access = shared_memory.ShareableList([*get_access_token(), 0])
         args.access = access
 
         args.skipped_tcia_collections = list_skips(sess, Base, args.skipped_tcia_groups, args.skipped_tcia_collections, args.included_tcia_collections)
@@ -72,8 +74,20 @@ def ingest(args):
             else:
                 skipped_collections[collection_id] = [False, True]
         args.skipped_collections = skipped_collections
+
+        # Each worker process writes its metrics to args.metrics_dir
+        if args.metrics_dir:
+            metrics.configure(args.metrics_dir)
+
+        # A cache of NBIA responses shared by all worker processes. It survives restarts of the build.
+        if args.nbia_cache_path:
+            args.nbia_cache = NBIACache(args.nbia_cache_path, args.nbia_cache_ttl, settings.CURRENT_VERSION)
+            args.nbia_cache.invalidate()
+        else:
+            args.nbia_cache = None
+
         all_sources = All(args.pid, sess, settings.CURRENT_VERSION, args.access,
-                          args.skipped_tcia_collections, args.skipped_idc_collections, Lock())
+                          args.skipped_tcia_collections, args.skipped_idc_collections, Lock(), args.nbia_cache)
 
         version = sess.query(Version).filter(Version.version == settings.CURRENT_VERSION).first()
         if not version:
@@ -116,6 +130,10 @@ def ingest(args):
             build_version(sess, args, all_sources, version)
         else:
             successlogger.info("    version %s previously built", settings.CURRENT_VERSION)
+
+        if args.metrics_dir:
+            # Combine the metrics of all the worker processes of the build
+            export(f'{args.metrics_dir}/v{settings.CURRENT_VERSION}_metrics')
         return
 
 if __name__ == '__main__':
@@ -140,6 +158,40 @@ if __name__ == '__main__':
     parser.add_argument('--server', default="", help="NBIA server to access. Set to NLST for NLST ingestion")
     parser.add_argument('--prestaging_idc_bucket_prefix', default=f'idc_v{settings.CURRENT_VERSION}_idc_', help='Copy idc instances here before forwarding to --staging_bucket')
 
+    parser.add_argument('--stream_tcia', type=bool, default=False, \
+                        help='Stream tcia instances from NBIA directly to the prestaging bucket instead of staging them on disk. NLST series are always staged')
+    parser.add_argument('--stream_spool_size', type=int, default=256*2**20, \
+                        help='Maximum size in bytes of a streamed instance that is buffered in memory rather than a temporary file')
+
+    parser.add_argument('--pipeline_series', type=bool, default=False, \
+                        help='Overlap the download, processing and upload of the series of each patient')
+    parser.add_argument('--pipeline_depth', type=int, default=2, \
+                        help='Maximum number of series waiting between pipeline stages')
+
+    parser.add_argument('--series_scheduler', type=bool, default=False, \
+                        help='Distribute the series of a collection, largest first, rather than its patients over the worker processes')
+
+    parser.add_argument('--upload_threads', type=int, default=16, \
+                        help='Number of threads per process uploading the instances of a series to the prestaging bucket')
+    parser.add_argument('--upload_chunk_size', type=int, default=64*2**20, \
+                        help='Instances larger than this are uploaded in resumable chunks of this size. Must be a multiple of 256KB')
+
+    parser.add_argument('--copy_threads', type=int, default=32, \
+                        help='Number of threads per process copying the instances of an idc series to the prestaging bucket')
+
+    parser.add_argument('--loading_profile', default='patient_series', \
+                        help='Relationships loaded with the patient of each worker task. One of patient_series, patient_tree, or "" for lazy loading')
+
+    parser.add_argument('--hash_prefetch_threads', type=int, default=16, \
+                        help='Number of concurrent NBIA hash requests when getting the hashes of all the patients of a collection')
+
+    parser.add_argument('--nbia_cache_path', default=f'{settings.LOGGING_BASE}/nbia_cache.db', \
+                        help='SQLite file in which to cache NBIA responses across processes and restarts. Set to "" to disable')
+    parser.add_argument('--nbia_cache_ttl', type=int, default=24*60*60, help='Seconds for which a cached NBIA response is valid')
+
+    parser.add_argument('--metrics_dir', default=f'{settings.LOGGING_BASE}/metrics', \
+                        help='Directory in which worker processes write timing and throughput metrics. Set to "" to disable')
+
     parser.add_argument('--stop_after_collection_summary', type=bool, default=False, \
                         help='Stop after printing a summary of collection dispositions')
 
@@ -17,6 +17,9 @@
 import os
 from pathlib import Path
 import time
+from base64 import b64encode, b64decode
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 import logging
 import pydicom
@@ -25,8 +28,10 @@ from pydicom.errors import InvalidDicomError
 from idc.models import Version, Instance, IDC_Instance
 from sqlalchemy import select,delete
 from google.cloud import storage
-from utilities.tcia_helpers import  get_TCIA_instances_per_series_with_hashes
-from ingestion.utilities.utils import validate_hashes, md5_hasher, copy_disk_to_gcs, copy_gcs_to_gcs
+from utilities.tcia_helpers import  get_TCIA_instances_per_series_with_hashes, stream_TCIA_instances_per_series_with_hashes, \
+    copy_and_hash
+from ingestion.utilities.utils import validate_hashes, copy_disk_to_gcs, copy_gcs_to_gcs, get_storage_client
+from utilities.metrics import metrics
 
 
 
@@ -42,139 +47,177 @@ def clone_instance(instance, uuid):
     return new_instance
 
 
-def build_instances_tcia(sess, args, collection, patient, study, series):
-    # Download a zip of the instances in a series
-    # It will be write the zip to a file dicom/<series_instance_uid>.zip in the
-    # working directory, and expand the zip to directory dicom/<series_instance_uid>
+# Download a zip of the instances in a series
+# It will be write the zip to a file dicom/<series_instance_uid>.zip in the
+# working directory, and expand the zip to directory dicom/<series_instance_uid>
+# Does not touch the DB, and so can be run outside the thread that owns the session.
+# Returns the NBIA md5hashes.csv rows, and the (md5 hash, size) of each file computed as it was extracted
+def download_instances_tcia(args, series_instance_uid):
+    # Delete the series from disk in case it is there from a previous run
     try:
-        # When TCIA provided series timestamps, we'll us that for timestamp.
-        now = datetime.now(timezone.utc)
+        shutil.rmtree("{}/{}".format(args.dicom_dir, series_instance_uid), ignore_errors=True)
+    except:
+        # It wasn't there
+        pass
 
-        # Delete the series from disk in case it is there from a previous run
-        try:
-            shutil.rmtree("{}/{}".format(args.dicom_dir, series.series_instance_uid), ignore_errors=True)
-        except:
-            # It wasn't there
-            pass
+    return get_TCIA_instances_per_series_with_hashes(args.dicom_dir, series_instance_uid)
 
-        download_start = time.time_ns()
-        hashes = get_TCIA_instances_per_series_with_hashes(args.dicom_dir, series.series_instance_uid)
-        download_time = (time.time_ns() - download_start)/10**9
-        if not validate_hashes(args, collection, patient, study, series, hashes):
-            return
 
-        # Get a list of the files from the download
-        dcms = [dcm for dcm in os.listdir("{}/{}".format(args.dicom_dir, series.series_instance_uid))]
+# Validate a downloaded series, and rename each file to <uuid>.dcm, recording its hash and size in the DB.
+# Returns a dictionary of stage times in ns, or None if the series is invalid.
+def process_instances_tcia(sess, args, collection, patient, study, series, hashes, file_hashes):
+    if not validate_hashes(args, collection, patient, study, series, hashes, file_hashes):
+        return None
 
-        # Ensure that the zip has the expected number of instances
-        if not len(dcms) == len(series.instances):
-            errlogger.error("      p%s: Invalid zip file for %s/%s/%s/%s", args.pid,
-                collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid)
-            # Return without marking all instances done. This will prevent the series from being done.
-            return
+    # Get a list of the files from the download
+    dcms = [dcm for dcm in os.listdir("{}/{}".format(args.dicom_dir, series.series_instance_uid))]
 
-        # TCIA file names are based on the position of the image in a scan. We need to extract the SOPInstanceUID
-        # so that we can know the instance.
-        # Use pydicom to open each file to get its UID and rename the file with its associated uuid that we
-        # generated when we expanded this series.
-
-        # Replace the TCIA assigned file name
-        # Also compute the md5 hash and length in bytes of each
-        pydicom_times=[]
-        psql_times=[]
-        rename_times=[]
-        metadata_times=[]
-        begin = time.time_ns()
-        instances = {instance.sop_instance_uid:instance for instance in series.instances}
+    # Ensure that the zip has the expected number of instances
+    if not len(dcms) == len(series.instances):
+        errlogger.error("      p%s: Invalid zip file for %s/%s/%s/%s", args.pid,
+            collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid)
+        # Return without marking all instances done. This will prevent the series from being done.
+        return None
 
-        for dcm in dcms:
-            try:
-                pydicom_times.append(time.time_ns())
-                breakpoint() # Validate new DICOM ID validation code
-                reader = pydicom.dcmread("{}/{}/{}".format(args.dicom_dir, series.series_instance_uid, dcm), stop_before_pixels=True)
-                SOPInstanceUID = reader.SOPInstanceUID
-                pydicom_times.append(time.time_ns())
-            except InvalidDicomError:
-                errlogger.error("       p%s: Invalid DICOM file for %s/%s/%s/%s", args.pid,
-                    collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid)
-                if collection.collection_id == 'NLST':
-                    breakpoint()
-                    # For NLST only, just delete the invalid file
-                    os.remove("{}/{}/{}".format(args.dicom_dir, series.series_instance_uid, dcm))
-                    continue
-                else:
-                    # Return without marking all instances done. This will be prevent the series from being done.
-                    return
+    # TCIA file names are based on the position of the image in a scan. We need to extract the SOPInstanceUID
+    # so that we can know the instance.
+    # Use pydicom to open each file to get its UID and rename the file with its associated uuid that we
+    # generated when we expanded this series.
 
-            psql_times.append(time.time_ns())
-            instance = instances[SOPInstanceUID]
-            # If an instance is already done, don't need to do anything more
-            if instance.done:
-                # Delete file. We already have it.
-                os.remove("{}/{}/{}".format(args.dicom_dir, series.series_instance_uid, dcm))
-                progresslogger.debug("      p%s: Instance %s previously done, ", args.pid, series.series_instance_uid)
+    # Replace the TCIA assigned file name
+    # Also compute the md5 hash and length in bytes of each
+    pydicom_times=[]
+    psql_times=[]
+    rename_times=[]
+    metadata_times=[]
+    begin = time.time_ns()
+    instances = {instance.sop_instance_uid:instance for instance in series.instances}
 
+    for dcm in dcms:
+        try:
+            pydicom_times.append(time.time_ns())
+            reader = pydicom.dcmread("{}/{}/{}".format(args.dicom_dir, series.series_instance_uid, dcm), stop_before_pixels=True)
+            SOPInstanceUID = reader.SOPInstanceUID
+            pydicom_times.append(time.time_ns())
+        except InvalidDicomError:
+            errlogger.error("       p%s: Invalid DICOM file for %s/%s/%s/%s", args.pid,
+                collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid)
+            if collection.collection_id == 'NLST':
+                errlogger.error("       p%s: Deleting invalid NLST file %s of %s", args.pid, dcm, series.series_instance_uid)
+                # For NLST only, just delete the invalid file
+                os.remove("{}/{}/{}".format(args.dicom_dir, series.series_instance_uid, dcm))
                 continue
-            psql_times.append(time.time_ns())
+            else:
+                # Return without marking all instances done. This will be prevent the series from being done.
+                return None
 
-            # Validate that DICOM IDs match what we are expecting
-            try:
-                assert patient.submitter_case_id == reader.PatientID;
-                assert study.study_instance_uid == reader.StudyInstanceUID;
-                assert series.series_instance_uid == reader.SeriesInstanceUID;
-            except:
-                errlogger.error(f"       p{args.pid}: DICOM ID mismatch for instance: {instance.sop_instance_uid} ")
-                errlogger.error(f'       p{args.pid}: PatientID: TCIA : {patient.submitter_case_id}, \
-                    DICOM: {reader.PatientID}')
-                errlogger.error(f'       p{args.pid}: StudyInstanceUID: TCIA : {patient.study_instance_uid}, \
-                    DICOM: {reader.StudyInstanceUID}')
-                errlogger.error(f'       p{args.pid}: SeriesInstanceUID: TCIA : {patient.series_instance_uid}, \
-                    DICOM: {reader.SeriesInstanceUID}')
+        psql_times.append(time.time_ns())
+        instance = instances[SOPInstanceUID]
+        # If an instance is already done, don't need to do anything more
+        if instance.done:
+            # Delete file. We already have it.
+            os.remove("{}/{}/{}".format(args.dicom_dir, series.series_instance_uid, dcm))
+            progresslogger.debug("      p%s: Instance %s previously done, ", args.pid, series.series_instance_uid)
+
+            continue
+        psql_times.append(time.time_ns())
+
+        # Validate that DICOM IDs match what we are expecting
+        try:
+            assert patient.submitter_case_id == reader.PatientID;
+            assert study.study_instance_uid == reader.StudyInstanceUID;
+            assert series.series_instance_uid == reader.SeriesInstanceUID;
+        except:
+            errlogger.error(f"       p{args.pid}: DICOM ID mismatch for instance: {instance.sop_instance_uid} ")
+            errlogger.error(f'       p{args.pid}: PatientID: TCIA : {patient.submitter_case_id}, \
+                DICOM: {reader.PatientID}')
+            errlogger.error(f'       p{args.pid}: StudyInstanceUID: TCIA : {patient.study_instance_uid}, \
+                DICOM: {reader.StudyInstanceUID}')
+            errlogger.error(f'       p{args.pid}: SeriesInstanceUID: TCIA : {patient.series_instance_uid}, \
+                DICOM: {reader.SeriesInstanceUID}')
+            # Return without marking all instances done. This will be prevent the series from being done.
+            return None
+
+        rename_times.append(time.time_ns())
+        uuid = instance.uuid
+        file_name = "{}/{}/{}".format(args.dicom_dir, series.series_instance_uid, dcm)
+        blob_name = "{}/{}/{}.dcm".format(args.dicom_dir, series.series_instance_uid, uuid)
+        if os.path.exists(blob_name):
+            errlogger.error("       p%s: Duplicate DICOM files for %s/%s/%s/%s/%s", args.pid,
+                collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid, SOPInstanceUID)
+            if collection.collection_id == 'NLST':
+                errlogger.error("       p%s: Deleting duplicate NLST file %s of %s", args.pid, dcm, series.series_instance_uid)
+                # For NLST only, just delete the duplicate
+                os.remove("{}/{}/{}".format(args.dicom_dir, series.series_instance_uid, dcm))
+                continue
+            else:
                 # Return without marking all instances done. This will be prevent the series from being done.
-                return
-
-            rename_times.append(time.time_ns())
-            uuid = instance.uuid
-            file_name = "{}/{}/{}".format(args.dicom_dir, series.series_instance_uid, dcm)
-            blob_name = "{}/{}/{}.dcm".format(args.dicom_dir, series.series_instance_uid, uuid)
-            if os.path.exists(blob_name):
-                errlogger.error("       p%s: Duplicate DICOM files for %s/%s/%s/%s/%s", args.pid,
-                    collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid, SOPInstanceUID)
-                if collection.collection_id == 'NLST':
-                    breakpoint()
-                    # For NLST only, just delete the duplicate
-                    os.remove("{}/{}/{}".format(args.dicom_dir, series.series_instance_uid, dcm))
-                    continue
-                else:
-                    # Return without marking all instances done. This will be prevent the series from being done.
-                    return
+                return None
 
-            os.rename(file_name, blob_name)
-            rename_times.append(time.time_ns())
+        os.rename(file_name, blob_name)
+        rename_times.append(time.time_ns())
 
-            metadata_times.append(time.time_ns())
-            instance.hash = md5_hasher(blob_name)
-            instance.size = Path(blob_name).stat().st_size
-            instance.timestamp = datetime.utcnow()
-            metadata_times.append(time.time_ns())
+        metadata_times.append(time.time_ns())
+        instance.hash, instance.size = file_hashes[dcm]
+        instance.timestamp = datetime.utcnow()
+        metadata_times.append(time.time_ns())
 
-        if collection.collection_id == 'NLST':
-            breakpoint()
-            # For NLST only, delete any instances for which there is not a corresponding file
-            for instance in series.instances:
-                if not os.path.exists("{}/{}/{}.dcm".format(args.dicom_dir, series.series_instance_uid, instance.uuid)):
-                    sess.execute(delete(Instance).where(Instance.uuid==instance.uuid))
-                    series.instances.remove(instance)
+    if collection.collection_id == 'NLST':
+        # For NLST only, delete any instances for which there is not a corresponding file
+        for instance in list(series.instances):
+            if not os.path.exists("{}/{}/{}.dcm".format(args.dicom_dir, series.series_instance_uid, instance.uuid)):
+                errlogger.error("       p%s: Deleting NLST instance %s of %s, which has no file", args.pid,
+                    instance.sop_instance_uid, series.series_instance_uid)
+                sess.execute(delete(Instance).where(Instance.uuid==instance.uuid))
+                series.instances.remove(instance)
 
-        instances_time = time.time_ns() - begin
+    return {
+        'instances': time.time_ns() - begin,
+        'pydicom': sum(pydicom_times[1::2]) - sum(pydicom_times[0::2]),
+        'psql': sum(psql_times[1::2]) - sum(psql_times[0::2]),
+        'rename': sum(rename_times[1::2]) - sum(rename_times[0::2]),
+        'metadata': sum(metadata_times[1::2]) - sum(metadata_times[0::2])
+    }
+
+
+# Copy a processed series to the prestaging bucket, validate it there, and delete it from disk.
+# Returns True if successful
+def upload_instances_tcia(args, collection, patient, study, series):
+    try:
+        copy_disk_to_gcs(args, collection, patient, study, series)
+    except:
+        # Copy failed. Return without marking all instances done. This will be prevent the series from being done.
+        errlogger.error("       p%s: Copy files to GCS failed for %s/%s/%s/%s", args.pid,
+                collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid)
+        return False
+    return True
+
+
+# Record the stage times, in seconds, of a series built by build_instances_tcia
+def record_tcia_series_metrics(series, download_time, times, copy_time):
+    metrics.observe('tcia.series.download', download_time)
+    for stage in ('instances', 'pydicom', 'psql', 'rename', 'metadata'):
+        metrics.observe(f'tcia.series.{stage}', times[stage]/10**9)
+    metrics.observe('tcia.series.copy', copy_time)
+    metrics.count('tcia.instances', len(series.instances))
+    metrics.bytes('tcia.copy', sum(instance.size for instance in series.instances if instance.size))
+
+
+def build_instances_tcia(sess, args, collection, patient, study, series):
+    try:
+        # When TCIA provided series timestamps, we'll us that for timestamp.
+        now = datetime.now(timezone.utc)
+
+        download_start = time.time_ns()
+        hashes, file_hashes = download_instances_tcia(args, series.series_instance_uid)
+        download_time = (time.time_ns() - download_start)/10**9
+
+        times = process_instances_tcia(sess, args, collection, patient, study, series, hashes, file_hashes)
+        if times is None:
+            return
 
         copy_start = time.time_ns()
-        try:
-            copy_disk_to_gcs(args, collection, patient, study, series)
-        except:
-            # Copy failed. Return without marking all instances done. This will be prevent the series from being done.
-            errlogger.error("       p%s: Copy files to GCS failed for %s/%s/%s/%s", args.pid,
-                    collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid)
+        if not upload_instances_tcia(args, collection, patient, study, series):
             return
         copy_time = (time.time_ns() - copy_start)/10**9
 
@@ -182,15 +225,16 @@ def build_instances_tcia(sess, args, collection, patient, study, series):
         for instance in series.instances:
             instance.done = True
         mark_done_time = time.time() - mark_done_start
+        record_tcia_series_metrics(series, download_time, times, copy_time)
         # rootlogger.debug("      p%s: Series %s, completed build_instances; %s", args.pid, series.series_instance_uid, time.asctime())
         progresslogger.debug("        p%s: Series %s: download: %s, instances: %s, pydicom: %s, psql: %s, rename: %s, metadata: %s, copy: %s, mark_done: %s",
                          args.pid, series.series_instance_uid,
                          download_time,
-                         instances_time/10**9,
-                         (sum(pydicom_times[1::2]) - sum(pydicom_times[0::2]))/10**9,
-                         (sum(psql_times[1::2]) - sum(psql_times[0::2]))/10**9,
-                         (sum(rename_times[1::2]) - sum(rename_times[0::2]))/10 **9,
-                         (sum(metadata_times[1::2]) - sum(metadata_times[0::2])) / 10 ** 9,
+                         times['instances']/10**9,
+                         times['pydicom']/10**9,
+                         times['psql']/10**9,
+                         times['rename']/10 **9,
+                         times['metadata'] / 10 ** 9,
                          copy_time,
                          mark_done_time)
     except Exception as exc:
@@ -198,6 +242,164 @@ def build_instances_tcia(sess, args, collection, patient, study, series):
         raise exc
 
 
+# Delete blobs that were uploaded by build_instances_tcia_streaming before a failure was detected
+def rollback_streamed_instances(args, bucket, uploaded):
+    for blob_name in uploaded:
+        try:
+            bucket.blob(blob_name).delete()
+        except Exception as exc:
+            errlogger.error('       p%s: Failed to delete blob %s during streaming rollback: %s', args.pid, blob_name, exc)
+
+
+# NLST series are always staged on disk, even with --stream_tcia. Only the staged path deletes invalid
+# or duplicate NLST files, and NLST instances that have no file, rather than failing the series.
+def is_streamed(args, collection):
+    return args.stream_tcia and collection.collection_id != 'NLST'
+
+
+# Streaming alternative to build_instances_tcia. Rather than downloading the series zip to args.dicom_dir,
+# extracting, renaming and copying with gsutil, read zip members directly from the NBIA response,
+# hash and parse each one as it arrives, and upload it to the prestaging bucket as <uuid>.dcm.
+# Each instance is buffered in memory unless it exceeds args.stream_spool_size bytes.
+def build_instances_tcia_streaming(sess, args, collection, patient, study, series):
+    try:
+        client = get_storage_client(args)
+        bucket = client.bucket(args.prestaging_tcia_bucket)
+        instances = {instance.sop_instance_uid:instance for instance in series.instances}
+
+        # Hashes from md5hashes.csv, indexed by TCIA file name
+        nbia_hashes = {}
+        # Hash and size of each received file, indexed by TCIA file name
+        received = {}
+        # Blobs that we have uploaded, in case we need to roll back
+        uploaded = []
+        # SOPInstanceUIDs seen in the zip, including those of previously done instances
+        seen = set()
+
+        pydicom_time = 0
+        upload_time = 0
+        upload_size = 0
+        begin = time.time_ns()
+        for dcm, chunks in stream_TCIA_instances_per_series_with_hashes(series.series_instance_uid):
+            if dcm == 'md5hashes.csv':
+                for row in b''.join(chunks).decode().splitlines()[1:]:
+                    row = row.split(',')
+                    nbia_hashes[row[0]] = row[1]
+                continue
+
+            # Hash the instance as it is received. The spool, and any file that it spilled to, is
+            # closed however the instance is handled.
+            with SpooledTemporaryFile(max_size=args.stream_spool_size) as spool:
+                received[dcm] = copy_and_hash(chunks, spool)
+                size = received[dcm][1]
+
+                try:
+                    pydicom_start = time.time_ns()
+                    spool.seek(0)
+                    reader = pydicom.dcmread(spool, stop_before_pixels=True)
+                    SOPInstanceUID = reader.SOPInstanceUID
+                    pydicom_time += time.time_ns() - pydicom_start
+                except InvalidDicomError:
+                    errlogger.error("       p%s: Invalid DICOM file for %s/%s/%s/%s", args.pid,
+                        collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid)
+                    rollback_streamed_instances(args, bucket, uploaded)
+                    # Return without marking all instances done. This will be prevent the series from being done.
+                    return
+
+                if SOPInstanceUID in seen:
+                    errlogger.error("       p%s: Duplicate DICOM files for %s/%s/%s/%s/%s", args.pid,
+                        collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid, SOPInstanceUID)
+                    rollback_streamed_instances(args, bucket, uploaded)
+                    return
+                seen.add(SOPInstanceUID)
+
+                instance = instances.get(SOPInstanceUID)
+                if instance is None:
+                    errlogger.error("       p%s: Unexpected instance for %s/%s/%s/%s/%s", args.pid,
+                        collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid, SOPInstanceUID)
+                    rollback_streamed_instances(args, bucket, uploaded)
+                    # Return without marking all instances done. This will be prevent the series from being done.
+                    return
+                # If an instance is already done, don't need to do anything more
+                if instance.done:
+                    progresslogger.debug("      p%s: Instance %s previously done, ", args.pid, series.series_instance_uid)
+                    continue
+
+                # Validate that DICOM IDs match what we are expecting
+                try:
+                    assert patient.submitter_case_id == reader.PatientID;
+                    assert study.study_instance_uid == reader.StudyInstanceUID;
+                    assert series.series_instance_uid == reader.SeriesInstanceUID;
+                except:
+                    errlogger.error(f"       p{args.pid}: DICOM ID mismatch for instance: {instance.sop_instance_uid} ")
+                    errlogger.error(f'       p{args.pid}: PatientID: TCIA : {patient.submitter_case_id}, \
+                        DICOM: {reader.PatientID}')
+                    errlogger.error(f'       p{args.pid}: StudyInstanceUID: TCIA : {study.study_instance_uid}, \
+                        DICOM: {reader.StudyInstanceUID}')
+                    errlogger.error(f'       p{args.pid}: SeriesInstanceUID: TCIA : {series.series_instance_uid}, \
+                        DICOM: {reader.SeriesInstanceUID}')
+                    rollback_streamed_instances(args, bucket, uploaded)
+                    # Return without marking all instances done. This will be prevent the series from being done.
+                    return
+
+                # Upload the instance. GCS verifies the supplied MD5 hash.
+                upload_start = time.time_ns()
+                blob = bucket.blob(f'{instance.uuid}.dcm')
+                blob.md5_hash = b64encode(bytes.fromhex(received[dcm][0])).decode()
+                spool.seek(0)
+                try:
+                    blob.upload_from_file(spool, size=size)
+                    uploaded.append(blob.name)
+                    assert b64decode(blob.md5_hash).hex() == received[dcm][0]
+                    assert blob.size == size
+                except Exception as exc:
+                    errlogger.error("       p%s: Upload to GCS failed for %s/%s/%s/%s/%s: %s", args.pid,
+                        collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid, SOPInstanceUID, exc)
+                    rollback_streamed_instances(args, bucket, uploaded)
+                    return
+                upload_time += time.time_ns() - upload_start
+                upload_size += size
+
+                instance.hash = received[dcm][0]
+                instance.size = size
+                instance.timestamp = datetime.utcnow()
+
+        # Validate that instances were received correctly
+        if set(received) != set(nbia_hashes) or \
+                any(received[dcm][0] != nbia_hashes[dcm] for dcm in received):
+            errlogger.error("      p%s: Invalid hash for %s/%s/%s/%s", args.pid,
+                collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid)
+            rollback_streamed_instances(args, bucket, uploaded)
+            return
+
+        # Ensure that the zip has the expected number of instances
+        if not len(seen) == len(series.instances):
+            errlogger.error("      p%s: Invalid zip file for %s/%s/%s/%s", args.pid,
+                collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid)
+            rollback_streamed_instances(args, bucket, uploaded)
+            # Return without marking all instances done. This will prevent the series from being done.
+            return
+        instances_time = time.time_ns() - begin
+
+        for instance in series.instances:
+            instance.done = True
+        metrics.observe('tcia.series.stream', instances_time/10**9)
+        metrics.observe('tcia.series.pydicom', pydicom_time/10**9)
+        metrics.observe('tcia.series.upload', upload_time/10**9)
+        metrics.count('tcia.instances', len(uploaded))
+        metrics.bytes('tcia.copy', upload_size, begin/10**9)
+        progresslogger.debug("        p%s: Series %s: stream: %s, pydicom: %s, upload: %s, instances: %s, rate: %.2fMB/s",
+                         args.pid, series.series_instance_uid,
+                         instances_time/10**9,
+                         pydicom_time/10**9,
+                         upload_time/10**9,
+                         len(uploaded),
+                         (upload_size/(instances_time/10**9))/(2**20) if instances_time else 0)
+    except Exception as exc:
+        errlogger.info('  p%s build_instances_streaming failed: %s', args.pid, exc)
+        raise exc
+
+
 def build_instances_idc(sess, args, collection, patient, study, series):
     # Download a zip of the instances in a series
     # It will be write the zip to a file dicom/<series_instance_uid>.zip in the
@@ -205,7 +407,7 @@ def build_instances_idc(sess, args, collection, patient, study, series):
 
     # When TCIA provided series timestamps, we'll us that for timestamp.
     now = datetime.now(timezone.utc)
-    client=storage.Client()
+    client = get_storage_client(args)
 
     stmt = select(IDC_Instance.sop_instance_uid, IDC_Instance.gcs_url, IDC_Instance.hash ). \
         where(IDC_Instance.series_instance_uid == series.series_instance_uid)
@@ -214,21 +416,42 @@ def build_instances_idc(sess, args, collection, patient, study, series):
                              for i in result.fetchall()}
     start = time.time()
     total_size = 0
-    for instance in series.instances:
-        if not instance.done:
-            instance.hash = src_instance_metadata[instance.sop_instance_uid]['hash']
-            instance.size, hash = copy_gcs_to_gcs(args, client, args.prestaging_idc_bucket, instance, src_instance_metadata[instance.sop_instance_uid]['gcs_url'])
-            if hash != instance.hash:
-                errlogger.error("       p%s: Copy files to GCS failed for %s/%s/%s/%s/%s", args.pid,
-                                collection.collection_id, patient.submitter_case_id, study.study_instance_uid,
-                                series.series_instance_uid, instance.sop_instance_uid)
-                # Copy failed. Return without marking all instances done. This will be prevent the series from being done.
-                return
-            total_size += instance.size
-            instance.done = True
+
+    # Fan out the rewrites of the series across a thread pool. The threads only talk to GCS;
+    # instances are updated here once their copies complete.
+    todo = [instance for instance in series.instances if not instance.done]
+    with ThreadPoolExecutor(max_workers=args.copy_threads) as executor:
+        futures = {executor.submit(copy_gcs_to_gcs, args, client, args.prestaging_idc_bucket, f'{instance.uuid}.dcm',
+                        src_instance_metadata[instance.sop_instance_uid]['gcs_url']): instance for instance in todo}
+        copies = {}
+        for future in as_completed(futures):
+            try:
+                copies[futures[future].sop_instance_uid] = future.result()
+            except Exception as exc:
+                errlogger.error("       p%s: Rewrite failed for %s: %s", args.pid, futures[future].sop_instance_uid, exc)
+
+    # Verify the copies against the source hashes
+    failed = False
+    for instance in todo:
+        instance.hash = src_instance_metadata[instance.sop_instance_uid]['hash']
+        if instance.sop_instance_uid not in copies or copies[instance.sop_instance_uid][1] != instance.hash:
+            errlogger.error("       p%s: Copy files to GCS failed for %s/%s/%s/%s/%s", args.pid,
+                            collection.collection_id, patient.submitter_case_id, study.study_instance_uid,
+                            series.series_instance_uid, instance.sop_instance_uid)
+            failed = True
+            continue
+        instance.size = copies[instance.sop_instance_uid][0]
+        total_size += instance.size
+        instance.done = True
+    if failed:
+        # Copy failed. Return without marking all instances done. This will be prevent the series from being done.
+        return
+    metrics.observe('idc.series.copy', time.time() - start)
+    metrics.count('idc.instances', len(todo))
+    metrics.bytes('idc.copy', total_size, start)
     progresslogger.debug("        p%s: Series %s: instances: %s, gigabytes: %.2f, rate: %.2fMB/s",
                      args.pid, series.series_instance_uid,
                      len(series.instances),
                      total_size/(2**30),
                      (total_size/(time.time() - start))/(2**20)
-                     )
\ No newline at end of file
+                     )
@@ -18,9 +18,10 @@ import time
 from datetime import datetime, timedelta
 import logging
 from uuid import uuid4
-from idc.models import Patient, Study
-from ingestion.utilities.utils import accum_sources, get_merkle_hash, is_skipped
+from idc.models import Patient, Study, patient_study
+from ingestion.utilities.utils import accum_sources, get_merkle_hash, is_skipped, bulk_insert_children
 from ingestion.study import clone_study, build_study, retire_study
+from ingestion.series_pipeline import build_patient_series_pipelined
 from python_settings import settings
 
 successlogger = logging.getLogger('root.success')
@@ -106,27 +107,27 @@ def expand_patient(sess, args, all_sources, version, collection, patient):
         retired_objects = [obj for id, obj in idc_objects.items() \
                       if not obj in existing_objects]
 
+    # New studies are inserted in bulk after the existing studies have been processed
+    timestamp = datetime.utcnow()
+    new_studies = []
     for study in sorted(new_objects):
-        new_study = Study()
-        new_study.study_instance_uid=study
-        new_study.uuid = str(uuid4())
-        new_study.min_timestamp = datetime.utcnow()
-        new_study.study_instances = 0
-        new_study.revised = studies[study]
-        # The following line can probably be deleted because
-        # a object's sources are computed hierarchically after
-        # building all the children.
-        new_study.source = studies[study]
-        new_study.hashes = None
-        new_study.max_timestamp = new_study.min_timestamp
-        new_study.init_idc_version=settings.CURRENT_VERSION
-        new_study.rev_idc_version=settings.CURRENT_VERSION
-        new_study.final_idc_version=0
-        new_study.done = False
-        new_study.is_new=True
-        new_study.expanded=False
-        patient.studies.append(new_study)
-        progresslogger.debug  ('    p%s: Study %s is new',  args.pid, new_study.study_instance_uid)
+        # Note that a study's sources are computed hierarchically after building all the children.
+        new_studies.append(dict(
+            study_instance_uid=study,
+            uuid=str(uuid4()),
+            min_timestamp=timestamp,
+            study_instances=0,
+            revised=studies[study],
+            hashes=None,
+            max_timestamp=timestamp,
+            init_idc_version=settings.CURRENT_VERSION,
+            rev_idc_version=settings.CURRENT_VERSION,
+            final_idc_version=0,
+            done=False,
+            is_new=True,
+            expanded=False
+        ))
+        progresslogger.debug  ('    p%s: Study %s is new',  args.pid, study)
 
     for study in existing_objects:
         idc_hashes = study.hashes
@@ -175,6 +176,7 @@ def expand_patient(sess, args, all_sources, version, collection, patient):
         retire_study(args, study)
         patient.studies.remove(study)
 
+    bulk_insert_children(sess, patient, 'studies', Study, patient_study, 'patient_uuid', 'study_uuid', new_studies)
     patient.expanded = True
     sess.commit()
     return
@@ -190,6 +192,9 @@ def build_patient(sess, args, all_sources, patient_index, version, collection, p
         successlogger.info("  p%s: Expanded Patient %s, %s, %s studies, expand_time: %s, %s", args.pid, patient.submitter_case_id, patient_index, len(patient.studies), time.time()-begin, time.asctime())
 
         dois_urls_licenses = get_dois_urls_licenses(args, all_sources, collection.collection_id, patient.submitter_case_id)
+        if args.pipeline_series:
+            # Overlap the download, processing and upload of the patient's series
+            build_patient_series_pipelined(sess, args, all_sources, version, collection, patient, dois_urls_licenses)
         for study in patient.studies:
             study_index = f'{patient.studies.index(study) + 1} of {len(patient.studies)}'
             if not study.done:
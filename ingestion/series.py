@@ -18,9 +18,10 @@ import time
 from datetime import datetime, timedelta
 import logging
 from uuid import uuid4
-from idc.models import Series, Instance, instance_source
-from ingestion.instance import clone_instance, build_instances_idc, build_instances_tcia
-from ingestion.utilities.utils import is_skipped
+from idc.models import Series, Instance, instance_source, series_instance
+from ingestion.instance import clone_instance, build_instances_idc, build_instances_tcia, build_instances_tcia_streaming, \
+    is_streamed
+from ingestion.utilities.utils import is_skipped, bulk_insert_children
 from python_settings import settings
 
 
@@ -83,23 +84,26 @@ def expand_series(sess, args, all_sources, version, collection, patient, study,
         retired_objects = [obj for id, obj in idc_objects.items() \
                if not obj in existing_objects ]
 
+    # New instances are inserted in bulk after the existing instances have been processed
+    timestamp = datetime.utcnow()
+    new_instances = []
     for instance in sorted(new_objects):
-        new_instance = Instance()
-        new_instance.sop_instance_uid=instance
-        new_instance.uuid=str(uuid4())
-        new_instance.size=0
-        new_instance.revised=True
-        new_instance.done=False
-        new_instance.is_new=True
-        new_instance.expanded=False
-        new_instance.init_idc_version=settings.CURRENT_VERSION
-        new_instance.rev_idc_version=settings.CURRENT_VERSION
-        new_instance.source = instances[instance]
-        new_instance.hash = None
-        new_instance.timestamp = datetime.utcnow()
-        new_instance.final_idc_version = 0
-        series.instances.append(new_instance)
-        progresslogger.debug('        p%s: Instance %s is new', args.pid, new_instance.sop_instance_uid)
+        new_instances.append(dict(
+            sop_instance_uid=instance,
+            uuid=str(uuid4()),
+            size=0,
+            revised=True,
+            done=False,
+            is_new=True,
+            expanded=False,
+            init_idc_version=settings.CURRENT_VERSION,
+            rev_idc_version=settings.CURRENT_VERSION,
+            source=instances[instance],
+            hash=None,
+            timestamp=timestamp,
+            final_idc_version=0
+        ))
+        progresslogger.debug('        p%s: Instance %s is new', args.pid, instance)
 
     for instance in existing_objects:
         idc_hash = instance.hash
@@ -140,6 +144,7 @@ def expand_series(sess, args, all_sources, version, collection, patient, study,
         instance.final_idc_version = settings.PREVIOUS_VERSION
         series.instances.remove(instance)
 
+    bulk_insert_children(sess, series, 'instances', Instance, series_instance, 'series_uuid', 'instance_uuid', new_instances)
     series.expanded = True
     sess.commit()
     return 0
@@ -162,7 +167,11 @@ def build_series(sess, args, all_sources, series_index, version, collection, pat
 
         if not all(instance.done for instance in series.instances):
             if series.sources.tcia:
-                build_instances_tcia(sess, args, collection, patient, study, series)
+                if is_streamed(args, collection):
+                    # Stream instances from NBIA to GCS without staging them on disk
+                    build_instances_tcia_streaming(sess, args, collection, patient, study, series)
+                else:
+                    build_instances_tcia(sess, args, collection, patient, study, series)
             if series.sources.idc:
                 # Get instance data from idc DB table/ GCS bucket.
                 build_instances_idc(sess, args, collection, patient, study, series)
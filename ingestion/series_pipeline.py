@@ -0,0 +1,177 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Pipelined building of the series of a patient. Within a patient worker, the download of series N+1
+# overlaps the processing of series N and the upload of series N-1. Stages are connected by bounded
+# queues so that at most args.pipeline_depth series are on disk waiting for the next stage.
+#
+# All DB work (expansion, processing, finalization) runs on the event loop thread, which owns the
+# session. Only download and upload, which do not touch the DB, run in executor threads. The upload
+# stage is given a snapshot of the series so that it never lazy loads through the session.
+
+import asyncio
+import time
+import logging
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from ingestion.study import expand_study
+from ingestion.series import expand_series, build_series
+from ingestion.instance import download_instances_tcia, process_instances_tcia, upload_instances_tcia, record_tcia_series_metrics, \
+    is_streamed
+
+successlogger = logging.getLogger('root.success')
+progresslogger = logging.getLogger('root.progress')
+errlogger = logging.getLogger('root.err')
+
+
+# Copy the attributes of the hierarchy that the upload stage needs into plain objects
+def snapshot_series(collection, patient, study, series):
+    return (
+        SimpleNamespace(collection_id=collection.collection_id),
+        SimpleNamespace(submitter_case_id=patient.submitter_case_id),
+        SimpleNamespace(study_instance_uid=study.study_instance_uid),
+        SimpleNamespace(series_instance_uid=series.series_instance_uid,
+            instances=[SimpleNamespace(sop_instance_uid=instance.sop_instance_uid, uuid=instance.uuid,
+                hash=instance.hash, size=instance.size) for instance in series.instances])
+    )
+
+
+# Only TCIA series that are staged on disk benefit from pipelining
+def is_pipelined(args, collection, series):
+    return series.sources.tcia and not is_streamed(args, collection) and \
+        not all(instance.done for instance in series.instances)
+
+
+async def expand_stage(sess, args, all_sources, version, collection, patient, work, download_queue, failures):
+    for series_index, study, series in work:
+        try:
+            if not series.expanded:
+                expand_series(sess, args, all_sources, version, collection, patient, study, series)
+            if is_pipelined(args, collection, series):
+                await download_queue.put((series_index, study, series))
+            else:
+                build_series(sess, args, all_sources, series_index, version, collection, patient, study, series)
+        except Exception as exc:
+            errlogger.error('      p%s: Pipeline expansion of series %s failed: %s', args.pid, series.series_instance_uid, exc)
+            failures.append(exc)
+    await download_queue.put(None)
+
+
+async def download_stage(args, executor, download_queue, process_queue, failures):
+    loop = asyncio.get_running_loop()
+    while (item := await download_queue.get()) is not None:
+        series_index, study, series = item
+        series_instance_uid = series.series_instance_uid
+        try:
+            start = time.time()
+            hashes, file_hashes = await loop.run_in_executor(executor, download_instances_tcia, args, series_instance_uid)
+            await process_queue.put((item, hashes, file_hashes, time.time() - start))
+        except Exception as exc:
+            errlogger.error('      p%s: Pipeline download of series %s failed: %s', args.pid, series_instance_uid, exc)
+            failures.append(exc)
+    await process_queue.put(None)
+
+
+async def process_stage(sess, args, collection, patient, process_queue, upload_queue, failures):
+    while (next_item := await process_queue.get()) is not None:
+        item, hashes, file_hashes, download_time = next_item
+        series_index, study, series = item
+        try:
+            times = process_instances_tcia(sess, args, collection, patient, study, series, hashes, file_hashes)
+            if times is None:
+                # The series is invalid. It will not be marked done.
+                continue
+            await upload_queue.put((item, snapshot_series(collection, patient, study, series), download_time, times))
+        except Exception as exc:
+            errlogger.error('      p%s: Pipeline processing of series %s failed: %s', args.pid, series.series_instance_uid, exc)
+            failures.append(exc)
+    await upload_queue.put(None)
+
+
+async def upload_stage(args, executor, upload_queue, finalize_queue, failures):
+    loop = asyncio.get_running_loop()
+    while (next_item := await upload_queue.get()) is not None:
+        item, snapshot, download_time, times = next_item
+        try:
+            start = time.time()
+            if await loop.run_in_executor(executor, upload_instances_tcia, args, *snapshot):
+                await finalize_queue.put((item, download_time, times, time.time() - start))
+        except Exception as exc:
+            errlogger.error('      p%s: Pipeline upload of series %s failed: %s', args.pid, snapshot[-1].series_instance_uid, exc)
+            failures.append(exc)
+    await finalize_queue.put(None)
+
+
+async def finalize_stage(sess, args, all_sources, version, collection, patient, finalize_queue, failures):
+    while (next_item := await finalize_queue.get()) is not None:
+        item, download_time, times, copy_time = next_item
+        series_index, study, series = item
+        try:
+            for instance in series.instances:
+                instance.done = True
+            record_tcia_series_metrics(series, download_time, times, copy_time)
+            progresslogger.debug("        p%s: Series %s: download: %s, instances: %s, pydicom: %s, psql: %s, rename: %s, metadata: %s, copy: %s",
+                             args.pid, series.series_instance_uid,
+                             download_time,
+                             times['instances']/10**9,
+                             times['pydicom']/10**9,
+                             times['psql']/10**9,
+                             times['rename']/10**9,
+                             times['metadata']/10**9,
+                             copy_time)
+            # All instances are done, so this only validates the series hash and marks the series done
+            build_series(sess, args, all_sources, series_index, version, collection, patient, study, series)
+        except Exception as exc:
+            errlogger.error('      p%s: Pipeline finalization of series %s failed: %s', args.pid, series.series_instance_uid, exc)
+            failures.append(exc)
+
+
+async def run_pipeline(sess, args, all_sources, version, collection, patient, work):
+    failures = []
+    download_queue = asyncio.Queue(maxsize=args.pipeline_depth)
+    process_queue = asyncio.Queue(maxsize=args.pipeline_depth)
+    upload_queue = asyncio.Queue(maxsize=args.pipeline_depth)
+    finalize_queue = asyncio.Queue(maxsize=args.pipeline_depth)
+    # One thread each for the download and upload stages
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        await asyncio.gather(
+            expand_stage(sess, args, all_sources, version, collection, patient, work, download_queue, failures),
+            download_stage(args, executor, download_queue, process_queue, failures),
+            process_stage(sess, args, collection, patient, process_queue, upload_queue, failures),
+            upload_stage(args, executor, upload_queue, finalize_queue, failures),
+            finalize_stage(sess, args, all_sources, version, collection, patient, finalize_queue, failures)
+        )
+    return failures
+
+
+# Expand all the studies of a patient and build their series through the pipeline.
+# Studies are then completed by build_study, which finds their series done.
+def build_patient_series_pipelined(sess, args, all_sources, version, collection, patient, dois_urls_licenses):
+    begin = time.time()
+    work = []
+    for study in patient.studies:
+        if not study.done:
+            if not study.expanded:
+                expand_study(sess, args, all_sources, version, collection, patient, study, dois_urls_licenses)
+            for series in study.seriess:
+                if not series.done:
+                    work.append((f'{study.seriess.index(series) + 1} of {len(study.seriess)}', study, series))
+
+    failures = asyncio.run(run_pipeline(sess, args, all_sources, version, collection, patient, work))
+    progresslogger.debug("    p%s: Pipelined %s series of patient %s in %s", args.pid, len(work), patient.submitter_case_id, time.time() - begin)
+    if failures:
+        # Raise the first failure so that the worker retries the patient
+        raise failures[0]
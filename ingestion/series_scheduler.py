@@ -0,0 +1,176 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Series level scheduling of a collection build. Distributing whole patients to workers lets a
+# patient with a huge study pin one worker while the others idle at the tail of the collection.
+# Instead, a collection is built in three phases, each distributed over the same worker processes:
+#   expand:   patients, and their studies and series, are expanded. Each worker reports the series
+#             of its patient that remain to be built, with an estimate of the bytes to be copied.
+#   series:   series are queued largest first. Each idle worker takes the next series from the shared
+#             queue, so that the largest series start early and the small ones fill in the tail.
+#   finalize: build_patient is run on each patient. It finds the series done and only validates the
+#             study and patient hashes (and rebuilds any series that failed in the series phase).
+
+import time
+import logging
+from multiprocessing import Process, Queue
+from idc.models import Version, get_collection, get_patient
+from ingestion.patient import expand_patient, build_patient, get_dois_urls_licenses
+from ingestion.study import expand_study
+from ingestion.series import expand_series, build_series
+from ingestion.all_sources import All
+from utilities.sqlalchemy_helpers import sa_session
+from utilities.metrics import metrics
+from python_settings import settings
+
+successlogger = logging.getLogger('root.success')
+progresslogger = logging.getLogger('root.progress')
+errlogger = logging.getLogger('root.err')
+
+TASK_TRIES = 3
+# Size assumed for an instance whose size is not yet known (new and revised instances have size 0)
+ESTIMATED_INSTANCE_SIZE = 512*2**10
+
+
+# Estimate of the number of bytes that building a series will copy
+def series_weight(series):
+    return sum(instance.size or ESTIMATED_INSTANCE_SIZE for instance in series.instances if not instance.done)
+
+
+def find_patient(sess, args, collection_id, submitter_case_id):
+    version = sess.query(Version).filter(Version.version == settings.CURRENT_VERSION).one()
+    collection = get_collection(sess, settings.CURRENT_VERSION, collection_id)
+    patient = get_patient(sess, settings.CURRENT_VERSION, collection_id, submitter_case_id, args.loading_profile)
+    return version, collection, patient
+
+
+# Expand a patient and all of its studies and series. Returns a work unit for each series that is not done.
+def expand_patient_series(sess, args, all_sources, version, collection, patient):
+    if not patient.expanded:
+        expand_patient(sess, args, all_sources, version, collection, patient)
+    dois_urls_licenses = None
+    units = []
+    for study in patient.studies:
+        if study.done:
+            continue
+        if not study.expanded:
+            if dois_urls_licenses is None:
+                dois_urls_licenses = get_dois_urls_licenses(args, all_sources, collection.collection_id, patient.submitter_case_id)
+            expand_study(sess, args, all_sources, version, collection, patient, study, dois_urls_licenses)
+        for series in study.seriess:
+            if series.done:
+                continue
+            if not series.expanded:
+                expand_series(sess, args, all_sources, version, collection, patient, study, series)
+            units.append((series_weight(series), patient.submitter_case_id, study.study_instance_uid,
+                          series.series_instance_uid, f'{study.seriess.index(series) + 1} of {len(study.seriess)}'))
+    return units
+
+
+def run_task(sess, args, all_sources, task):
+    kind, index, collection_id, submitter_case_id = task[:4]
+    version, collection, patient = find_patient(sess, args, collection_id, submitter_case_id)
+    if kind == 'expand':
+        return expand_patient_series(sess, args, all_sources, version, collection, patient)
+    elif kind == 'series':
+        study_instance_uid, series_instance_uid = task[4:]
+        study = next(study for study in patient.studies if study.study_instance_uid == study_instance_uid)
+        series = next(series for series in study.seriess if series.series_instance_uid == series_instance_uid)
+        if not series.done:
+            build_series(sess, args, all_sources, index, version, collection, patient, study, series)
+        return series.done
+    else:
+        build_patient(sess, args, all_sources, index, version, collection, patient)
+        return patient.done
+
+
+# Tasks are tuples of (kind, index, collection_id, submitter_case_id[, study_instance_uid, series_instance_uid]).
+# For each task, (task, result) is put on the output queue. The result is None if all tries failed.
+def scheduler_worker(input, output, args, access, lock):
+    with sa_session() as sess:
+        all_sources = All(args.pid, sess, settings.CURRENT_VERSION, access,
+                          args.skipped_tcia_collections, args.skipped_idc_collections, lock, args.nbia_cache)
+
+        for task in iter(input.get, 'STOP'):
+            result = None
+            for attempt in range(TASK_TRIES):
+                time.sleep((2**attempt)-1)
+                try:
+                    result = run_task(sess, args, all_sources, task)
+                    break
+                except Exception as exc:
+                    errlogger.error("p%s, exception %s; reattempt %s on %s task %s, %s", args.pid, exc, attempt, task[0], task[3:], time.asctime())
+                    sess.rollback()
+            else:
+                errlogger.error("p%s, Failed %s task %s", args.pid, task[0], task[3:])
+            output.put((task, result))
+            metrics.flush()
+
+
+# Put the tasks on the task queue and return the result of each as they complete
+def run_phase(task_queue, done_queue, tasks):
+    for task in tasks:
+        task_queue.put(task)
+    results = []
+    for _ in tasks:
+        results.append(done_queue.get(True))
+    return results
+
+
+def build_collection_series_scheduled(sess, args, collection, lock):
+    begin = time.time()
+    patients = [patient for patient in collection.patients if not patient.done]
+    patient_indices = {patient.submitter_case_id: f'{collection.patients.index(patient) + 1} of {len(collection.patients)}' \
+                       for patient in patients}
+    if not patients:
+        return
+
+    processes = []
+    task_queue = Queue()
+    done_queue = Queue()
+    num_processes = min(args.num_processes, len(patients))
+    for process in range(num_processes):
+        args.pid = process+1
+        processes.append(
+            Process(target=scheduler_worker, args=(task_queue, done_queue, args, args.access, lock)))
+        processes[-1].start()
+    args.pid = 0
+
+    try:
+        results = run_phase(task_queue, done_queue,
+            [('expand', patient_indices[patient.submitter_case_id], collection.collection_id, patient.submitter_case_id) \
+             for patient in patients])
+        units = sorted((unit for task, result in results if result for unit in result), reverse=True)
+        progresslogger.info("  p%s: Collection %s: %s series to build, %s estimated bytes, expand time: %s", args.pid,
+            collection.collection_id, len(units), sum(unit[0] for unit in units), time.time() - begin)
+
+        run_phase(task_queue, done_queue,
+            [('series', series_index, collection.collection_id, submitter_case_id, study_instance_uid, series_instance_uid) \
+             for weight, submitter_case_id, study_instance_uid, series_instance_uid, series_index in units])
+        progresslogger.info("  p%s: Collection %s: series built in %s", args.pid, collection.collection_id, time.time() - begin)
+
+        run_phase(task_queue, done_queue,
+            [('patient', patient_indices[patient.submitter_case_id], collection.collection_id, patient.submitter_case_id) \
+             for patient in patients])
+    finally:
+        # Tell child processes to stop
+        for process in processes:
+            task_queue.put('STOP')
+        # Wait for them to stop
+        for process in processes:
+            process.join()
+    # The workers have committed their changes. Make the parent's session see them.
+    sess.commit()
@@ -14,10 +14,11 @@
 # limitations under the License.
 #
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from utilities.tcia_helpers import  get_access_token, get_hash, get_TCIA_studies_per_patient, get_TCIA_patients_per_collection,\
     get_TCIA_series_per_study, get_TCIA_instance_uids_per_series, get_TCIA_instances_per_series, get_collection_values_and_counts,\
-    get_updated_series, get_instance_hash, refresh_access_token
+    get_updated_series, get_instance_hash, refresh_access_token, NBIATokenManager
 from uuid import uuid4
 from idc.models  import IDC_Collection, IDC_Patient, IDC_Study, IDC_Series, IDC_Instance, instance_source
 from sqlalchemy import select
@@ -38,7 +39,7 @@ class Source:
 
 
 class TCIA(Source):
-    def __init__(self, pid, sess, access, skipped_collections, lock):
+    def __init__(self, pid, sess, access, skipped_collections, lock, cache=None):
         super().__init__(instance_source['tcia'].value)
         self.source = instance_source.tcia
         # self.access_token, self.refresh_token = get_access_token()
@@ -47,6 +48,23 @@ class TCIA(Source):
         self.access = access
         self.skipped_collections = skipped_collections
         self.lock = lock
+        # The lock is only taken to refresh the shared token
+        self.tokens = NBIATokenManager(access, lock)
+        # Optional NBIACache of NBIA responses
+        self.cache = cache
+
+    # Return the result of an NBIA request from the cache if we have one, else call fetch()
+    def cached(self, endpoint, params, fetch):
+        if self.cache is None:
+            return fetch()
+        return self.cache.get_or_fetch(endpoint, params, fetch)
+
+    # Return the decoded result of a getMD5Hierarchy request, or None if the request failed
+    def get_hash_value(self, request_data):
+        def fetch():
+            result = self.get_hash(request_data)
+            return result.content.decode() if result else None
+        return self.cached('getMD5Hierarchy', request_data, fetch)
 
     def get_hash(self, request_data, access_token=None, refresh_token=None):
         # if not access_token:
@@ -57,23 +75,17 @@ class TCIA(Source):
         # # url = "https://public-dev.cancerimagingarchive.net/nbia-api/services/getMD5Hierarchy"
         # url = f"{NBIA_V2_URL}/getM5HashForImage?SOPInstanceUid={sop_instance_uid}"
         # result = requests.get(url, headers=headers)
-        self.lock.acquire()
-        try:
-            # result = get_hash(request_data, self.access_token)
-            result = get_hash(request_data, self.access[0])
-            if result.status_code == 401:
-                # Refresh the token and try once more to get the hash
-                # errlogger.error('p%s Refreshing access token %s, refresh token %s at %s', self.pid, self.access[0], self.access[1], time.asctime(time.localtime()))
-                self.access[0], self.access[1] = refresh_access_token(self.access[1])
-                # errlogger.error('p%s After refresh, token %s, refresh token %s', self.pid, self.access[0], self.access[1])
-                result = get_hash(request_data, self.access[0])
-                if result.status_code != 200:
-                    result = None
-            elif result.status_code != 200:
+        access_token, generation = self.tokens.token()
+        result = get_hash(request_data, access_token)
+        if result.status_code == 401:
+            # Refresh the token, unless another process already has, and try once more to get the hash
+            access_token, generation = self.tokens.refresh(generation)
+            result = get_hash(request_data, access_token)
+            if result.status_code != 200:
                 result = None
-        finally:
-            self.lock.release()
-            return result
+        elif result.status_code != 200:
+            result = None
+        return result
 
     ###-------------------Versions-----------------###
 
@@ -107,12 +119,12 @@ class TCIA(Source):
             # result, self.access_token, refresh_token = get_hash(
             #     {'Collection': collection_id}, \
             #     access_token=self.access_token, refresh_token=self.refresh_token)
-            result = self.get_hash({'Collection': collection_id})
+            result = self.get_hash_value({'Collection': collection_id})
         except Exception as exc:
             errlogger.error('Exception %s in src_collection_hash', exc)
             raise Exception('Exception %s in src_collection_hash', exc)
-        if result:
-            return result.content.decode()
+        if result is not None:
+            return result
         else:
             rootlogger.info('get_hash failed for collection %s', collection_id)
             raise Exception('get_hash failed for collection %s', collection_id)
@@ -125,7 +137,9 @@ class TCIA(Source):
     ###-------------------Patients-----------------###
 
     def patients(self, collection):
-        patients = [patient['PatientId'] for patient in get_TCIA_patients_per_collection(collection.collection_id, self.nbia_server)]
+        patients = [patient['PatientId'] for patient in self.cached('getPatient',
+            {'Collection': collection.collection_id, 'server': self.nbia_server},
+            lambda: get_TCIA_patients_per_collection(collection.collection_id, self.nbia_server))]
         return patients
 
         # Return True if the source's object is updated relative to the version in our DB, else
@@ -134,18 +148,26 @@ class TCIA(Source):
 
     def src_patient_hash(self, collection_id, submitter_case_id):
         try:
-            result = self.get_hash({'Collection':collection_id, 'PatientID': submitter_case_id})
+            result = self.get_hash_value({'Collection':collection_id, 'PatientID': submitter_case_id})
         except Exception as exc:
             errlogger.error('Exception %s in src_patient_hash', exc)
             # raise Exception('Exception %s in src_patient_hash', exc)
             return -1
-        if result:
-            return result.content.decode()
+        if result is not None:
+            return result
         else:
             rootlogger.info('get_hash failed for patient %s', submitter_case_id)
             # raise Exception('get_hash failed for patient %s', submitter_case_id)
             return -1
 
+    # Get the hashes of many patients concurrently. Returns a dictionary indexed by submitter_case_id.
+    # Patients whose hash could not be obtained are omitted.
+    def src_patient_hashes_batch(self, collection_id, submitter_case_ids, max_workers):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            hashes = dict(zip(submitter_case_ids, executor.map(
+                lambda submitter_case_id: self.src_patient_hash(collection_id, submitter_case_id), submitter_case_ids)))
+        return {submitter_case_id: hash for submitter_case_id, hash in hashes.items() if hash != -1}
+
     # Get the DOIs of all series in a patient
     def get_patient_dois(self, collection, patient):
         patient_dois = get_patient_dois_tcia(collection, patient)
@@ -166,18 +188,21 @@ class TCIA(Source):
     ###-------------------Studies-----------------###
 
     def studies(self, patient):
-        studies = [study['StudyInstanceUID'] for study in get_TCIA_studies_per_patient(patient.collections[0].collection_id, patient.submitter_case_id, self.nbia_server)]
+        collection_id = patient.collections[0].collection_id
+        studies = [study['StudyInstanceUID'] for study in self.cached('getPatientStudy',
+            {'Collection': collection_id, 'PatientID': patient.submitter_case_id, 'server': self.nbia_server},
+            lambda: get_TCIA_studies_per_patient(collection_id, patient.submitter_case_id, self.nbia_server))]
         return studies
 
 
     def src_study_hash(self, collection_id, study_instance_uid):
         try:
-            result = self.get_hash({'StudyInstanceUID': study_instance_uid})
+            result = self.get_hash_value({'StudyInstanceUID': study_instance_uid})
         except Exception as exc:
             errlogger.error('Exception %s in src_study_hash', exc)
             raise Exception('Exception %s in src_study_hash', exc)
-        if result:
-            return result.content.decode()
+        if result is not None:
+            return result
         else:
             rootlogger.info('get_hash failed for study %s', study_instance_uid)
             raise Exception('get_hash failed for study %s', study_instance_uid)
@@ -186,19 +211,22 @@ class TCIA(Source):
     ###-------------------Series-----------------###
 
     def series(self, study):
-        series = [series['SeriesInstanceUID'] for series in get_TCIA_series_per_study(study.patients[0].collections[0].collection_id, study.patients[0].submitter_case_id, study.study_instance_uid, \
-                                         self.nbia_server)]
+        collection_id = study.patients[0].collections[0].collection_id
+        submitter_case_id = study.patients[0].submitter_case_id
+        series = [series['SeriesInstanceUID'] for series in self.cached('getSeries',
+            {'Collection': collection_id, 'PatientID': submitter_case_id, 'StudyInstanceUID': study.study_instance_uid, 'server': self.nbia_server},
+            lambda: get_TCIA_series_per_study(collection_id, submitter_case_id, study.study_instance_uid, self.nbia_server))]
         return series
 
 
     def src_series_hash(self, series_instance_uid):
         try:
-            result = self.get_hash({'SeriesInstanceUID': series_instance_uid})
+            result = self.get_hash_value({'SeriesInstanceUID': series_instance_uid})
         except Exception as exc:
             errlogger.error('Exception %s in src_series_hash', exc)
             raise Exception('Exception %s in src_series_hash', exc)
-        if result:
-            return result.content.decode()
+        if result is not None:
+            return result
         else:
             rootlogger.info('get_hash failed for series %s', series_instance_uid)
             raise Exception('get_hash failed for series %s', series_instance_uid)
@@ -206,18 +234,23 @@ class TCIA(Source):
     ###-------------------Instance-----------------###
 
     def instances(self, collection, series):
-        instances = [instance['SOPInstanceUID'] for instance in get_TCIA_instance_uids_per_series(collection.collection_id, series.series_instance_uid, self.nbia_server)]
+        instances = [instance['SOPInstanceUID'] for instance in self.cached('getSOPInstanceUIDs',
+            {'Collection': collection.collection_id, 'SeriesInstanceUID': series.series_instance_uid, 'server': self.nbia_server},
+            lambda: get_TCIA_instance_uids_per_series(collection.collection_id, series.series_instance_uid, self.nbia_server))]
         return instances
 
 
     def src_instance_hash(self, sop_instance_uid):
-        try:
+        def fetch():
             result = self.get_instance_hash(sop_instance_uid)
+            return result.content.decode() if result else None
+        try:
+            result = self.cached('getM5HashForImage', {'SOPInstanceUid': sop_instance_uid}, fetch)
         except Exception as exc:
             errlogger.error('Exception %s in src_instance_hash', exc)
             raise Exception('Exception %s in src_instance_hash', exc)
-        if result:
-            return result.content.decode()
+        if result is not None:
+            return result
         else:
             errlogger.info('get_hash failed for instance %s', sop_instance_uid)
             raise Exception('get_hash failed for instance %s', sop_instance_uid)
@@ -231,21 +264,17 @@ class TCIA(Source):
         # # url = "https://public-dev.cancerimagingarchive.net/nbia-api/services/getMD5Hierarchy"
         # url = f"{NBIA_V2_URL}/getM5HashForImage?SOPInstanceUid={sop_instance_uid}"
         # result = requests.get(url, headers=headers)
-        self.lock.acquire()
-        try:
-            # result = get_instance_hash(sop_instance_uid, self.access_token)
-            result = get_instance_hash(sop_instance_uid, self.access[0])
-            if result.status_code == 401:
-                # Refresh the token and try once more to get the hash
-                self.access_token, self.refresh_token = refresh_access_token(self.refresh_token)
-                result = get_instance_hash(sop_instance_uid, self.access_token)
-                if result.status_code != 200:
-                    result = None
-            elif result.status_code != 200:
+        access_token, generation = self.tokens.token()
+        result = get_instance_hash(sop_instance_uid, access_token)
+        if result.status_code == 401:
+            # Refresh the token, unless another process already has, and try once more to get the hash
+            access_token, generation = self.tokens.refresh(generation)
+            result = get_instance_hash(sop_instance_uid, access_token)
+            if result.status_code != 200:
                 result = None
-        finally:
-            self.lock.release()
-            return result
+        elif result.status_code != 200:
+            result = None
+        return result
 
 
 class IDC(Source):
@@ -297,6 +326,12 @@ class IDC(Source):
             raise exc
         return hash
 
+    # Get the hashes of many patients in one query. Returns a dictionary indexed by submitter_case_id.
+    def src_patient_hashes_batch(self, collection_id, submitter_case_ids, max_workers):
+        query = select(IDC_Patient.submitter_case_id, IDC_Patient.hash).where(IDC_Patient.submitter_case_id.in_(submitter_case_ids))
+        hashes = {row.submitter_case_id: row.hash for row in self.sess.execute(query).fetchall()}
+        return {submitter_case_id: hashes.get(submitter_case_id, "") for submitter_case_id in submitter_case_ids}
+
     # Get the DOIs of all series in a patient
     def get_patient_dois(self, collection, patient):
         patient_dois = get_patient_dois_idc(self.sess, collection, patient)
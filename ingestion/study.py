@@ -19,8 +19,8 @@ import time
 from datetime import datetime, timedelta
 import logging
 from uuid import uuid4
-from idc.models import Study, Series
-from ingestion.utilities.utils import accum_sources, get_merkle_hash, is_skipped
+from idc.models import Study, Series, study_series
+from ingestion.utilities.utils import accum_sources, get_merkle_hash, is_skipped, bulk_insert_children
 from ingestion.series import clone_series, build_series, retire_series
 
 from python_settings import settings
@@ -81,38 +81,46 @@ def expand_study(sess, args, all_sources, version, collection, patient, study, d
         retired_objects = [obj for id, obj in idc_objects.items() \
                 if not obj in existing_objects]
 
+    # New series are inserted in bulk after the existing series have been processed
+    timestamp = datetime.utcnow()
+    new_seriess = []
     for series in sorted(new_objects):
-        new_series = Series()
-        new_series.series_instance_uid = series
-        new_series.uuid = str(uuid4())
-        new_series.min_timestamp = datetime.utcnow()
         # new_series.source_doi=analysis_collection_dois[series] \
         #     if series in analysis_collection_dois \
         #     else data_collection_doi_url['doi']
         # new_series.source_url = data_collection_doi_url['url'] \
         #     if not series in analysis_collection_dois else None
         try:
-            new_series.source_doi = dois_urls_licenses[series]['doi']
-            new_series.source_url = dois_urls_licenses[series]['url']
-            new_series.license_url = dois_urls_licenses[series]['license']['license_url']
-            new_series.license_long_name = dois_urls_licenses[series]['license']['license_long_name']
-            new_series.license_short_name = dois_urls_licenses[series]['license']['license_short_name']
+            source_doi = dois_urls_licenses[series]['doi']
+            source_url = dois_urls_licenses[series]['url']
+            license_url = dois_urls_licenses[series]['license']['license_url']
+            license_long_name = dois_urls_licenses[series]['license']['license_long_name']
+            license_short_name = dois_urls_licenses[series]['license']['license_short_name']
         except Exception as exc:
-            errlogger.error(f'No DOI/URL for series {series.series_instance_uid}')
+            errlogger.error(f'No DOI/URL for series {series}')
             return
-        new_series.series_instances = 0
-        new_series.revised = seriess[series]
-        new_series.sources = seriess[series]
-        new_series.hashes = None
-        new_series.max_timestamp = new_series.min_timestamp
-        new_series.init_idc_version=settings.CURRENT_VERSION
-        new_series.rev_idc_version=settings.CURRENT_VERSION
-        new_series.final_idc_version = 0
-        new_series.done=False
-        new_series.is_new=True
-        new_series.expanded=False
-        study.seriess.append(new_series)
-        progresslogger.debug('      p%s:Series %s new', args.pid, new_series.series_instance_uid)
+        new_seriess.append(dict(
+            series_instance_uid=series,
+            uuid=str(uuid4()),
+            min_timestamp=timestamp,
+            source_doi=source_doi,
+            source_url=source_url,
+            license_url=license_url,
+            license_long_name=license_long_name,
+            license_short_name=license_short_name,
+            series_instances=0,
+            revised=seriess[series],
+            sources=seriess[series],
+            hashes=None,
+            max_timestamp=timestamp,
+            init_idc_version=settings.CURRENT_VERSION,
+            rev_idc_version=settings.CURRENT_VERSION,
+            final_idc_version=0,
+            done=False,
+            is_new=True,
+            expanded=False
+        ))
+        progresslogger.debug('      p%s:Series %s new', args.pid, series)
 
     for series in existing_objects:
         idc_hashes = series.hashes
@@ -160,6 +168,7 @@ def expand_study(sess, args, all_sources, version, collection, patient, study, d
         retire_series(args, series)
         study.seriess.remove(series)
 
+    bulk_insert_children(sess, study, 'seriess', Series, study_series, 'study_uuid', 'series_uuid', new_seriess)
     study.expanded = True
     sess.commit()
     return
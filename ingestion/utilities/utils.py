@@ -17,11 +17,16 @@
 import shutil
 import os
 import hashlib
-from base64 import b64decode
+from base64 import b64decode, b64encode
 import logging
 from subprocess import run
+from concurrent.futures import ThreadPoolExecutor
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
 from google.cloud import storage
 from google.api_core.exceptions import Conflict
+from sqlalchemy import insert
 
 from python_settings import settings
 
@@ -37,6 +42,19 @@ def is_skipped(skipped_collections, collection_id):
         skipped = (False, False)
     return skipped
 
+# Insert new children of parent, and the rows that associate them with parent, with one Core
+# statement each rather than through the ORM unit of work. rows is a list of dictionaries of the
+# children's column values, each including 'uuid'. Pending ORM changes are flushed first. The
+# parent's relationship is then expired, so that it is reloaded, including the new children,
+# when next accessed.
+def bulk_insert_children(sess, parent, relationship, child_class, association, parent_column, child_column, rows):
+    sess.flush()
+    if rows:
+        sess.execute(insert(child_class), rows)
+        sess.execute(insert(association), [{parent_column: parent.uuid, child_column: row['uuid']} for row in rows])
+    sess.expire(parent, [relationship])
+
+
 def to_webapp(collection_id):
     return collection_id.lower().replace('-','_').replace(' ','_')
 
@@ -65,10 +83,16 @@ def get_merkle_hash(hashes):
         ""
 
 # Validate that instances were received correctly
-def validate_hashes(args, collection, patient, study, series, hashes):
+# If file_hashes, a dictionary of (md5 hash, size) per file computed when the files were
+# written, is supplied, it is used instead of rereading each file from disk.
+def validate_hashes(args, collection, patient, study, series, hashes, file_hashes=None):
     for instance in hashes:
         instance = instance.split(',')
-        if md5_hasher(f'{args.dicom_dir}/{series.series_instance_uid}/{instance[0]}') != instance[1]:
+        if file_hashes is not None:
+            hash = file_hashes[instance[0]][0] if instance[0] in file_hashes else None
+        else:
+            hash = md5_hasher(f'{args.dicom_dir}/{series.series_instance_uid}/{instance[0]}')
+        if hash != instance[1]:
             errlogger.error("      p%s: Invalid hash for %s/%s/%s/%s", args.pid,
             collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid,\
             instance[0])
@@ -86,38 +110,87 @@ def rollback_copy_to_prestaging_bucket(client, args, series):
             raise
 
 
+# Maximum number of requests in a GCS JSON API batch
+GCS_BATCH_SIZE = 100
+
+# Get the metadata of a list of blobs in batched JSON API requests, rather than a GET per blob.
+# Returns the blobs with their properties populated.
+def get_blobs_metadata(client, bucket, blob_names, batch_size=GCS_BATCH_SIZE):
+    blobs = []
+    for i in range(0, len(blob_names), batch_size):
+        batch_blobs = [bucket.blob(blob_name) for blob_name in blob_names[i:i+batch_size]]
+        # Properties are set on each blob when the batch completes
+        with client.batch():
+            for blob in batch_blobs:
+                blob.reload()
+        blobs.extend(batch_blobs)
+    return blobs
+
+
 def validate_series_in_gcs(args, collection, patient, study, series):
     # client = storage.Client(project=settings.DEV_PROJECT)
-    client = storage.Client()
+    client = get_storage_client(args)
     # blobs_info = get_series_info(storage_client, args.project, args.staging_bucket)
     bucket = client.get_bucket(args.prestaging_tcia_bucket)
+    instance = None
     try:
-        for instance in series.instances:
-            blob = bucket.blob(f'{instance.uuid}.dcm')
-            blob.reload()
+        blobs = get_blobs_metadata(client, bucket, [f'{instance.uuid}.dcm' for instance in series.instances])
+        for instance, blob in zip(series.instances, blobs):
             assert instance.hash == b64decode(blob.md5_hash).hex()
             assert instance.size == blob.size
 
     except Exception as exc:
         rollback_copy_to_prestaging_bucket(client, args, series)
         errlogger.error('p%s: GCS validation failed for %s/%s/%s/%s/%s',
-            args.pid, collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid, instance.sop_instance_uid)
+            args.pid, collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid,
+            instance.sop_instance_uid if instance else '')
         raise exc
 
 
+# One GCS client per process, reused across series. A forked process creates its own.
+_storage_clients = {}
+
+# The HTTP connection pool of the client is sized for the most threads that use it at once,
+# args.upload_threads or args.copy_threads, so that no connection is discarded
+def get_storage_client(args):
+    pid = os.getpid()
+    if pid not in _storage_clients:
+        pool_size = max(args.upload_threads, args.copy_threads)
+        credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+        session = AuthorizedSession(credentials)
+        session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        _storage_clients[pid] = storage.Client(project=project, credentials=credentials, _http=session)
+    return _storage_clients[pid]
+
+
+# Upload a file to a blob. Files larger than chunk_size are sent as chunked resumable uploads
+# so that a failed chunk is retried rather than the whole file. If md5_hash (hex) is supplied,
+# GCS rejects the upload if the received data does not match it.
+def upload_file_to_blob(bucket, file_path, blob_name, chunk_size, md5_hash=None):
+    if os.path.getsize(file_path) > chunk_size:
+        blob = bucket.blob(blob_name, chunk_size=chunk_size)
+    else:
+        blob = bucket.blob(blob_name)
+    if md5_hash:
+        blob.md5_hash = b64encode(bytes.fromhex(md5_hash)).decode()
+    blob.upload_from_filename(file_path)
+    return blob
+
+
 # Copy the series instances downloaded from TCIA/NBIA from disk to the prestaging bucket
+# Instances are uploaded concurrently by args.upload_threads threads sharing the process's GCS client.
 def copy_disk_to_prestaging_bucket(args, series):
-    # Do the copy as a subprocess in order to use the gsutil -m option
     try:
-        # Copy the series to GCS
-        src = "{}/{}/*".format(args.dicom_dir, series.series_instance_uid)
-        dst = "gs://{}/".format(args.prestaging_tcia_bucket)
-        # breakpoint() # Check if -J parameter is still broken
-        result = run(["gsutil", "-m", "-q", "cp", src, dst], check=True)
-        # result = run(["gsutil", "-m", "-q", "cp", "-J", src, dst], check=True)
-        if result.returncode :
-            errlogger.error('p%s: \tcopy_disk_to_prestaging_bucket failed for series %s', args.pid, series.series_instance_uid)
-            raise RuntimeError('p%s: copy_disk_to_prestaging_bucket failed for series %s', args.pid, series.series_instance_uid)
+        client = get_storage_client(args)
+        bucket = client.bucket(args.prestaging_tcia_bucket)
+        hashes = {f'{instance.uuid}.dcm': instance.hash for instance in series.instances}
+        src = "{}/{}".format(args.dicom_dir, series.series_instance_uid)
+        with ThreadPoolExecutor(max_workers=args.upload_threads) as executor:
+            futures = [executor.submit(upload_file_to_blob, bucket, f'{src}/{dcm}', dcm, args.upload_chunk_size, hashes.get(dcm)) \
+                       for dcm in os.listdir(src)]
+            # Raises the exception of the first failed upload, if any
+            for future in futures:
+                future.result()
         # rootlogger.debug("p%s: Uploaded instances to GCS", args.pid)
     except Exception as exc:
         errlogger.error("\tp%s: Copy to prestage bucket failed for series %s", args.pid, series.series_instance_uid)
@@ -171,18 +244,19 @@ def copy_disk_to_gcs(args, collection, patient, study, series):
 
 # Copy an instance from a source bucket to a destination bucket. Currently used when ingesting IDC sourced data
 # which is placed in some bucket after preparation
-def copy_gcs_to_gcs(args, client, dst_bucket_name, instance, gcs_url):
+# Does not touch the DB, so may be called concurrently from multiple threads sharing a client.
+def copy_gcs_to_gcs(args, client, dst_bucket_name, dst_blob_name, gcs_url):
     # storage_client = args.client
     idc_src_bucket = client.bucket(gcs_url.split('gs://')[1].split('/',1)[0])
     blob_id = gcs_url.split('gs://')[1].split('/',1)[1]
     dst_bucket = client.bucket(dst_bucket_name)
     src_blob = idc_src_bucket.blob(blob_id)
-    dst_blob = dst_bucket.blob(f'{instance.uuid}.dcm')
+    dst_blob = dst_bucket.blob(dst_blob_name)
     token, bytes_rewritten, total_bytes = dst_blob.rewrite(src_blob)
     while token:
         debuglogger.debug('******p%s: Rewrite bytes_rewritten %s, total_bytes %s', args.pid, bytes_rewritten, total_bytes)
         token, bytes_rewritten, total_bytes = dst_blob.rewrite(src_blob, token=token)
-    dst_blob.reload()
+    # The final rewrite response includes the metadata of the new blob, so no reload is needed
     return dst_blob.size, b64decode(dst_blob.md5_hash).hex()
 
 
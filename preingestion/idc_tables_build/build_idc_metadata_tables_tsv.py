@@ -17,14 +17,17 @@
 # Adds/replaces data to the idc_collection/_patient/_study/_series/_instance DB tables.
 # Metadata is extracted from a TSV file having columns Filename, "SOP Instance UID",
 # "Patient ID", "Clinical Trial Protocol ID", "Study Instance UID", "Series Instance UID".
-# !!! The table should also probably include columns "doi", and "third_party"
-# !!! This script is currently broken because it does not deal with the "doi" and "third_party"
-# !!! attributes.
+# The "doi" and "third_party" of all the series in the manifest are given by the --wiki_doi and
+# --third_party parameters.
 # "Clinical Trial Protocol ID" is considered to be the collection ID.
 #
 # The expectation is that the TSV file will contain metadata of non-TCIA instances that is to
 # to be in the next IDC version. The  idc_collection/_patient/_study/_series/_instance tables
 # are always a snapshot of IDC sourced data.
+#
+# The manifest is read once and grouped in memory by UID, the hash and size of every instance are
+# obtained from a single listing of the source bucket, and each table is then written with batched
+# INSERT ... ON CONFLICT upserts, parents before children.
 import io
 import os
 import sys
@@ -38,90 +41,62 @@ from utilities.logging_config import successlogger, errlogger, progresslogger
 from base64 import b64decode
 from python_settings import settings
 
+import psycopg2.extras
 from sqlalchemy.orm import Session
 from sqlalchemy import create_engine, update
 from google.cloud import storage
 
-def build_instance(client, args, sess, series, row):
-    instance_id = row['SOP Instance UID'].strip()
-    try:
-        instance = next(instance for instance in series.instances if instance.sop_instance_uid == instance_id)
-    except StopIteration:
-        instance = IDC_Instance()
-        instance.sop_instance_uid = instance_id
-        series.instances.append(instance)
-        successlogger.info('\t\t\t\tInstance %s', instance_id)
-
-    blob_name = f'{args.src_path}/{row["Filename"].strip()}' if args.src_path else \
-        f'{row["Filename"].strip().split("/", 1)[1]}'
-    instance.url = f'gs://{args.src_bucket}/{blob_name}'
-    bucket = client.bucket(args.src_bucket)
-    blob = bucket.blob(blob_name)
-    blob.reload()
-    new_hash = b64decode(blob.md5_hash).hex()
-    if instance.hash != new_hash:
-        instance.hash = new_hash
-        instance.idc_version = args.version
-    progresslogger.info('\t\t\t\tInstance %s', instance_id)
-
-
-def build_series(client, args, sess, study, row):
-    series_id = row['Series Instance UID'].strip()
-    try:
-        series = next(series for series in study.seriess if series.series_instance_uid == series_id)
-    except StopIteration:
-        series = IDC_Series()
-        series.series_instance_uid = series_id
-        study.seriess.append(series)
-        successlogger.info('\t\t\tSeries %s', series_id)
-    # Always set/update the wiki_doi in case it has changed
-    series.wiki_doi = doi
-    series.third_party = args.third_party
-    build_instance(client, args, sess, series, row)
-    return
-
-
-def build_study(client, args, sess, patient, row):
-    study_id = row['Study Instance UID'].strip()
-    try:
-        study = next(study for study in patient.studies if study.study_instance_uid == study_id)
-    except StopIteration:
-        study = IDC_Study()
-        study.study_instance_uid = study_id
-        patient.studies.append(study)
-        successlogger.info('\t\tStudy %s', study_id)
-    build_series(client, args, sess, study, row)
-    return
-
-
-def build_patient(client, args, sess, collection, row):
-    patient_id = row['Patient ID'].strip()
-    try:
-        patient = next(patient for patient in collection.patients if patient.submitter_case_id == patient_id)
-    except StopIteration:
-        patient = IDC_Patient()
-        patient.submitter_case_id = patient_id
-        collection.patients.append(patient)
-        successlogger.info('\tPatient %s', patient_id)
-    build_study(client, args, sess, patient, row)
-    return
-
-
-def build_collection(client, args, sess,row, skips):
-    collection_id = row['Clinical Trial Protocol ID'].strip()
-    if not collection_id in skips:
+PAGE_SIZE = 10000
+
+
+# Group the rows of the manifest by UID. Returns dictionaries that map each object to its parent,
+# and each instance to its blob name.
+def load_manifest(args, tsv, skips):
+    patients = {}
+    studies = {}
+    seriess = {}
+    instances = {}
+    reader = csv.DictReader(tsv, delimiter='\t')
+    for row in reader:
+        collection_id = row['Clinical Trial Protocol ID'].strip()
+        if collection_id in skips:
+            continue
         if collection_id=='NCT00047385':
             collection_id = 'NLST'
-        # Get the collection from the DB
-        collection = sess.query(IDC_Collection).filter(IDC_Collection.collection_id == collection_id).first()
-        if not collection:
-            # The collection is not currently in the DB, so add it
-            collection = IDC_Collection()
-            collection.collection_id = collection_id
-            sess.add(collection)
-            successlogger.info('Collection %s',collection_id)
-        build_patient(client, args, sess, collection, row)
-        return
+        patient_id = row['Patient ID'].strip()
+        study_id = row['Study Instance UID'].strip()
+        series_id = row['Series Instance UID'].strip()
+        instance_id = row['SOP Instance UID'].strip()
+        blob_name = f'{args.src_path}/{row["Filename"].strip()}' if args.src_path else \
+            f'{row["Filename"].strip().split("/", 1)[1]}'
+        patients[patient_id] = collection_id
+        studies[study_id] = patient_id
+        seriess[series_id] = study_id
+        instances[instance_id] = (series_id, blob_name)
+    progresslogger.info('Manifest: %s rows, %s patients, %s studies, %s series, %s instances', reader.line_num-1,
+                        len(patients), len(studies), len(seriess), len(instances))
+    return patients, studies, seriess, instances
+
+
+# Get the (hex md5 hash, size) of each of blob_names, listing the blobs under src_path in a single
+# listing. Other blobs under src_path are ignored. A blob without an MD5 hash, e.g. a composite
+# object, is logged and left out, and so is reported as not found.
+def get_blob_metadata(client, args, blob_names):
+    prefix = f'{args.src_path}/' if args.src_path else None
+    blobs = client.list_blobs(args.src_bucket, prefix=prefix, fields='items(name,md5Hash,size),nextPageToken')
+    metadata = {}
+    for blob in blobs:
+        if blob.name not in blob_names:
+            continue
+        if blob.md5_hash is None:
+            errlogger.error('Blob %s in %s has no MD5 hash', blob.name, args.src_bucket)
+            continue
+        metadata[blob.name] = (b64decode(blob.md5_hash).hex(), blob.size)
+    return metadata
+
+
+def upsert(cur, query, values):
+    psycopg2.extras.execute_values(cur, query, values, template=None, page_size=PAGE_SIZE)
 
 
 def prebuild(args):
@@ -139,13 +114,48 @@ def prebuild(args):
         result = bucket.blob(f'{args.tsv_blob_path}').download_as_text()
         with io.StringIO(result) as tsv:
         # with open(args.tsv_file, newline='', ) as tsv:
-            reader = csv.DictReader(tsv, delimiter='\t')
-            rows = len(list(reader))
-            tsv.seek(0)
-            reader = csv.DictReader(tsv, delimiter='\t')
-            for row in reader:
-                # print(f'{reader.line_num-1}/{rows}: {row}')
-                build_collection(client, args, sess, row, skips)
+            patients, studies, seriess, instances = load_manifest(args, tsv, skips)
+
+        blob_metadata = get_blob_metadata(client, args, {blob_name for _, blob_name in instances.values()})
+        progresslogger.info('Listed %s blobs in %s', len(blob_metadata), args.src_bucket)
+
+        cur = sess.connection().connection.cursor()
+        upsert(cur, """
+            INSERT INTO idc_collection (collection_id) VALUES %s
+            ON CONFLICT (collection_id) DO NOTHING
+        """, [(collection_id,) for collection_id in set(patients.values())])
+        upsert(cur, """
+            INSERT INTO idc_patient (submitter_case_id, collection_id) VALUES %s
+            ON CONFLICT (submitter_case_id) DO UPDATE SET collection_id = EXCLUDED.collection_id
+        """, list(patients.items()))
+        upsert(cur, """
+            INSERT INTO idc_study (study_instance_uid, submitter_case_id) VALUES %s
+            ON CONFLICT (study_instance_uid) DO UPDATE SET submitter_case_id = EXCLUDED.submitter_case_id
+        """, list(studies.items()))
+        # Always set/update the wiki_doi in case it has changed
+        upsert(cur, """
+            INSERT INTO idc_series (series_instance_uid, study_instance_uid, wiki_doi, third_party) VALUES %s
+            ON CONFLICT (series_instance_uid) DO UPDATE SET study_instance_uid = EXCLUDED.study_instance_uid,
+                wiki_doi = EXCLUDED.wiki_doi, third_party = EXCLUDED.third_party
+        """, [(series_id, study_id, args.wiki_doi, args.third_party) for series_id, study_id in seriess.items()])
+
+        values = []
+        for instance_id, (series_id, blob_name) in instances.items():
+            if blob_name not in blob_metadata:
+                errlogger.error('Instance %s: blob %s not found in %s', instance_id, blob_name, args.src_bucket)
+                continue
+            hash, size = blob_metadata[blob_name]
+            values.append((instance_id, series_id, hash, f'gs://{args.src_bucket}/{blob_name}', size, args.version))
+        # idc_version is only changed if the instance is new or its hash changed
+        upsert(cur, """
+            INSERT INTO idc_instance (sop_instance_uid, series_instance_uid, hash, gcs_url, size, idc_version) VALUES %s
+            ON CONFLICT (sop_instance_uid) DO UPDATE SET series_instance_uid = EXCLUDED.series_instance_uid,
+                gcs_url = EXCLUDED.gcs_url, size = EXCLUDED.size, hash = EXCLUDED.hash,
+                idc_version = CASE WHEN idc_instance.hash IS DISTINCT FROM EXCLUDED.hash
+                    THEN EXCLUDED.idc_version ELSE idc_instance.idc_version END
+        """, values)
+        successlogger.info('Upserted %s collections, %s patients, %s studies, %s series, %s instances',
+            len(set(patients.values())), len(patients), len(studies), len(seriess), len(values))
         # gen_hashes(args, sess)
         sess.commit()
     return
@@ -166,6 +176,8 @@ if __name__ == '__main__':
                              "Note that this value is interpreted as a list.")
     parser.add_argument('--skipped_collections', type=str, default=['HTAN-Vanderbilt'], nargs='*', \
       help='A list of additional collections that should not be ingested.')
+    parser.add_argument('--wiki_doi', default='', help='Source DOI of the wiki of the series in the manifest')
+    parser.add_argument('--third_party', type=bool, default=False, help='True if the series are third party analysis results')
     # parser.add_argument('--log_dir', default=f'{settings.LOGGING_BASE}/{settings.BASE_NAME}')
 
     args = parser.parse_args()
@@ -13,7 +13,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-# Update hierarchical hashes in the WSI tables
+# Update hierarchical hashes in the IDC tables.
+# Hashes are computed bottom up in the DB, one statement per level, rather than by walking the
+# hierarchy through the ORM. By default, only the series having instances added or revised in
+# --version, and their ancestors, are rehashed. Use --all after deleting instances.
 import io
 import os
 import sys
@@ -28,38 +31,82 @@ from base64 import b64decode
 from python_settings import settings
 
 from sqlalchemy.orm import Session
-from sqlalchemy import create_engine, update
+from sqlalchemy import create_engine, update, text
 from google.cloud import storage
 
+# Each level of the hierarchy: (child table, parent table, parent key, parent's own parent key)
+LEVELS = [
+    ('idc_instance', 'idc_series', 'series_instance_uid', 'study_instance_uid'),
+    ('idc_series', 'idc_study', 'study_instance_uid', 'submitter_case_id'),
+    ('idc_study', 'idc_patient', 'submitter_case_id', 'collection_id'),
+    ('idc_patient', 'idc_collection', 'collection_id', None),
+]
+
+
+# Create a temporary table, dirty_<table>, of the keys of each parent whose hash must be recomputed.
+# It is seeded with the series having instances added or revised in this version, or no hash. Each level
+# then adds the parents of the objects whose hash it changed.
+def create_dirty_tables(sess, args):
+    for child, parent, key, parent_key in LEVELS:
+        sess.execute(text(f'CREATE TEMP TABLE dirty_{parent} ({key} VARCHAR PRIMARY KEY) ON COMMIT DROP'))
+    sess.execute(text("""
+        INSERT INTO dirty_idc_series
+        SELECT DISTINCT series_instance_uid FROM idc_instance WHERE idc_version = :version
+        UNION
+        SELECT series_instance_uid FROM idc_series WHERE hash IS NULL
+    """), {'version': args.version})
+
+
+# Compute the hashes of one level from those of its children in a single statement. The Merkle
+# hash is the md5 of the concatenation of the sorted child hashes, as computed by get_merkle_hash.
+# COLLATE "C" makes the order that of a Python sort. Only rows whose hash changes are written.
+# Returns the number of hashes that changed.
+def gen_level_hashes(sess, args, child, parent, key, parent_key):
+    where = '' if args.all else f'WHERE c.{key} IN (SELECT {key} FROM dirty_{parent})'
+    returning = parent_key if parent_key else key
+    next_level = next((p for c, p, k, pk in LEVELS if c == parent), None)
+    if next_level and not args.all:
+        insert = f', dirtied AS (INSERT INTO dirty_{next_level} SELECT DISTINCT {parent_key} FROM updated ON CONFLICT DO NOTHING)'
+    else:
+        insert = ''
+    result = sess.execute(text(f"""
+        WITH hashes AS (
+          SELECT
+            c.{key},
+            md5(STRING_AGG(c.hash, '' ORDER BY c.hash COLLATE "C" ASC)) AS hash
+          FROM {child} AS c
+          {where}
+          GROUP BY c.{key}
+        ), updated AS (
+          UPDATE {parent} AS p
+          SET hash = hashes.hash
+          FROM hashes
+          WHERE p.{key} = hashes.{key} AND p.hash IS DISTINCT FROM hashes.hash
+          RETURNING p.{returning}
+        ){insert}
+        SELECT count(*) FROM updated
+    """))
+    return result.scalar()
+
+
 def gen_hashes(args):
     sql_uri = f'postgresql+psycopg2://{settings.CLOUD_USERNAME}:{settings.CLOUD_PASSWORD}@{settings.CLOUD_HOST}:{settings.CLOUD_PORT}/{settings.CLOUD_DATABASE}'
     # sql_engine = create_engine(sql_uri, echo=True)
     sql_engine = create_engine(sql_uri)
 
     with Session(sql_engine) as sess:
-        collections = sess.query(IDC_Collection).all()
-        for collection in collections:
-            for patient in collection.patients:
-                for study in patient.studies:
-                    for series in study.seriess:
-                        hashes = [instance.hash for instance in series.instances]
-                        series.hash = get_merkle_hash(hashes)
-                        progresslogger.info('\t\t\tseries hash %s', series.series_instance_uid)
-                    hashes = [series.hash for series in study.seriess]
-                    study.hash = get_merkle_hash(hashes)
-                    progresslogger.info('\t\tstudy hash %s', study.study_instance_uid)
-                hashes = [study.hash for study in patient.studies]
-                patient.hash = get_merkle_hash(hashes)
-                progresslogger.info('\tpatient hash %s', patient.submitter_case_id)
-            hashes = [patient.hash for patient in collection.patients]
-            collection.hash = get_merkle_hash(hashes)
-            progresslogger.info('Collection hash %s', collection.collection_id)\
-
+        if not args.all:
+            create_dirty_tables(sess, args)
+        for child, parent, key, parent_key in LEVELS:
+            changed = gen_level_hashes(sess, args, child, parent, key, parent_key)
+            progresslogger.info('%s: %s hashes changed', parent, changed)
         sess.commit()
 
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--version', default=settings.CURRENT_VERSION)
+    parser.add_argument('--all', type=bool, default=False, help='Rehash all objects rather than only those that changed')
 
     args = parser.parse_args()
     print("{}".format(args), file=sys.stdout)
@@ -0,0 +1,149 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Regenerate hashes.all_sources of only the series that changed and their ancestors.
+# regen_allsources_hashes.py re-aggregates the entire hierarchy. Here, the changed series are
+# either given by --series_uuids, or are those series that were revised in --version or that
+# have instances revised in --version. Hashes are then recomputed a level at a time, bottom up:
+# each level is a single statement that rehashes its dirty objects and marks the parents of those
+# whose hash changed as dirty in the next level. Each level is committed separately so that locks
+# are only held on the rows of the affected subtrees, and only for the duration of that level.
+# The dirty_<level> tables are temporary tables, which only exist in the DB session that created
+# them, so all the levels are run on one connection, and the tables are dropped at the end.
+#
+# As in regen_allsources_hashes.py, a series hash is the hash of its instance hashes, and the hash
+# of a higher level object is the hash of its children's hashes.all_sources.
+
+import argparse
+import time
+
+import settings as etl_settings
+from python_settings import settings
+settings.configure(etl_settings)
+from utilities.logging_config import successlogger, progresslogger, errlogger
+
+from sqlalchemy import create_engine, text
+
+
+# Each level of the hierarchy, bottom up:
+# (parent table, parent key type, association table, parent column, child column, child table, child hash)
+LEVELS = [
+    ('series', 'VARCHAR', 'series_instance', 'series_uuid', 'instance_uuid', 'instance', 'c.hash'),
+    ('study', 'VARCHAR', 'study_series', 'study_uuid', 'series_uuid', 'series', '(c.hashes).all_sources'),
+    ('patient', 'VARCHAR', 'patient_study', 'patient_uuid', 'study_uuid', 'study', '(c.hashes).all_sources'),
+    ('collection', 'VARCHAR', 'collection_patient', 'collection_uuid', 'patient_uuid', 'patient', '(c.hashes).all_sources'),
+    ('version', 'INTEGER', 'version_collection', 'version', 'collection_uuid', 'collection', '(c.hashes).all_sources'),
+]
+
+
+def primary_key(table):
+    return 'version' if table == 'version' else 'uuid'
+
+
+def create_dirty_tables(conn, args):
+    for parent, key_type, *_ in LEVELS:
+        conn.execute(text(f'CREATE TEMP TABLE dirty_{parent} (id {key_type} PRIMARY KEY)'))
+    if args.series_uuids:
+        conn.execute(text("INSERT INTO dirty_series SELECT DISTINCT unnest(CAST(:uuids AS VARCHAR[]))"),
+                     {'uuids': args.series_uuids})
+    else:
+        conn.execute(text("""
+            INSERT INTO dirty_series
+            SELECT uuid FROM series WHERE rev_idc_version = :version
+            UNION
+            SELECT si.series_uuid
+            FROM series_instance AS si
+            JOIN instance AS i
+            ON si.instance_uuid = i.uuid
+            WHERE i.rev_idc_version = :version
+        """), {'version': args.version})
+    conn.commit()
+
+
+def drop_dirty_tables(conn):
+    for parent, *_ in LEVELS:
+        conn.execute(text(f'DROP TABLE IF EXISTS dirty_{parent}'))
+    conn.commit()
+
+
+# Rehash the dirty objects of one level. The Merkle hash is the md5 of the concatenation of the
+# sorted child hashes, as computed by get_merkle_hash. COLLATE "C" makes the order that of a Python
+# sort. Returns the number of hashes that changed.
+def regen_level_hashes(conn, level, next_level):
+    parent, key_type, association, parent_column, child_column, child, child_hash = level
+    if next_level:
+        next_parent, _, next_association, next_parent_column, next_child_column, _, _ = next_level
+        dirtied = f"""
+        , dirtied AS (
+          INSERT INTO dirty_{next_parent}
+          SELECT DISTINCT n.{next_parent_column}
+          FROM {next_association} AS n
+          JOIN updated
+          ON n.{next_child_column} = updated.id
+          ON CONFLICT DO NOTHING
+        )"""
+    else:
+        dirtied = ''
+    result = conn.execute(text(f"""
+        WITH merkle AS (
+          SELECT
+            a.{parent_column} AS id,
+            md5(STRING_AGG({child_hash}, '' ORDER BY {child_hash} COLLATE "C" ASC)) AS hash
+          FROM {association} AS a
+          JOIN {child} AS c
+          ON a.{child_column} = c.{primary_key(child)}
+          WHERE a.{parent_column} IN (SELECT id FROM dirty_{parent})
+          GROUP BY a.{parent_column}
+        ), updated AS (
+          UPDATE {parent} AS p
+          SET hashes.all_sources = merkle.hash
+          FROM merkle
+          WHERE p.{primary_key(parent)} = merkle.id AND (p.hashes).all_sources IS DISTINCT FROM merkle.hash
+          RETURNING p.{primary_key(parent)} AS id
+        ){dirtied}
+        SELECT count(*) FROM updated
+    """))
+    changed = result.scalar()
+    conn.commit()
+    return changed
+
+
+def regen_dirty_hashes(args):
+    sql_uri = f'postgresql+psycopg2://{settings.CLOUD_USERNAME}:{settings.CLOUD_PASSWORD}@{settings.CLOUD_HOST}:{settings.CLOUD_PORT}/{settings.CLOUD_DATABASE}'
+    sql_engine = create_engine(sql_uri)
+
+    with sql_engine.connect() as conn:
+        create_dirty_tables(conn, args)
+        try:
+            for index, level in enumerate(LEVELS):
+                begin = time.time()
+                dirty = conn.execute(text(f'SELECT count(*) FROM dirty_{level[0]}')).scalar()
+                next_level = LEVELS[index+1] if index+1 < len(LEVELS) else None
+                changed = regen_level_hashes(conn, level, next_level)
+                successlogger.info('%s: %s dirty, %s hashes changed, in %s', level[0], dirty, changed, time.time() - begin)
+        finally:
+            conn.rollback()
+            drop_dirty_tables(conn)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--version', default=settings.CURRENT_VERSION, help='Rehash series revised, or having instances revised, in this version')
+    parser.add_argument('--series_uuids', default=[], nargs='*', help='Rehash only these series (and their ancestors)')
+    args = parser.parse_args()
+    print("{}".format(args))
+
+    regen_dirty_hashes(args)
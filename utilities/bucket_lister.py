@@ -0,0 +1,166 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Concurrent listing of a bucket. Our blob names are <uuid>.dcm, so the keyspace is split at the
+# hex prefixes of length PREFIX_LENGTH into shards, which are listed by THREADS threads at once.
+# Each shard is a [start_offset, end_offset) range of names, and the first and last shards are open
+# ended, so that blobs having any other name are listed as well.
+#
+#   for page in list_blob_pages(client, args.src_bucket, page_size=args.batch):
+#       task_queue.put(([blob.name for blob in page], n))
+#
+# Pages are yielded as they arrive from the shards, so that workers can start on the first pages
+# while the rest of the bucket is being listed. If ordered, pages are yielded in blob name order,
+# as a single list_blobs() would: THREADS shards are listed at once, and the pages of the first of
+# them are yielded as they arrive, while each of the others queues at most SHARD_QUEUED_PAGES pages.
+
+import time
+import queue
+import threading
+from itertools import product
+from collections import deque
+
+from utilities.metrics import metrics
+
+PREFIX_LENGTH = 2
+THREADS = 16
+# Number of pages that may be waiting for the consumer before the listing threads block
+QUEUED_PAGES = 64
+# Number of pages of each shard that may be waiting for the consumer, when ordered
+SHARD_QUEUED_PAGES = 4
+
+
+# Return the [start, end) name ranges, None being unbounded, that together cover all blob names
+def shard_ranges(prefix_length=PREFIX_LENGTH):
+    boundaries = [''.join(digits) for digits in product('0123456789abcdef', repeat=prefix_length)]
+    return list(zip([None] + boundaries, boundaries + [None]))
+
+
+def _shard_pages(client, bucket_name, start, end, page_size, kwargs):
+    begin = time.time()
+    iterator = client.list_blobs(bucket_name, start_offset=start, end_offset=end, page_size=page_size, **kwargs)
+    for page in iterator.pages:
+        blobs = list(page)
+        if blobs:
+            metrics.count('gcs.list.blobs', len(blobs))
+            yield blobs
+    metrics.observe('gcs.list.shard', time.time() - begin)
+
+
+# Yield lists of the blobs in a bucket. kwargs, e.g. versions or fields, are passed to list_blobs().
+def list_blob_pages(client, bucket_name, page_size=1000, ordered=False, prefix_length=PREFIX_LENGTH, threads=THREADS, **kwargs):
+    shards = shard_ranges(prefix_length)
+    if ordered:
+        yield from _ordered_pages(client, bucket_name, shards, page_size, threads, kwargs)
+    else:
+        yield from _unordered_pages(client, bucket_name, shards, page_size, threads, kwargs)
+
+
+def _ordered_pages(client, bucket_name, shards, page_size, threads, kwargs):
+    stopped = threading.Event()
+
+    def list_shard(shard, pages):
+        try:
+            for page in _shard_pages(client, bucket_name, *shard, page_size, kwargs):
+                if stopped.is_set():
+                    break
+                pages.put(page)
+        except Exception as exc:
+            pages.put(exc)
+        finally:
+            pages.put('DONE')
+
+    # Each shard is listed by a daemon thread into its own queue, so that a consumer that stops early
+    # does not wait for it
+    def start(shard):
+        pages = queue.Queue(SHARD_QUEUED_PAGES)
+        lister = threading.Thread(target=list_shard, args=(shard, pages), daemon=True)
+        lister.start()
+        return lister, pages
+
+    # Keep `threads` shards in progress, and yield the pages of each when those before it have been yielded
+    shards = iter(shards)
+    listing = deque(start(shard) for _, shard in zip(range(threads), shards))
+    try:
+        while listing:
+            _, pages = listing[0]
+            while True:
+                page = pages.get()
+                if isinstance(page, str):
+                    break
+                elif isinstance(page, Exception):
+                    raise page
+                yield page
+            listing.popleft()
+            shard = next(shards, None)
+            if shard:
+                listing.append(start(shard))
+    finally:
+        stopped.set()
+        # Unblock any thread waiting to queue a page
+        for lister, pages in listing:
+            while lister.is_alive():
+                try:
+                    pages.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+
+def _unordered_pages(client, bucket_name, shards, page_size, threads, kwargs):
+    todo = queue.Queue()
+    for shard in shards:
+        todo.put(shard)
+    pages = queue.Queue(QUEUED_PAGES)
+    stopped = threading.Event()
+
+    def list_shards():
+        try:
+            while not stopped.is_set():
+                try:
+                    shard = todo.get_nowait()
+                except queue.Empty:
+                    break
+                for page in _shard_pages(client, bucket_name, *shard, page_size, kwargs):
+                    pages.put(page)
+                    if stopped.is_set():
+                        break
+        except Exception as exc:
+            pages.put(exc)
+        finally:
+            pages.put('DONE')
+
+    # The threads are daemons, so that a consumer that stops early does not wait for them
+    listers = [threading.Thread(target=list_shards, daemon=True) for _ in range(min(threads, len(shards)))]
+    for lister in listers:
+        lister.start()
+    try:
+        running = len(listers)
+        while running:
+            page = pages.get()
+            if isinstance(page, str):
+                running -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield page
+    finally:
+        stopped.set()
+        # Unblock any thread waiting to queue a page
+        while any(lister.is_alive() for lister in listers):
+            try:
+                pages.get(timeout=0.1)
+            except queue.Empty:
+                pass
@@ -0,0 +1,183 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Bulk copy of the blobs of a version, from one bucket to another, as a Storage Transfer Service
+# job rather than blob by blob from this VM. The blobs to copy are written to a manifest, a CSV
+# file of blob names, which is uploaded to a bucket and drives a one-time transfer job:
+#
+#   manifests = ManifestWriter(f'{settings.LOG_DIR}/manifests')
+#   for row in rows:
+#       manifests.add(row.src_bucket, row.dst_bucket, row.blob_name)
+#   bulk_copy(args, manifests.close(), successlogger, success_checkpoints(successlogger))
+#
+# With executor 'local', the manifests are instead processed by this VM, using the batched copy of
+# utilities/gcs_batch, e.g. to test a tool against a GCS emulator. Each (src, dst) bucket pair that
+# has been copied is logged to the successlogger and added to the tool's CheckpointStore, so that a
+# rerun skips it.
+
+import os
+import csv
+import time
+import logging
+
+from google.cloud import storage
+
+from utilities.gcs_batch import copy_blobs
+from utilities.metrics import metrics
+
+progresslogger = logging.getLogger('root.progress')
+errlogger = logging.getLogger('root.err')
+
+EXECUTORS = ('sts', 'local')
+# Number of blob names per copy_blobs() call of the local executor
+LOCAL_BATCH = 1000
+
+
+# Write one manifest file per (src_bucket, dst_bucket) pair, a row at a time, so that the blob
+# names are not held in memory
+class ManifestWriter:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.files = {}
+        self.counts = {}
+
+    def add(self, src_bucket, dst_bucket, blob_name):
+        pair = (src_bucket, dst_bucket)
+        if pair not in self.files:
+            f = open(os.path.join(self.directory, f'{src_bucket}__{dst_bucket}.csv'), 'w', newline='')
+            self.files[pair] = (f, csv.writer(f))
+            self.counts[pair] = 0
+        self.files[pair][1].writerow([blob_name])
+        self.counts[pair] += 1
+
+    # Close the files and return a dict from each (src_bucket, dst_bucket) to its manifest path
+    def close(self):
+        manifests = {}
+        for pair, (f, _) in self.files.items():
+            f.close()
+            manifests[pair] = f.name
+            progresslogger.info('Manifest %s: %s blobs', f.name, self.counts[pair])
+        return manifests
+
+
+def read_manifest(path):
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if row:
+                yield row[0]
+
+
+def upload_manifest(client, path, manifest_bucket):
+    # Manifests of different runs must not overwrite each other
+    blob = client.bucket(manifest_bucket).blob(f'manifests/{time.strftime("%Y%m%d-%H%M%S")}/{os.path.basename(path)}')
+    blob.upload_from_filename(path, content_type='text/csv')
+    return f'gs://{manifest_bucket}/{blob.name}'
+
+
+# Create and run a one-time transfer job copying the blobs in a manifest, and wait for it to
+# complete. Returns the counters of the transfer operation.
+def run_transfer_job(project, src_bucket, dst_bucket, manifest_url, poll_interval=30):
+    # Only needed by the sts executor
+    from google.cloud import storage_transfer
+
+    client = storage_transfer.StorageTransferServiceClient()
+    job = client.create_transfer_job({
+        'transfer_job': {
+            'project_id': project,
+            'description': f'Copy {manifest_url} from {src_bucket} to {dst_bucket}',
+            'status': storage_transfer.TransferJob.Status.ENABLED,
+            'transfer_spec': {
+                'gcs_data_source': {'bucket_name': src_bucket},
+                'gcs_data_sink': {'bucket_name': dst_bucket},
+                'transfer_manifest': {'location': manifest_url},
+                # Blobs already copied by a previous run are skipped
+                'transfer_options': {
+                    'overwrite_when': storage_transfer.TransferOptions.OverwriteWhen.DIFFERENT
+                },
+            },
+        }
+    })
+    progresslogger.info('Created transfer job %s', job.name)
+    operation = client.run_transfer_job({'job_name': job.name, 'project_id': project})
+    while not operation.done():
+        time.sleep(poll_interval)
+        counters = operation.metadata.counters if operation.metadata else None
+        if counters:
+            progresslogger.info('%s: %s blobs, %s bytes copied', job.name, counters.objects_copied_to_sink,
+                                counters.bytes_copied_to_sink)
+    operation.result()
+    return operation.metadata.counters
+
+
+def sts_copy(args, client, src_bucket, dst_bucket, manifest):
+    manifest_url = upload_manifest(client, manifest, args.manifest_bucket)
+    counters = run_transfer_job(args.transfer_project, src_bucket, dst_bucket, manifest_url)
+    metrics.count('gcs.copy.blobs', counters.objects_copied_to_sink)
+    metrics.bytes('gcs.copy', counters.bytes_copied_to_sink)
+    if counters.objects_from_source_failed:
+        errlogger.error('Transfer %s to %s: %s blobs failed', src_bucket, dst_bucket, counters.objects_from_source_failed)
+        return False
+    progresslogger.info('Transfer %s to %s: %s blobs copied, %s skipped', src_bucket, dst_bucket,
+                        counters.objects_copied_to_sink, counters.objects_from_source_skipped_by_sync)
+    return True
+
+
+# Stand-in for the transfer service: copy the blobs in the manifest from this process
+def local_copy(args, client, src_bucket, dst_bucket, manifest):
+    copied = 0
+    failures = 0
+
+    def copy_batch(blob_names):
+        done, failed = copy_blobs(client, src_bucket, dst_bucket, blob_names)
+        for blob_name, exc in failed:
+            errlogger.error('%s/%s copy failed\n   %s', src_bucket, blob_name, exc)
+        return len(done), len(failed)
+
+    blob_names = []
+    for blob_name in read_manifest(manifest):
+        blob_names.append(blob_name)
+        if len(blob_names) == LOCAL_BATCH:
+            done, failed = copy_batch(blob_names)
+            copied, failures = copied + done, failures + failed
+            blob_names = []
+    if blob_names:
+        done, failed = copy_batch(blob_names)
+        copied, failures = copied + done, failures + failed
+    progresslogger.info('Local copy %s to %s: %s blobs copied, %s failed', src_bucket, dst_bucket, copied, failures)
+    return not failures
+
+
+# Copy the blobs in each manifest, a dict from (src_bucket, dst_bucket) to a manifest path, using
+# args.executor. The sts executor also needs args.manifest_bucket and args.transfer_project. dones
+# is the CheckpointStore of the tool, in which each pair is recorded as 'src->dst'.
+def bulk_copy(args, manifests, successlogger, dones):
+    if args.executor not in EXECUTORS:
+        raise ValueError(f'Unknown executor {args.executor}; must be one of {EXECUTORS}')
+    if args.executor == 'sts' and not args.manifest_bucket:
+        raise ValueError('The sts executor requires a manifest_bucket')
+    client = storage.Client()
+    copy = sts_copy if args.executor == 'sts' else local_copy
+    for (src_bucket, dst_bucket), manifest in manifests.items():
+        pair = f'{src_bucket}->{dst_bucket}'
+        if pair in dones:
+            progresslogger.info('%s previously copied', pair)
+            continue
+        begin = time.time()
+        if copy(args, client, src_bucket, dst_bucket, manifest):
+            successlogger.info(pair)
+            dones.add(pair)
+        metrics.observe(f'bulk_copy.{args.executor}', time.time() - begin)
@@ -0,0 +1,92 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# On-disk set of the keys (blob names, UIDs, ...) that a resumable tool has completed. It replaces
+# reading all of success.log into a set in every process: the set is not loaded, but queried a batch
+# of keys at a time, and any number of processes can query and add to it concurrently. A store
+# created next to an existing success.log is initialized from that log, so that a tool can resume a
+# run that was started before it used the store.
+
+import os
+import logging
+
+from utilities.sqlite_helpers import SQLiteConnections
+
+errlogger = logging.getLogger('root.err')
+
+# Maximum number of keys in a single query
+QUERY_BATCH = 500
+# Number of keys inserted per transaction when importing a log
+IMPORT_BATCH = 100000
+
+
+class CheckpointStore:
+    def __init__(self, path):
+        self.path = path
+        self.connections = SQLiteConnections(path, 'CREATE TABLE IF NOT EXISTS dones (key TEXT PRIMARY KEY) WITHOUT ROWID')
+
+    def _connection(self):
+        return self.connections.get()
+
+    def __contains__(self, key):
+        return self._connection().execute('SELECT 1 FROM dones WHERE key = ?', (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self._connection().execute('SELECT count(*) FROM dones').fetchone()[0]
+
+    # Return the keys that are not done, in their original order
+    def todo(self, keys):
+        keys = list(keys)
+        dones = set()
+        for i in range(0, len(keys), QUERY_BATCH):
+            batch = keys[i:i+QUERY_BATCH]
+            dones.update(row[0] for row in self._connection().execute(
+                f'SELECT key FROM dones WHERE key IN ({",".join("?" * len(batch))})', batch))
+        return [key for key in keys if key not in dones]
+
+    def add(self, key):
+        self._connection().execute('INSERT OR IGNORE INTO dones (key) VALUES (?)', (key,))
+
+    def add_many(self, keys):
+        conn = self._connection()
+        conn.execute('BEGIN')
+        try:
+            conn.executemany('INSERT OR IGNORE INTO dones (key) VALUES (?)', ((key,) for key in keys))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+    # Add the lines of a file, such as a success.log, reading it in batches
+    def import_log(self, path):
+        batch = []
+        with open(path) as f:
+            for line in f:
+                batch.append(line.rstrip('\n'))
+                if len(batch) == IMPORT_BATCH:
+                    self.add_many(batch)
+                    batch = []
+        self.add_many(batch)
+
+
+# Return the store of a tool that logs its completed keys with successlogger. The store is kept
+# beside the success.log, and initialized from it when first created.
+def success_checkpoints(successlogger):
+    log_path = successlogger.handlers[0].baseFilename
+    store = CheckpointStore(os.path.join(os.path.dirname(log_path), 'success.db'))
+    if not len(store) and os.path.exists(log_path):
+        store.import_log(log_path)
+    return store
@@ -0,0 +1,166 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Adaptive limit on the number of operations that the worker processes of a multiprocessing tool
+# have in flight. The tool starts as many workers as its ceiling (e.g. --processes), and each worker
+# performs an operation within controller.slot(), which waits while the limit is reached.
+# Every INTERVAL seconds the parent adjusts the limit, AIMD style:
+#   - if more than THROTTLE_THRESHOLD of the operations in the interval were throttled (429/503),
+#     or the load average per CPU exceeds CPU_LIMIT, the limit is multiplied by DECREASE
+#   - else if throughput fell by more than TOLERANCE after the last increase, that increase is undone
+#   - else, if operations waited for a slot, the limit is increased by one, up to the ceiling
+#
+#   controller = ConcurrencyController(args.processes)
+#   ... start the workers, passing them controller ...
+#   controller.start()
+#   ... in a worker:
+#       with controller.slot():
+#           try:
+#               <operation on n items>
+#               controller.record(n)
+#           except Exception as exc:
+#               if is_throttled(exc):
+#                   controller.record_throttle()
+#   ...
+#   controller.stop()
+
+import os
+import time
+import threading
+import logging
+from contextlib import contextmanager
+from multiprocessing import Value, Condition
+from google.api_core.exceptions import TooManyRequests, ServiceUnavailable
+
+progresslogger = logging.getLogger('root.progress')
+
+INITIAL_CONCURRENCY = 4
+INTERVAL = 10
+THROTTLE_THRESHOLD = 0.01
+CPU_LIMIT = 0.9
+DECREASE = 0.5
+TOLERANCE = 0.05
+
+
+def is_throttled(exc):
+    return isinstance(exc, (TooManyRequests, ServiceUnavailable)) or getattr(exc, 'code', None) in (429, 503)
+
+
+class ConcurrencyController:
+    def __init__(self, maximum, initial=INITIAL_CONCURRENCY, minimum=1, interval=INTERVAL):
+        self.maximum = int(maximum)
+        self.minimum = min(minimum, self.maximum)
+        self.interval = interval
+        # Shared by all processes, and protected by condition
+        self.condition = Condition()
+        self.limit = Value('i', max(self.minimum, min(initial, self.maximum)), lock=False)
+        self.in_flight = Value('i', 0, lock=False)
+        self.operations = Value('q', 0, lock=False)
+        self.items = Value('q', 0, lock=False)
+        self.throttled = Value('q', 0, lock=False)
+        # Number of times that an operation had to wait for a slot
+        self.waits = Value('q', 0, lock=False)
+        # Used only in the parent, by adjust()
+        self.thread = None
+        self.stopped = threading.Event()
+        self.last = (time.time(), 0, 0, 0, 0)
+        self.last_rate = None
+        self.increased = False
+
+    @contextmanager
+    def slot(self):
+        with self.condition:
+            if self.in_flight.value >= self.limit.value:
+                self.waits.value += 1
+            # Wake periodically, since an increase of the limit is not notified
+            while self.in_flight.value >= self.limit.value:
+                self.condition.wait(1)
+            self.in_flight.value += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight.value -= 1
+                self.condition.notify()
+
+    # Record an operation that completed, and the number of items (e.g. blobs) that it processed
+    def record(self, items=1):
+        with self.condition:
+            self.operations.value += 1
+            self.items.value += items
+
+    def record_throttle(self):
+        with self.condition:
+            self.throttled.value += 1
+
+    def adjust(self):
+        now = time.time()
+        with self.condition:
+            current = (now, self.operations.value, self.items.value, self.throttled.value, self.waits.value)
+            limit = self.limit.value
+        last_time, last_operations, last_items, last_throttled, last_waits = self.last
+        self.last = current
+        operations = current[1] - last_operations
+        throttled = current[3] - last_throttled
+        rate = (current[2] - last_items) / (now - last_time)
+        load = os.getloadavg()[0] / os.cpu_count()
+
+        if operations + throttled and throttled / (operations + throttled) > THROTTLE_THRESHOLD or load > CPU_LIMIT:
+            new_limit = max(self.minimum, int(limit * DECREASE))
+            reason = f'{throttled} throttled of {operations + throttled} operations, load {load:.2f}'
+            self.increased = False
+        elif self.increased and self.last_rate and rate < self.last_rate * (1 - TOLERANCE):
+            new_limit = max(self.minimum, limit - 1)
+            reason = f'throughput fell to {rate:.1f}/s from {self.last_rate:.1f}/s'
+            self.increased = False
+        elif limit < self.maximum and current[4] > last_waits:
+            # Only increase the limit when operations are waiting for it
+            new_limit = limit + 1
+            reason = f'throughput {rate:.1f}/s'
+            self.increased = True
+        else:
+            new_limit = limit
+            self.increased = False
+        self.last_rate = rate
+
+        if new_limit != limit:
+            with self.condition:
+                self.limit.value = new_limit
+                self.condition.notify_all()
+            progresslogger.info('Concurrency %s -> %s: %s', limit, new_limit, reason)
+        return new_limit
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.adjust()
+
+    # Start adjusting the limit in a thread of the calling (parent) process
+    def start(self):
+        self.last = (time.time(), self.operations.value, self.items.value, self.throttled.value, self.waits.value)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    # Exclude the thread, and the parent's events, from pickling when passed to a spawned worker
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['thread'] = None
+        state['stopped'] = None
+        return state
@@ -0,0 +1,174 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Copy and delete operations on many blobs, grouped into GCS JSON API batch requests of
+# up to BATCH_SIZE operations. Most of our blobs are small instances, for which the latency of a
+# request, rather than the bytes copied, dominates. Each function returns (succeeded, failed), where
+# failed is a list of (item, exception). An item whose operation failed with a retryable error
+# (429, 5xx, 408) is retried in a later batch, up to TRIES times; any other error fails just that
+# item, not the batch.
+#
+#   copied, failed = copy_blobs(client, args.src_bucket, args.dst_bucket, blob_names, controller)
+#   for blob_name, exc in failed:
+#       errlogger.error(...)
+#
+# If a ConcurrencyController is passed, each batch request is made within one of its slots.
+
+import time
+import logging
+from contextlib import nullcontext
+
+from google.api_core import exceptions
+
+from utilities.concurrency import is_throttled
+from utilities.metrics import metrics
+
+errlogger = logging.getLogger('root.err')
+
+# The maximum number of calls in a GCS batch request
+BATCH_SIZE = 100
+TRIES = 3
+
+
+def is_retryable(exc):
+    return is_throttled(exc) or isinstance(exc, (exceptions.ServerError, exceptions.RequestTimeout))
+
+
+# Perform request(item), which must make a single GCS API call, for each item, in batches. Returns
+# (succeeded, failed), where succeeded is a list of (item, response) and response is the JSON
+# response to the item's call, or {} if it has none.
+def run_batched(client, items, request, controller=None, tries=TRIES, name='gcs.batch'):
+    succeeded = []
+    failed = []
+    todo = list(items)
+    for attempt in range(tries):
+        retry = []
+        for i in range(0, len(todo), BATCH_SIZE):
+            chunk = todo[i:i+BATCH_SIZE]
+            begin = time.time()
+            try:
+                with controller.slot() if controller else nullcontext():
+                    # The calls are deferred to the batch while it is the client's current batch. The
+                    # batch is sent by finish() rather than on leaving a `with` block, so as to have
+                    # the response to each call, failed or not.
+                    batch = client.batch(raise_exception=False)
+                    client._push_batch(batch)
+                    try:
+                        for item in chunk:
+                            request(item)
+                    finally:
+                        client._pop_batch()
+                    responses = batch.finish(raise_exception=False)
+                if len(responses) != len(chunk):
+                    raise ValueError(f'{len(responses)} responses to a batch of {len(chunk)} calls')
+            except Exception as exc:
+                # The batch request as a whole failed
+                responses = [exc] * len(chunk)
+            metrics.observe(name, time.time() - begin)
+
+            throttled = False
+            for item, response in zip(chunk, responses):
+                if isinstance(response, Exception):
+                    exc = response
+                elif 200 <= response.status_code < 300:
+                    try:
+                        succeeded.append((item, response.json()))
+                    except ValueError:
+                        succeeded.append((item, {}))
+                    continue
+                else:
+                    exc = exceptions.from_http_response(response)
+                throttled |= is_throttled(exc)
+                if is_retryable(exc) and attempt < tries - 1:
+                    retry.append(item)
+                else:
+                    failed.append((item, exc))
+            if controller:
+                if throttled:
+                    controller.record_throttle()
+                else:
+                    controller.record(len(chunk))
+        if not retry:
+            break
+        metrics.count(f'{name}.retries', len(retry))
+        time.sleep(2 ** attempt)
+        todo = retry
+    metrics.count(f'{name}.failures', len(failed))
+    return succeeded, failed
+
+
+# Copy a blob with one or more rewrite calls, as is needed for a copy that the copyTo of a batch
+# cannot complete, e.g. of a large blob between locations or storage classes
+def rewrite_blob(src_blob, dst_blob):
+    rewrite_token = False
+    while True:
+        rewrite_token, bytes_rewritten, bytes_to_rewrite = dst_blob.rewrite(
+            src_blob, token=rewrite_token
+        )
+        if not rewrite_token:
+            break
+    return bytes_rewritten
+
+
+# Copy blobs, keeping their names. blob_names may instead be (src_name, dst_name) pairs. A blob
+# whose batched copy fails with a non-retryable error is then copied by rewrite_blob().
+def copy_blobs(client, src_bucket_name, dst_bucket_name, blob_names, controller=None, tries=TRIES):
+    src_bucket = client.bucket(src_bucket_name)
+    dst_bucket = client.bucket(dst_bucket_name)
+
+    def names(item):
+        return item if isinstance(item, tuple) else (item, item)
+
+    def copy(item):
+        src_name, dst_name = names(item)
+        src_bucket.copy_blob(src_bucket.blob(src_name), dst_bucket, dst_name)
+
+    copied, failed = run_batched(client, blob_names, copy, controller, tries, 'gcs.batch.copy')
+    metrics.count('gcs.copy.blobs', len(copied))
+    metrics.bytes('gcs.copy', sum(int(response.get('size', 0)) for _, response in copied))
+
+    still_failed = []
+    for item, exc in failed:
+        if is_retryable(exc):
+            still_failed.append((item, exc))
+            continue
+        src_name, dst_name = names(item)
+        try:
+            with controller.slot() if controller else nullcontext():
+                size = rewrite_blob(src_bucket.blob(src_name), dst_bucket.blob(dst_name))
+            metrics.count('gcs.copy.blobs')
+            metrics.bytes('gcs.copy', size)
+            copied.append((item, {}))
+        except Exception as rewrite_exc:
+            still_failed.append((item, rewrite_exc))
+    metrics.count('gcs.copy.failures', len(still_failed))
+    return [item for item, _ in copied], still_failed
+
+
+# Delete blobs. blobs may be names or (name, generation) pairs. A blob that is not found is
+# counted as deleted.
+def delete_blobs(client, bucket_name, blobs, controller=None, tries=TRIES):
+    bucket = client.bucket(bucket_name)
+
+    def delete(item):
+        name, generation = item if isinstance(item, (tuple, list)) else (item, None)
+        bucket.blob(name, generation=generation).delete()
+
+    deleted, failed = run_batched(client, blobs, delete, controller, tries, 'gcs.batch.delete')
+    deleted = [item for item, _ in deleted] + [item for item, exc in failed if isinstance(exc, exceptions.NotFound)]
+    failed = [(item, exc) for item, exc in failed if not isinstance(exc, exceptions.NotFound)]
+    metrics.count('gcs.delete.blobs', len(deleted))
+    return deleted, failed
@@ -0,0 +1,230 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Process-wide timing and throughput metrics.
+#
+#   from utilities.metrics import metrics
+#   with metrics.timer('tcia.download'):      # Latency histogram, in seconds
+#       ...
+#   metrics.count('instances.copied', n)      # Counter
+#   metrics.observe('series.instances', n)    # Histogram of arbitrary values
+#   metrics.bytes('gcs.upload', size)         # Bytes moved, and the span over which they were moved
+#
+# Each process records into its own registry. If metrics.configure(directory) is called before
+# worker processes are started, each process writes a snapshot of its registry to that directory
+# when metrics.flush() is called, and the parent combines them with collect(directory).
+# Histograms use logarithmic buckets, each HISTOGRAM_RATIO wide, so that snapshots of any number
+# of processes merge exactly and percentiles are accurate to within a bucket.
+
+import os
+import json
+import math
+import time
+import threading
+from uuid import uuid4
+from contextlib import contextmanager
+from collections import defaultdict
+
+HISTOGRAM_RATIO = 1.05
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def new_histogram():
+    return dict(count=0, sum=0.0, min=None, max=None, buckets=defaultdict(int))
+
+
+def new_meter():
+    return dict(bytes=0, first=None, last=None)
+
+
+class Metrics:
+    def __init__(self):
+        self.directory = None
+        self.reset()
+
+    def reset(self):
+        # A lock held by another thread of a forking parent would never be released in the child
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = defaultdict(new_histogram)
+        self.meters = defaultdict(new_meter)
+        # Identifies this process's snapshot. A pid alone could be reused by a later process.
+        self.id = f'{os.getpid()}-{uuid4().hex[:8]}'
+
+    # Snapshots left in directory by an earlier run are removed
+    def configure(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.startswith('snapshot-'):
+                os.remove(f'{directory}/{name}')
+        self.directory = directory
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms[name]
+            histogram['count'] += 1
+            histogram['sum'] += value
+            histogram['min'] = value if histogram['min'] is None else min(histogram['min'], value)
+            histogram['max'] = value if histogram['max'] is None else max(histogram['max'], value)
+            bucket = math.floor(math.log(value, HISTOGRAM_RATIO)) if value > 0 else None
+            histogram['buckets'][bucket] += 1
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def bytes(self, name, size, start=None):
+        now = time.time()
+        with self.lock:
+            meter = self.meters[name]
+            meter['bytes'] += size
+            meter['first'] = min(meter['first'] or now, start or now)
+            meter['last'] = now
+
+    def snapshot(self):
+        with self.lock:
+            return dict(
+                counters=dict(self.counters),
+                histograms={name: dict(histogram, buckets={str(bucket): count for bucket, count in histogram['buckets'].items()}) \
+                            for name, histogram in self.histograms.items()},
+                meters={name: dict(meter) for name, meter in self.meters.items()}
+            )
+
+    # Write this process's snapshot, if a directory is configured
+    def flush(self):
+        if self.directory:
+            path = f'{self.directory}/snapshot-{self.id}.json'
+            with open(f'{path}.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(f'{path}.tmp', path)
+
+
+metrics = Metrics()
+
+# A forked child starts with an empty registry. Otherwise it would report its parent's metrics again.
+os.register_at_fork(after_in_child=metrics.reset)
+
+
+def merge(snapshots):
+    merged = dict(counters=defaultdict(float), histograms={}, meters={})
+    for snapshot in snapshots:
+        for name, value in snapshot['counters'].items():
+            merged['counters'][name] += value
+        for name, histogram in snapshot['histograms'].items():
+            total = merged['histograms'].setdefault(name, dict(count=0, sum=0.0, min=None, max=None, buckets=defaultdict(int)))
+            total['count'] += histogram['count']
+            total['sum'] += histogram['sum']
+            total['min'] = histogram['min'] if total['min'] is None else min(total['min'], histogram['min'])
+            total['max'] = histogram['max'] if total['max'] is None else max(total['max'], histogram['max'])
+            for bucket, count in histogram['buckets'].items():
+                total['buckets'][bucket] += count
+        for name, meter in snapshot['meters'].items():
+            total = merged['meters'].setdefault(name, dict(bytes=0, first=None, last=None))
+            total['bytes'] += meter['bytes']
+            total['first'] = meter['first'] if total['first'] is None else min(total['first'], meter['first'])
+            total['last'] = meter['last'] if total['last'] is None else max(total['last'], meter['last'])
+    merged['counters'] = dict(merged['counters'])
+    for histogram in merged['histograms'].values():
+        histogram['buckets'] = dict(histogram['buckets'])
+    return merged
+
+
+# Merge the snapshots written to a directory, and that of this process
+def collect(directory=None):
+    directory = directory or metrics.directory
+    metrics.flush()
+    snapshots = []
+    if directory:
+        for name in os.listdir(directory):
+            if name.startswith('snapshot-') and name.endswith('.json'):
+                with open(f'{directory}/{name}') as f:
+                    snapshots.append(json.load(f))
+    else:
+        snapshots.append(metrics.snapshot())
+    return merge(snapshots)
+
+
+def quantile(histogram, q):
+    rank = q * histogram['count']
+    seen = 0
+    for bucket, count in sorted(histogram['buckets'].items(), key=lambda item: -math.inf if item[0] in (None, 'None') else int(item[0])):
+        seen += count
+        if seen >= rank:
+            if bucket in (None, 'None'):
+                return 0.0
+            # The geometric midpoint of the bucket, clamped to the observed range
+            return min(max(HISTOGRAM_RATIO ** (int(bucket) + 0.5), histogram['min']), histogram['max'])
+    return histogram['max']
+
+
+# Summarize a (merged) snapshot: histograms as count, mean and quantiles, meters as bytes and rate
+def summary(snapshot):
+    return dict(
+        counters=snapshot['counters'],
+        histograms={name: dict(count=histogram['count'], sum=histogram['sum'], min=histogram['min'], max=histogram['max'],
+                               mean=histogram['sum']/histogram['count'] if histogram['count'] else 0,
+                               **{f'p{int(q*100)}': quantile(histogram, q) for q in QUANTILES}) \
+                    for name, histogram in snapshot['histograms'].items()},
+        meters={name: dict(bytes=meter['bytes'], seconds=meter['last'] - meter['first'],
+                           bytes_per_second=meter['bytes']/(meter['last'] - meter['first']) if meter['last'] > meter['first'] else 0) \
+                for name, meter in snapshot['meters'].items()}
+    )
+
+
+def to_json(snapshot):
+    return json.dumps(summary(snapshot), indent=2, sort_keys=True)
+
+
+def prometheus_name(name):
+    return 'etl_' + ''.join(c if c.isalnum() else '_' for c in name)
+
+
+# Render a (merged) snapshot in the Prometheus text exposition format
+def to_prometheus(snapshot):
+    lines = []
+    for name, value in sorted(snapshot['counters'].items()):
+        lines.append(f'# TYPE {prometheus_name(name)}_total counter')
+        lines.append(f'{prometheus_name(name)}_total {value}')
+    for name, histogram in sorted(snapshot['histograms'].items()):
+        lines.append(f'# TYPE {prometheus_name(name)} summary')
+        for q in QUANTILES:
+            lines.append(f'{prometheus_name(name)}{{quantile="{q}"}} {quantile(histogram, q)}')
+        lines.append(f'{prometheus_name(name)}_sum {histogram["sum"]}')
+        lines.append(f'{prometheus_name(name)}_count {histogram["count"]}')
+    for name, meter in sorted(snapshot['meters'].items()):
+        lines.append(f'# TYPE {prometheus_name(name)}_bytes_total counter')
+        lines.append(f'{prometheus_name(name)}_bytes_total {meter["bytes"]}')
+        lines.append(f'# TYPE {prometheus_name(name)}_seconds gauge')
+        lines.append(f'{prometheus_name(name)}_seconds {meter["last"] - meter["first"]}')
+    return '\n'.join(lines) + '\n'
+
+
+# Write the merged metrics of a directory as <prefix>.json and <prefix>.prom
+def export(prefix, directory=None):
+    snapshot = collect(directory)
+    with open(f'{prefix}.json', 'w') as f:
+        f.write(to_json(snapshot))
+    with open(f'{prefix}.prom', 'w') as f:
+        f.write(to_prometheus(snapshot))
+    return snapshot
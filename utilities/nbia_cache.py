@@ -0,0 +1,83 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# On-disk cache of NBIA API responses, shared by all the processes of a version build so that
+# a restarted build does not repeat the NBIA queries of collections that were already expanded.
+# Entries are keyed by endpoint and parameters, expire after a TTL, and are only valid for the
+# IDC version that created them.
+
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+
+from utilities.sqlite_helpers import SQLiteConnections
+
+errlogger = logging.getLogger('root.err')
+
+
+class NBIACache:
+    def __init__(self, path, ttl, version):
+        self.path = path
+        self.ttl = ttl
+        self.version = version
+        self.connections = SQLiteConnections(path, 'CREATE TABLE IF NOT EXISTS responses '
+                                             '(key TEXT PRIMARY KEY, version INTEGER, endpoint TEXT, created REAL, value TEXT)')
+
+    def _connection(self):
+        return self.connections.get()
+
+    @staticmethod
+    def key(endpoint, params):
+        return hashlib.sha256(json.dumps([endpoint, params], sort_keys=True).encode()).hexdigest()
+
+    # Return the cached value of a request, or None if it is not cached, expired or from another version
+    def get(self, endpoint, params):
+        try:
+            row = self._connection().execute(
+                'SELECT value FROM responses WHERE key = ? AND version = ? AND created > ?',
+                (self.key(endpoint, params), self.version, time.time() - self.ttl)).fetchone()
+        except sqlite3.Error as exc:
+            errlogger.error('NBIA cache read failed: %s', exc)
+            return None
+        return json.loads(row[0]) if row else None
+
+    def put(self, endpoint, params, value):
+        try:
+            self._connection().execute(
+                'INSERT OR REPLACE INTO responses (key, version, endpoint, created, value) VALUES (?, ?, ?, ?, ?)',
+                (self.key(endpoint, params), self.version, endpoint, time.time(), json.dumps(value)))
+        except sqlite3.Error as exc:
+            # The cache is only an optimization
+            errlogger.error('NBIA cache write failed: %s', exc)
+
+    # Return the cached result of a request, or call fetch() and cache its result.
+    # A result of None is treated as a failure and not cached.
+    def get_or_fetch(self, endpoint, params, fetch):
+        value = self.get(endpoint, params)
+        if value is None:
+            value = fetch()
+            if value is not None:
+                self.put(endpoint, params, value)
+        return value
+
+    # Delete the entries of other versions, or of a given endpoint
+    def invalidate(self, endpoint=None):
+        if endpoint:
+            self._connection().execute('DELETE FROM responses WHERE endpoint = ?', (endpoint,))
+        else:
+            self._connection().execute('DELETE FROM responses WHERE version != ?', (self.version,))
@@ -14,22 +14,66 @@
 # limitations under the License.
 #
 
+import os
 import settings
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import NullPool
 from sqlalchemy_utils import register_composites
 from sqlalchemy.orm import Session
 from idc.models import Base
 
-# Create an SQLAlchemy session
-def sa_session(echo=False):
-    sql_uri = f'postgresql+psycopg2://{settings.CLOUD_USERNAME}:{settings.CLOUD_PASSWORD}@{settings.CLOUD_HOST}:{settings.CLOUD_PORT}/{settings.CLOUD_DATABASE}'
-    sql_engine = create_engine(sql_uri, echo=echo)
+POOL_SIZE = 5
+MAX_OVERFLOW = 5
+# Seconds after which a pooled connection is replaced rather than reused
+POOL_RECYCLE = 1800
+# Milliseconds after which the server cancels a statement. 0 disables the timeout.
+STATEMENT_TIMEOUT = 0
 
-    # Enable the underlying psycopg2 to deal with composites
-    conn = sql_engine.connect()
-    register_composites(conn)
+# Engines are created once per process and configuration, and reused by every session.
+_engines = {}
 
-    sess = Session(sql_engine)
 
-    return sess
+# A forked child must not use, or close, the pooled connections of its parent's engines.
+# Drop the references without closing the connections, and let the child create its own engines.
+def _dispose_engines_after_fork():
+    for engine in _engines.values():
+        engine.dispose(close=False)
+    _engines.clear()
+
+os.register_at_fork(after_in_child=_dispose_engines_after_fork)
+
+
+# Return this process's engine for the given configuration, creating it if necessary.
+# If pgbouncer is True, connections are pooled by PgBouncer rather than by the engine, and
+# the statement timeout is set per transaction, since PgBouncer, in transaction pooling mode,
+# neither passes startup options nor preserves session settings.
+def get_engine(echo=False, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW, statement_timeout=STATEMENT_TIMEOUT,
+               pgbouncer=False):
+    key = (echo, pool_size, max_overflow, statement_timeout, pgbouncer)
+    if key not in _engines:
+        sql_uri = f'postgresql+psycopg2://{settings.CLOUD_USERNAME}:{settings.CLOUD_PASSWORD}@{settings.CLOUD_HOST}:{settings.CLOUD_PORT}/{settings.CLOUD_DATABASE}'
+        if pgbouncer:
+            sql_engine = create_engine(sql_uri, echo=echo, poolclass=NullPool)
+            if statement_timeout:
+                @event.listens_for(sql_engine, 'begin')
+                def set_statement_timeout(conn):
+                    conn.exec_driver_sql(f'SET LOCAL statement_timeout = {int(statement_timeout)}')
+        else:
+            connect_args = {'options': f'-c statement_timeout={int(statement_timeout)}'} if statement_timeout else {}
+            sql_engine = create_engine(sql_uri, echo=echo, pool_size=pool_size, max_overflow=max_overflow,
+                                       pool_pre_ping=True, pool_recycle=POOL_RECYCLE, connect_args=connect_args)
+
+        # Enable the underlying psycopg2 to deal with composites. The registration is global,
+        # so this is only needed once per engine.
+        with sql_engine.connect() as conn:
+            register_composites(conn)
 
+        _engines[key] = sql_engine
+    return _engines[key]
+
+
+# Create an SQLAlchemy session on this process's pooled engine
+def sa_session(echo=False, **engine_args):
+    sess = Session(get_engine(echo, **engine_args))
+
+    return sess
@@ -0,0 +1,54 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+# sqlite connections for stores that are shared by the processes and threads of a tool. A sqlite
+# connection must not be shared across a fork or between threads, so one is opened per process and
+# thread, on first use. Each connection is in autocommit mode and uses WAL, so that readers in other
+# processes proceed while one process writes.
+#
+#   self.connections = SQLiteConnections(path, 'CREATE TABLE IF NOT EXISTS ...')
+#   rows = self.connections.get().execute(...)
+#
+# A SQLiteConnections pickles without its connections, so that the object holding it can be passed
+# to a multiprocessing worker.
+
+import os
+import sqlite3
+import threading
+
+
+class SQLiteConnections:
+    def __init__(self, path, schema):
+        self.path = path
+        # Statement run on each new connection, e.g. to create the store's table
+        self.schema = schema
+        self.connections = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['connections'] = {}
+        return state
+
+    def get(self):
+        connection_id = (os.getpid(), threading.get_ident())
+        if connection_id not in self.connections:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(self.schema)
+            self.connections[connection_id] = conn
+        return self.connections[connection_id]
@@ -18,9 +18,16 @@ import os
 
 import json
 import sys
+import struct
+import zlib
+import hashlib
 from subprocess import run, PIPE
-from time import sleep
+import random
+from time import sleep, time
+from collections import defaultdict
 import requests
+from requests.adapters import HTTPAdapter
+from utilities.metrics import metrics as etl_metrics
 import logging
 
 import zipfile
@@ -42,12 +49,14 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 TIMEOUT=60
 CHUNK_SIZE=1024*1024
 
-TCIA_URL = 'https://services.cancerimagingarchive.net/services/v4/TCIA/query'
-NBIA_URL = 'https://services.cancerimagingarchive.net/nbia-api/services'
-NBIA_V1_URL = 'https://services.cancerimagingarchive.net/nbia-api/services/v1'
-NBIA_V2_URL = 'https://services.cancerimagingarchive.net/nbia-api/services/v2'
+# NBIA_HOST can be set in the environment to direct NBIA requests elsewhere, e.g. to benchmarks/fake_nbia.py
+NBIA_HOST = os.environ.get('NBIA_HOST', 'https://services.cancerimagingarchive.net')
+TCIA_URL = f'{NBIA_HOST}/services/v4/TCIA/query'
+NBIA_URL = f'{NBIA_HOST}/nbia-api/services'
+NBIA_V1_URL = f'{NBIA_HOST}/nbia-api/services/v1'
+NBIA_V2_URL = f'{NBIA_HOST}/nbia-api/services/v2'
 # NBIA_AUTH_URL = "https://public.cancerimagingarchive.net/nbia-api/oauth/token"
-NBIA_AUTH_URL = "https://services.cancerimagingarchive.net/nbia-api/oauth/token"
+NBIA_AUTH_URL = f"{NBIA_HOST}/nbia-api/oauth/token"
 NBIA_DEV_URL = 'https://public-dev.cancerimagingarchive.net/nbia-api/services'
 NBIA_DEV_AUTH_URL = "https://public-dev.cancerimagingarchive.net/nbia-api/oauth/token"
 NLST_URL = 'https://nlst.cancerimagingarchive.net/nbia-api/services'
@@ -55,12 +64,95 @@ NLST_V1_URL = 'https://nlst.cancerimagingarchive.net/nbia-api/services/v1'
 NLST_V2_URL = 'https://nlst.cancerimagingarchive.net/nbia-api/services/v2'
 NLST_AUTH_URL = 'https://nlst.cancerimagingarchive.net/nbia-api/oauth/token'
 
+# Each process keeps one pooled session so that requests to NBIA reuse keep-alive connections
+# rather than performing a TCP/TLS handshake per request.
+NBIA_POOL_SIZE=16
+CONNECT_TIMEOUT=10
+# Responses with these status codes, and connection errors and timeouts, are retried with jittered
+# exponential backoff: the n'th retry waits a random time in [0, min(BACKOFF_MAX, BACKOFF_BASE * 2**n)]
+RETRY_STATUSES=(429, 500, 502, 503, 504)
+MAX_RETRIES=5
+BACKOFF_BASE=1
+BACKOFF_MAX=60
+
+_nbia_sessions = {}
+# Per process request metrics, indexed by host and path
+_nbia_metrics = defaultdict(lambda: dict(requests=0, retries=0, failures=0, seconds=0.0))
+
+
+def get_nbia_session():
+    pid = os.getpid()
+    if pid not in _nbia_sessions:
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_connections=NBIA_POOL_SIZE, pool_maxsize=NBIA_POOL_SIZE))
+        session.mount('http://', HTTPAdapter(pool_connections=NBIA_POOL_SIZE, pool_maxsize=NBIA_POOL_SIZE))
+        _nbia_sessions[pid] = session
+    return _nbia_sessions[pid]
+
+
+def backoff_delay(attempt, response=None):
+    # Honor a Retry-After from a throttling server
+    if response is not None and response.headers.get('Retry-After', '').isdigit():
+        return min(BACKOFF_MAX, int(response.headers['Retry-After']))
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+# Issue a request through this process's pooled session, retrying throttled and failed requests.
+# Returns the last response, which may have a retryable status if retries were exhausted, so that
+# callers can continue to inspect status_code. Raises the last exception if no response was received.
+def nbia_request(method, url, timeout=TIMEOUT, retry_statuses=RETRY_STATUSES, max_retries=MAX_RETRIES, **kwargs):
+    metrics = _nbia_metrics[url.split('?')[0]]
+    endpoint = f"nbia.{url.split('?')[0].rsplit('/', 1)[-1]}"
+    attempt = 0
+    while True:
+        start = time()
+        metrics['requests'] += 1
+        try:
+            response = get_nbia_session().request(method, url, timeout=(CONNECT_TIMEOUT, timeout), **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            metrics['seconds'] += time() - start
+            etl_metrics.count(f'{endpoint}.errors')
+            if attempt == max_retries:
+                metrics['failures'] += 1
+                raise
+            response = None
+        else:
+            metrics['seconds'] += time() - start
+            etl_metrics.observe(endpoint, time() - start)
+            if response.status_code not in retry_statuses:
+                return response
+            if attempt == max_retries:
+                metrics['failures'] += 1
+                return response
+            # Release the connection of a streamed response before retrying
+            response.close()
+        metrics['retries'] += 1
+        etl_metrics.count(f'{endpoint}.retries')
+        sleep(backoff_delay(attempt, response))
+        attempt += 1
+
+
+def nbia_get(url, **kwargs):
+    return nbia_request('GET', url, **kwargs)
+
+
+def nbia_post(url, **kwargs):
+    return nbia_request('POST', url, **kwargs)
+
+
+# Return a snapshot of this process's request metrics, and optionally reset them
+def get_nbia_metrics(reset=False):
+    metrics = {url: dict(values) for url, values in _nbia_metrics.items()}
+    if reset:
+        _nbia_metrics.clear()
+    return metrics
+
 
 # @backoff.on_exception(backoff.expo,
 #                       requests.exceptions.RequestException,
 #                       max_tries=3)
 def get_url(url, headers="", timeout=TIMEOUT):  # , headers):
-    result =  requests.get(url, headers=headers, timeout=timeout)  # , headers=headers)
+    result =  nbia_get(url, headers=headers, timeout=timeout)  # , headers=headers)
     if result.status_code != 200:
         raise RuntimeError('In get_url(): status_code=%s; url: %s', result.status_code, url)
     return result
@@ -81,7 +173,7 @@ def get_access_token(auth_server = NBIA_AUTH_URL):
             client_secret=settings.TCIA_CLIENT_SECRET,
             grant_type="password")
 
-    result = requests.post(auth_server, data = data)
+    result = nbia_post(auth_server, data = data)
     return (result.json()['access_token'], result.json()['refresh_token'])
 
 
@@ -92,11 +184,43 @@ def refresh_access_token(refresh_token, auth_server = NBIA_AUTH_URL):
         client_secret=settings.TCIA_CLIENT_SECRET,
         grant_type="refresh_token")
 
-    result = requests.post(auth_server, data = data)
+    result = nbia_post(auth_server, data = data)
     access_token = result.json()['access_token']
     return (access_token, refresh_token)
 
 
+# Shares an NBIA access token among processes without serializing requests.
+# access is a ShareableList of [access_token, refresh_token, generation]. Requests read the token
+# without locking; only a refresh takes the lock. The generation is odd while a refresh is writing
+# the token, and is used to detect that another process has already refreshed the token that
+# failed, so that a burst of 401s results in a single refresh.
+class NBIATokenManager:
+    def __init__(self, access, lock):
+        self.access = access
+        self.lock = lock
+
+    # Return a consistent (access_token, generation)
+    def token(self):
+        while True:
+            generation = self.access[2]
+            if generation % 2 == 0:
+                access_token = self.access[0]
+                if self.access[2] == generation:
+                    return access_token, generation
+            sleep(0.01)
+
+    # Refresh the token if it is still the one with the given generation. Returns the current token.
+    def refresh(self, generation):
+        with self.lock:
+            if self.access[2] == generation:
+                access_token, refresh_token = refresh_access_token(self.access[1])
+                self.access[2] = generation + 1
+                self.access[0] = access_token
+                self.access[1] = refresh_token
+                self.access[2] = generation + 2
+        return self.token()
+
+
 def get_collection_id_from_doi(doi):
     access_token, refresh_token = get_access_token(NBIA_AUTH_URL)
     headers = dict(
@@ -104,7 +228,7 @@ def get_collection_id_from_doi(doi):
     )
     url = f"{NBIA_URL}/getCollectionOrSeriesForDOI"
     data = { "DOI": f'https://doi.org/{doi}', "CollectionOrSeries": 'collection' }
-    result = requests.post(url, headers=headers, data=data).json()
+    result = nbia_post(url, headers=headers, data=data).json()
     if len(result)>0:
         return result[0]['collection']
     else:
@@ -118,7 +242,7 @@ def get_instance_hash_nlst(sop_instance_uid, access_token=None):
         Authorization=f'Bearer {access_token}'
     )
     url = f"{NLST_V1_URL}/getM5HashForImage?SOPInstanceUid={sop_instance_uid}"
-    result = requests.get(url, headers=headers)
+    result = nbia_get(url, headers=headers)
     return result
 
 def get_instance_hash(sop_instance_uid, access_token=None):
@@ -128,7 +252,7 @@ def get_instance_hash(sop_instance_uid, access_token=None):
         Authorization=f'Bearer {access_token}'
     )
     url = f"{NBIA_V2_URL}/getM5HashForImage?SOPInstanceUid={sop_instance_uid}"
-    result = requests.get(url, headers=headers)
+    result = nbia_get(url, headers=headers)
     return result
 
 def get_hash_nlst(request_data, access_token=''):
@@ -137,24 +261,19 @@ def get_hash_nlst(request_data, access_token=''):
         Authorization=f'Bearer {access_token}'
     )
     url = f"{NLST_URL}/getMD5Hierarchy"
-    result = requests.post(url, headers=headers, data=request_data)
+    result = nbia_post(url, headers=headers, data=request_data)
     return result
 
 def get_hash(request_data, access_token=None):
     if not access_token:
         access_token, refresh_token = get_access_token(NBIA_AUTH_URL)
-    retries = 4
-    while retries:
-        headers = dict(
-            Authorization=f'Bearer {access_token}'
-        )
-        url = f"{NBIA_URL}/getMD5Hierarchy"
-        result = requests.post(url, headers=headers, data=request_data)
-        if result.status_code == 200:
-            break
-        else:
-            sleep( 2**(5-retries))
-            retries -= 1
+    headers = dict(
+        Authorization=f'Bearer {access_token}'
+    )
+    url = f"{NBIA_URL}/getMD5Hierarchy"
+    # Throttled and failed requests are retried by nbia_post. An expired token (401) is returned to
+    # the caller to refresh.
+    result = nbia_post(url, headers=headers, data=request_data)
     return result
 
 
@@ -164,14 +283,14 @@ def get_images_with_md5_hash_nlst(SeriesInstanceUID, access_token=None):
     )
     server_url = NLST_V1_URL
     url = f'{server_url}/getImageWithMD5Hash?SeriesInstanceUID={SeriesInstanceUID}'
-    result = requests.get(url, headers=headers)
+    result = nbia_get(url, headers=headers)
     return result
 
 
 def get_images_with_md5_hash(SeriesInstanceUID, access_token=None):
     server_url = NBIA_V1_URL
     url = f'{server_url}/getImageWithMD5Hash?SeriesInstanceUID={SeriesInstanceUID}'
-    result = requests.get(url)
+    result = nbia_get(url)
     return result
 
 
@@ -189,7 +308,7 @@ def get_collection_values_and_counts(server=NBIA_URL):
         Authorization = f'Bearer {access_token}'
     )
     url = f'{server_url}/getCollectionValuesAndCounts'
-    result = requests.get(url, headers=headers)
+    result = nbia_get(url, headers=headers)
     collections = [collection['criteria'] for collection in result.json()]
     return collections
 
@@ -319,12 +438,27 @@ def get_TCIA_single_instance(seriesInstanceUID, sopInstanceUID, server=NBIA_V1_U
     return results
 
 
+# Write byte chunks to a file object, computing the MD5 hash and size of the data as it passes.
+# Returns (hex md5, size in bytes)
+def copy_and_hash(chunks, dst):
+    md5 = hashlib.md5()
+    size = 0
+    for chunk in chunks:
+        md5.update(chunk)
+        dst.write(chunk)
+        size += len(chunk)
+    return md5.hexdigest(), size
+
+
+# Download a zip of the instances in a series and extract it to <dicom>/<series_instance_uid>.
+# Returns the rows of the md5hashes.csv that NBIA includes in the zip, and a dictionary, indexed by
+# file name, of the (md5 hash, size) of each extracted file.
 def get_TCIA_instances_per_series_with_hashes(dicom, series_instance_uid):
     filename = "{}/{}.zip".format(dicom, series_instance_uid)
     dirname = "{}/{}".format(dicom, series_instance_uid)
 
     url = f'{NBIA_V1_URL}/getImageWithMD5Hash?SeriesInstanceUID={series_instance_uid}'
-    with requests.get(url, stream=True) as r:
+    with nbia_get(url, stream=True) as r:
         r.raise_for_status()
         with open(filename, 'wb') as f:
             for chunk in r.iter_content(chunk_size=8192):
@@ -334,14 +468,139 @@ def get_TCIA_instances_per_series_with_hashes(dicom, series_instance_uid):
                 f.write(chunk)
 
     # Now try to extract the instances to a directory DICOM/<series_instance_uid>
+    # Each instance is hashed as it is extracted so that it need not be read again.
     os.mkdir(f"{dirname}")
+    hashes = None
+    file_hashes = {}
     with zipfile.ZipFile(filename, "r") as zip_ref:
-        zip_ref.extractall(f'{dirname}')
-
-    hashes = open(f'{dirname}/md5hashes.csv').read().splitlines()[1:]
-    os.remove(f'{dirname}/md5hashes.csv')
+        for member in zip_ref.infolist():
+            if member.is_dir():
+                continue
+            if member.filename == 'md5hashes.csv':
+                hashes = zip_ref.read(member).decode().splitlines()[1:]
+                continue
+            # Only extract into dirname, whatever path the member has in the zip
+            name = os.path.basename(member.filename)
+            if name in ('', '.', '..') or name.startswith('.'):
+                raise RuntimeError(f'Invalid member {member.filename} in zip of series {series_instance_uid}')
+            with zip_ref.open(member) as src, open(os.path.join(dirname, name), 'wb') as dst:
+                file_hashes[name] = copy_and_hash(iter(lambda: src.read(CHUNK_SIZE), b''), dst)
+
+    if hashes is None:
+        raise RuntimeError(f'No md5hashes.csv in zip of series {series_instance_uid}')
+    return hashes, file_hashes
+
+# Zip record signatures and general purpose flags used when reading a zip as a stream
+ZIP_LOCAL_HEADER_SIG = b'PK\x03\x04'
+ZIP_DATA_DESCRIPTOR_SIG = b'PK\x07\x08'
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+ZIP_FLAG_UTF8 = 0x800
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Read the members of a zip sequentially from a non-seekable stream, such as an HTTP response.
+# zipfile needs the central directory at the end of the archive, so instead we walk the local
+# file headers. Yields (member_name, chunks) where chunks is an iterator over the decompressed
+# bytes of the member. Each member's chunks must be consumed before advancing to the next member;
+# any unconsumed data is drained.
+class ZipStreamReader:
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = b''
+
+    def _read_exact(self, n):
+        while len(self.buffer) < n:
+            chunk = self.stream.read(self.chunk_size)
+            if not chunk:
+                raise EOFError('Unexpected end of zip stream')
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    def _read_some(self, n):
+        if not self.buffer:
+            self.buffer = self.stream.read(self.chunk_size)
+            if not self.buffer:
+                raise EOFError('Unexpected end of zip stream')
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    def _stored_chunks(self, compressed_size):
+        remaining = compressed_size
+        while remaining:
+            data = self._read_some(min(remaining, self.chunk_size))
+            remaining -= len(data)
+            yield data
+
+    def _deflated_chunks(self):
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        while not decompressor.eof:
+            data = self._read_some(self.chunk_size)
+            out = decompressor.decompress(data)
+            if out:
+                yield out
+        # Return whatever followed the end of the deflate stream to the buffer
+        self.buffer = decompressor.unused_data + self.buffer
+
+    def members(self):
+        while True:
+            signature = self._read_exact(4)
+            if signature != ZIP_LOCAL_HEADER_SIG:
+                # We've reached the central directory. There are no more members.
+                return
+            _, flags, method, _, _, _, compressed_size, _, name_len, extra_len = \
+                struct.unpack('<HHHHHIIIHH', self._read_exact(26))
+            name = self._read_exact(name_len).decode('utf-8' if flags & ZIP_FLAG_UTF8 else 'cp437')
+            extra = self._read_exact(extra_len)
+
+            # Zip64 sizes are in the extra field
+            zip64 = False
+            offset = 0
+            while offset + 4 <= len(extra):
+                header_id, data_len = struct.unpack('<HH', extra[offset:offset+4])
+                if header_id == 0x0001:
+                    zip64 = True
+                    if compressed_size == 0xFFFFFFFF:
+                        # The uncompressed size precedes the compressed size
+                        compressed_size = struct.unpack('<Q', extra[offset+12:offset+20])[0]
+                offset += 4 + data_len
+
+            if method == ZIP_STORED:
+                if flags & ZIP_FLAG_DATA_DESCRIPTOR:
+                    raise RuntimeError(f'Cannot stream stored zip member {name} without known size')
+                chunks = self._stored_chunks(compressed_size)
+            elif method == ZIP_DEFLATED:
+                chunks = self._deflated_chunks()
+            else:
+                raise RuntimeError(f'Unsupported compression method {method} for zip member {name}')
+
+            yield name, chunks
+
+            # Drain anything the caller did not consume
+            for _ in chunks:
+                pass
+
+            if flags & ZIP_FLAG_DATA_DESCRIPTOR:
+                # The descriptor signature is optional
+                signature = self._read_exact(4)
+                if signature != ZIP_DATA_DESCRIPTOR_SIG:
+                    self.buffer = signature + self.buffer
+                # crc, compressed size, uncompressed size
+                self._read_exact(4 + (16 if zip64 else 8))
+
+
+# Stream a zip of the instances in a series, together with an md5hashes.csv, directly from NBIA.
+# Nothing is written to disk. Yields (member_name, chunks) per ZipStreamReader.members().
+def stream_TCIA_instances_per_series_with_hashes(series_instance_uid):
+    url = f'{NBIA_V1_URL}/getImageWithMD5Hash?SeriesInstanceUID={series_instance_uid}'
+    with nbia_get(url, stream=True, timeout=TIMEOUT) as r:
+        r.raise_for_status()
+        # Undo any transfer encoding (e.g. gzip) applied by the server
+        r.raw.decode_content = True
+        for name, chunks in ZipStreamReader(r.raw).members():
+            yield name, chunks
 
-    return hashes
 
 def get_TCIA_instances_per_series(dicom, series_instance_uid, server=NBIA_V1_URL):
     filename = "{}/{}.zip".format(dicom, series_instance_uid)
@@ -444,7 +703,7 @@ def get_internal_series_ids(collection, patient, third_party="yes", size=100000,
             start=0,
             size=size)
 
-    result = requests.post(
+    result = nbia_post(
         url,
         headers=headers,
         data=data
@@ -488,7 +747,7 @@ def get_collection_descriptions_and_licenses(collection=None):
             Authorization=f'Bearer {access_token}'
         )
 
-    result = requests.get(
+    result = nbia_get(
         url,
         headers=headers
     )
@@ -550,7 +809,7 @@ def get_license_info():
     headers = dict(
         Authorization=f'Bearer {access_token}'
     )
-    result = requests.get(
+    result = nbia_get(
         url='https://public.cancerimagingarchive.net/nbia-api/services/getLicenses',
         headers=headers
     )
@@ -610,7 +869,8 @@ def get_updated_series(date):
     # url = f'https://services.cancerimagingarchive.net/nbia-api/services/v2/getUpdatedSeries?fromDate={date}'
     url = f'https://services.cancerimagingarchive.net/nbia-api/services/v1/getUpdatedSeries?fromDate={date}'
     # result = requests.get(url, headers=headers)
-    result = requests.get(url)
+    # NBIA reports that there are no updated series with a 500, so don't retry it
+    result = nbia_get(url, retry_statuses=(429, 502, 503, 504))
     if result.status_code == 500 and result.text == 'No data found.':
         series = []
     else: